@@ -0,0 +1,18 @@
+# Generated by Django 5.1.5 on 2026-10-19 15:29
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('events', '0003_remove_birthdayparty_student_birthdayparty_students_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='activity',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True),
+        ),
+    ]
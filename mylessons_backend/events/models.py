@@ -26,6 +26,8 @@ class Activity(models.Model):
     school = models.ForeignKey('schools.School', on_delete=models.CASCADE, related_name='activities', blank=True, null=True)
     activity_model = models.ForeignKey(ActivityModel, on_delete=models.CASCADE, related_name='activities', blank=True, null=True 
                                        )
+    updated_at = models.DateTimeField(auto_now=True)
+
     def __str__(self):
         return f"{self.name} on {self.date} at {self.start_time}"
     
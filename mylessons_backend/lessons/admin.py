@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import  Lesson, Pack, Voucher
+from .models import  CalendarSyncState, Lesson, Pack, PackBooking, Voucher
 
 # Inline model for ClassTicket
 class LessonInline(admin.TabularInline):  # You can also use StackedInline if you prefer that style
@@ -32,3 +32,18 @@ class VoucherAdmin(admin.ModelAdmin):
     search_fields = ('user__username',)
     ordering = ('-date',)
     filter_horizontal = ('packs', 'lessons')
+
+
+@admin.register(CalendarSyncState)
+class CalendarSyncStateAdmin(admin.ModelAdmin):
+    list_display = ('lesson', 'user', 'operation', 'attempts', 'next_retry_at', 'synced_at')
+    list_filter = ('operation',)
+    search_fields = ('user__username', 'last_error')
+    raw_id_fields = ('lesson', 'user')
+
+
+@admin.register(PackBooking)
+class PackBookingAdmin(admin.ModelAdmin):
+    list_display = ('idempotency_key', 'user', 'created_at')
+    search_fields = ('idempotency_key', 'user__username')
+    raw_id_fields = ('user',)
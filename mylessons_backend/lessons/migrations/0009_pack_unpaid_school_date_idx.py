@@ -0,0 +1,22 @@
+# Generated by Django 5.1.5 on 2026-10-19 15:08
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lessons', '0008_lesson_old_id_str_pack_old_id_str'),
+        ('schools', '0005_alter_review_options_remove_review_date_and_more'),
+        ('sports', '0001_initial'),
+        ('users', '0015_remove_useraccount_balance_history'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='pack',
+            index=models.Index(condition=models.Q(('debt__gt', 0)), fields=['school', 'date'], name='pack_unpaid_school_date_idx'),
+        ),
+    ]
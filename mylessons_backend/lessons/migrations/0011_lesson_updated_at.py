@@ -0,0 +1,18 @@
+# Generated by Django 5.1.5 on 2026-10-19 15:28
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('lessons', '0010_calendarsyncstate'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='lesson',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True),
+        ),
+    ]
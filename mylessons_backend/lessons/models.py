@@ -1,5 +1,6 @@
 from datetime import time, timedelta, datetime
 from decimal import Decimal
+from django.core.serializers.json import DjangoJSONEncoder
 from django.db import models
 from events.models import Activity
 from notifications.models import Notification
@@ -8,6 +9,7 @@ from users.utils import get_users_name, get_students_ids, get_instructors_name,
 from django.db.models import Q
 from django.utils.timezone import now, make_aware
 from payments.models import Payment
+from schools.pricing import quote_lessons
 
 # TODO not here but everywhere make_aware problem (convert to datetime and then make the operation with now())
 
@@ -32,6 +34,12 @@ class Pack(models.Model):
     school = models.ForeignKey('schools.School', on_delete=models.CASCADE, related_name='packs', blank=True, null=True)
     sport = models.ForeignKey('sports.Sport', related_name='packs', on_delete=models.SET_NULL, blank=True, null=True)
 
+    class Meta:
+        indexes = [
+            # only packs that still owe money are ever looked up by debt
+            models.Index(fields=['school', 'date'], condition=models.Q(debt__gt=0), name='pack_unpaid_school_date_idx'),
+        ]
+
     def __str__(self):
         return f"{self.type} pack for {self.get_students_name()}, {self.number_of_classes_left}/{self.number_of_classes} lessons left, {self.get_number_of_unscheduled_lessons()} number of unscheduled lessons"
     
@@ -112,13 +120,7 @@ class Pack(models.Model):
         """
         Books a new private pack, creates the necessary associations, and sends notifications.
         """
-        parents = []
-
-        for student in students:
-            for parent in student.parents.all():
-                parents.append(parent)
-
-        parents = list(set(parents))
+        parents = list(UserAccount.objects.filter(students__in=students).distinct())
 
         if not date:
             date = now().date()
@@ -140,10 +142,8 @@ class Pack(models.Model):
         pack.students.set(students)
         pack.parents.set(parents)
         if school:
-            for parent in parents:
-                school.parents.add(parent)
-            for student in students:
-                school.students.add(student)
+            school.parents.add(*parents)
+            school.students.add(*students)
         pack.instructors.set(instructors)
 
         if type == "private":
@@ -153,65 +153,37 @@ class Pack(models.Model):
         if payment:
             pack.update_debt(payment=payment)
         
+        context = dict(
+            students=get_users_name(students),
+            number_of_classes=number_of_classes,
+            duration_minutes=duration_in_minutes,
+            start_date=date,
+            total_price=price,
+            currency=school.currency,
+            school_name=school.name,
+        )
+        instructors_name = get_instructors_name(instructors) if instructors else None
+
         # Notify parents
-        for parent in parents:
-            Notification.create_notification(
-                user=parent,
-                subject=school.get_notification_template(f"{type}_pack_purchased_subject_parent").format(
-                    students=get_users_name(students),
-                ),
-                message=school.get_notification_template(f"{type}_pack_purchased_message_parent").format(
-                    parent_name=parent.first_name,
-                    students=get_users_name(students),
-                    number_of_classes=number_of_classes,
-                    duration_minutes=duration_in_minutes,
-                    instructor_name=f"{get_instructors_name(instructors)}" if instructors else "Not Assigned yet",
-                    start_date=date,
-                    total_price=price,
-                    currency=school.currency,
-                    school_name=school.name
-                ),
-                packs=[pack],
-                school=school,
-                type="Parent",
-            )
+        Notification.fan_out(
+            parents, f"{type}_pack_purchased", {**context, "instructor_name": instructors_name or "Not Assigned yet"},
+            school=school, type="Parent", packs=[pack],
+            recipient_context=lambda parent: {"parent_name": parent.first_name},
+        )
 
         # Notify instructors
         if instructors:
-            for instructor in instructors:
-                Notification.create_notification(
-                    user=instructor.user,
-                    subject=school.get_notification_template(f"{type}_pack_purchased_subject_instructor"),
-                    message=school.get_notification_template(f"{type}_pack_purchased_message_instructor").format(
-                        instructor_name=f"{instructor.user.first_name} {instructor.user.last_name}",
-                        students=get_users_name(students),
-                        number_of_classes=number_of_classes,
-                        duration_minutes=duration_in_minutes,
-                        start_date=date
-                    ),
-                    packs=[pack],
-                    school=school,
-                    type="Instructor",
-                )
+            Notification.fan_out(
+                [instructor.user for instructor in instructors], f"{type}_pack_purchased", context,
+                school=school, type="Instructor", packs=[pack],
+                recipient_context=lambda user: {"instructor_name": f"{user.first_name} {user.last_name}"},
+            )
 
         # Notify school admin
-        for admin in school.admins.all():
-            Notification.create_notification(
-                user=admin,
-                subject=school.get_notification_template(f"{type}_pack_purchased_subject_admin"),
-                message=school.get_notification_template(f"{type}_pack_purchased_message_admin").format(
-                    students=get_users_name(students),
-                    number_of_classes=number_of_classes,
-                    duration_minutes=duration_in_minutes,
-                    instructor_name=f"{get_instructors_name(instructors)}" if instructors else "Not Assigned",
-                    start_date=date,
-                    total_price=price,
-                    currency=school.currency
-                ),
-                packs=[pack],
-                school=school,
-                type="Admin",
-            )
+        Notification.fan_out(
+            school.admins.all(), f"{type}_pack_purchased", {**context, "instructor_name": instructors_name or "Not Assigned"},
+            school=school, type="Admin", packs=[pack],
+        )
         
         if discount_id and pack:
             discount = Discount.objects.filter(id=discount_id)
@@ -220,8 +192,13 @@ class Pack(models.Model):
         return pack
     
     def create_private_classes(self, location=None):
-        for i in range(self.number_of_classes):
-            private_class = Lesson.objects.create(
+        """
+        Creates the pack's lessons with one insert, then links them to the
+        pack's students, instructors and to the pack with one insert per
+        through table, so the queries don't grow with the number of classes.
+        """
+        lessons = Lesson.objects.bulk_create([
+            Lesson(
                 class_number=i + 1,
                 price=self.price / self.number_of_classes,
                 duration_in_minutes=self.duration_in_minutes,
@@ -230,10 +207,25 @@ class Pack(models.Model):
                 sport=self.sport,
                 location=location,  # set location for the lesson
             )
-            private_class.students.set(self.students.all())
-            private_class.instructors.set(self.instructors.all())
-            self.lessons_many.add(private_class)
-        self.save()
+            for i in range(self.number_of_classes)
+        ])
+        student_ids = list(self.students.values_list('pk', flat=True))
+        instructor_ids = list(self.instructors.values_list('pk', flat=True))
+        LessonStudent = Lesson.students.through
+        LessonInstructor = Lesson.instructors.through
+        LessonPack = Lesson.packs.through
+        LessonStudent.objects.bulk_create(
+            [LessonStudent(lesson_id=lesson.pk, student_id=student_id) for lesson in lessons for student_id in student_ids]
+        )
+        LessonInstructor.objects.bulk_create(
+            [LessonInstructor(lesson_id=lesson.pk, instructor_id=instructor_id) for lesson in lessons for instructor_id in instructor_ids]
+        )
+        LessonPack.objects.bulk_create([LessonPack(lesson_id=lesson.pk, pack_id=self.pk) for lesson in lessons])
+        if self.school_id:
+            # bulk_create sends no post_save
+            from payments.utils import invalidate_revenue_forecast
+            invalidate_revenue_forecast(self.school_id)
+        return lessons
 
     def update_debt(self, payment):
         self.debt -= payment
@@ -295,6 +287,7 @@ class Lesson(models.Model):
     calendar_event_ids = models.JSONField(default=dict, blank=True)
     needs_calendar_sync = models.BooleanField(default=True)
     last_calendar_sync = models.DateTimeField(null=True, blank=True)
+    updated_at = models.DateTimeField(auto_now=True)
 
     def __str__(self):
         if self.date and self.start_time:
@@ -392,22 +385,24 @@ class Lesson(models.Model):
 
     def get_fixed_price(self, instructor):
         """
-        Searches the instructor's fixed pricing list for a configuration matching:
+        Looks up the instructor's fixed pricing for a configuration matching:
          - self.duration_in_minutes equals configuration["duration"]
          - total student count (students + extra) is between configuration["min_students"] and configuration["max_students"] (inclusive)
          
         Returns the price if a match is found; otherwise, returns None.
         """
-        total_students = self.students.count() # TODO (might be a problem if they dont show up) + (self.number_of_extra_students or 0)
-        try:
-            pricing_list = instructor.user.payment_types[self.school.name]["instructor"][f"{self.type}"]["fixed"]
-        except (KeyError, TypeError):
+        if not self.school:
             return None
-        for pricing in pricing_list:
-            if (self.duration_in_minutes == pricing.get("duration") and 
-                pricing.get("min_students") <= total_students <= pricing.get("max_students")):
-                return pricing.get("price")
-        return None
+        total_students = self.students.count() # TODO (might be a problem if they dont show up) + (self.number_of_extra_students or 0)
+        rules = self.school.get_pay_rules(instructor.user)
+        return rules.fixed_price(self.type, self.duration_in_minutes, total_students)
+
+    def get_instructors_pay(self):
+        """
+        The fixed price plus commission earned by each instructor for this
+        lesson, as {instructor pk: Decimal}.
+        """
+        return {instructor_id: amount for (_, instructor_id), amount in quote_lessons([self]).items()}
     
     def mark_as_given(self):
         if self.is_done:
@@ -421,18 +416,9 @@ class Lesson(models.Model):
             pack_instance.save(update_fields=["number_of_classes_left"])
             pack_instance.update_pack_status()
             
+        pay = self.get_instructors_pay()
         for instructor in self.instructors.all():
-            fixed_price = self.get_fixed_price(instructor=instructor) or 0
-
-            try:
-                commission = instructor.user.payment_types[self.school.name]["instructor"][f"{self.type}"]["commission"]
-            except (KeyError, TypeError):
-                commission = 0
-
-            commission_fee = self.price * Decimal(commission) / Decimal(100) if commission else Decimal(0)
-            amount_to_add = Decimal(fixed_price) + commission_fee
-            
-            instructor.user.update_balance(amount=amount_to_add, message=str(self))
+            instructor.user.update_balance(amount=pay.get(instructor.pk, Decimal(0)), message=str(self), school=self.school)
         return True
     
     def mark_as_not_given(self):
@@ -447,18 +433,9 @@ class Lesson(models.Model):
             pack_instance.save(update_fields=["number_of_classes_left"])
             pack_instance.update_pack_status()
 
+        pay = self.get_instructors_pay()
         for instructor in self.instructors.all():
-
-            fixed_price = self.get_fixed_price(instructor=instructor) or 0
-            try:
-                commission = instructor.user.payment_types[self.school.name]["instructor"][f"{self.type}"]["commission"]
-            except (KeyError, TypeError):
-                commission = 0
-
-            commission_fee = self.price * Decimal(commission) / Decimal(100) if commission else Decimal(0)
-            amount_to_add = Decimal(fixed_price) + commission_fee
-            
-            instructor.user.update_balance(amount=-amount_to_add, message=str(self))
+            instructor.user.update_balance(amount=-pay.get(instructor.pk, Decimal(0)), message=str(self), school=self.school)
         return True
     
     def is_full(self):
@@ -498,7 +475,8 @@ class Lesson(models.Model):
                 ...
             }
         
-        It then uses the school's extra_prices (a dict mapping names to unit prices) to compute:
+        It then uses the school's extra_prices (a dict mapping names to unit prices, from
+        the school's compiled PriceTable) to compute:
         - For each student, the extra cost for extra students: extra_student_count * extra_prices["extra_students"].
         - For each equipment entry, the cost as unit_price from extra_prices based on the equipment name.
         
@@ -523,45 +501,11 @@ class Lesson(models.Model):
         if not self.school:
             return {}
         
-        extra_prices = self.school.extra_prices or {}
         # If extras is not set, assume no extra costs.
         if not self.extras:
             return {}
         
-        result = {"students": {}, "grand_total": 0}
-        
-        # Iterate over each student_id in the extras dict.
-        for student_id, extras_info in self.extras.items():
-            student_detail = {}
-            total_for_student = 0
-            
-            # Calculate extra student costs.
-            extra_count = extras_info.get("extra_student_count", 0)
-            if extra_count:
-                # Get unit price; default is 10 if not set.
-                price_per_student = extra_prices.get("extra_students", 10)
-                student_detail["extra_students"] = f"{extra_count}x{price_per_student}"
-                total_for_student += extra_count * price_per_student
-            
-            # Calculate equipment costs.
-            equip_details = {}
-            equipments = extras_info.get("equipments", {})
-            for equip_key, equip_data in equipments.items():
-                equip_name = equip_data.get("name")
-                if not equip_name:
-                    continue
-                unit_price = extra_prices.get(equip_name, 0)
-                # Here we assume count=1 per equipment item; extend as needed.
-                equip_details[equip_name] = f"1x{unit_price}"
-                total_for_student += unit_price
-            if equip_details:
-                student_detail["equipments"] = equip_details
-            
-            student_detail["total"] = total_for_student
-            result["students"][student_id] = student_detail
-            result["grand_total"] += total_for_student
-
-        return result
+        return self.school.get_price_table().extra_costs(self.extras)
 
     def add_student(self, student):
         """
@@ -769,3 +713,59 @@ class Voucher(models.Model):
     def is_expired(self):
         """Check if the voucher is expired."""
         return now().date() > self.expiration_date
+
+
+class CalendarSyncState(models.Model):
+    """
+    Sync journal of one lesson in one participant's Google Calendar: what was
+    last sent (content_hash) and, for failed calls, when to retry.
+    """
+    INSERT = "insert"
+    PATCH = "patch"
+    DELETE = "delete"
+    OPERATION_CHOICES = [
+        (INSERT, "Insert"),
+        (PATCH, "Patch"),
+        (DELETE, "Delete"),
+    ]
+
+    lesson = models.ForeignKey(Lesson, on_delete=models.CASCADE, related_name="calendar_sync_states")
+    user = models.ForeignKey(UserAccount, on_delete=models.CASCADE, related_name="calendar_sync_states")
+    operation = models.CharField(max_length=10, choices=OPERATION_CHOICES)
+    content_hash = models.CharField(max_length=64, blank=True)  # hash of the last event body Google accepted
+    attempts = models.PositiveIntegerField(default=0)  # consecutive failed attempts
+    last_error = models.TextField(blank=True, null=True)
+    next_retry_at = models.DateTimeField(blank=True, null=True)
+    synced_at = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["lesson", "user"], name="unique_calendar_sync_state"),
+        ]
+        indexes = [
+            models.Index(fields=["next_retry_at"]),
+        ]
+
+    def __str__(self):
+        status = f"failed {self.attempts}x" if self.last_error else "synced"
+        return f"{self.operation} lesson {self.lesson_id} for user {self.user_id} ({status})"
+
+
+class PackBooking(models.Model):
+    """
+    Response of a book_pack request sent with an idempotency key. A retried
+    request with the same key gets the stored response instead of booking
+    the packs again.
+    """
+    user = models.ForeignKey(UserAccount, on_delete=models.CASCADE, related_name="pack_bookings")
+    idempotency_key = models.CharField(max_length=255)
+    response = models.JSONField(default=dict, encoder=DjangoJSONEncoder)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["user", "idempotency_key"], name="unique_pack_booking_key"),
+        ]
+
+    def __str__(self):
+        return f"Booking {self.idempotency_key} by {self.user}"
@@ -1,8 +1,22 @@
+import json
+import threading
+from email.parser import BytesParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+import httplib2
+from decimal import Decimal
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 from django.test import TestCase
+from django.urls import reverse
+from rest_framework.test import APIClient
+from googleapiclient.discovery import build
 from django.utils.timezone import now
 from datetime import timedelta, time, datetime, date
 from equipment.models import Equipment
-from lessons.models import Pack, Lesson, Voucher
+from lessons.models import CalendarSyncState, Pack, Lesson, Voucher
+from lessons.utils import CalendarSyncEngine
 from notifications.models import Notification
 from users.models import Student, UserAccount, Instructor, Unavailability
 from schools.models import School
@@ -396,6 +410,30 @@ class PrivatePackTests(TestCase):
         pack.update_pack_status()
         self.assertTrue(pack.is_done)
 
+    def test_create_private_classes_takes_fixed_queries(self):
+        other_student = Student.objects.create(first_name="Bob", last_name="Smith")
+
+        def create(number_of_classes):
+            pack = Pack.objects.create(
+                school=self.school, date=now().date(), number_of_classes=number_of_classes,
+                number_of_classes_left=number_of_classes, duration_in_minutes=60, price=Decimal("200.00"),
+            )
+            pack.students.set([self.student, other_student])
+            pack.instructors.set([self.instructor])
+            with CaptureQueriesContext(connection) as context:
+                lessons = pack.create_private_classes()
+            return pack, lessons, len(context)
+
+        _, _, five_classes = create(5)
+        pack, lessons, twenty_classes = create(20)
+
+        self.assertEqual(five_classes, twenty_classes)
+        self.assertEqual([lesson.class_number for lesson in lessons], list(range(1, 21)))
+        self.assertEqual(pack.lessons_many.count(), 20)
+        self.assertEqual(Lesson.students.through.objects.filter(lesson__packs=pack).count(), 40)
+        self.assertEqual(self.instructor.lessons.filter(packs=pack).count(), 20)
+        self.assertEqual(lessons[0].price, Decimal("10.00"))
+
 class VoucherTests(TestCase):
     def setUp(self):
         self.user = UserAccount.objects.create(username="guardian")
@@ -419,3 +457,230 @@ class VoucherTests(TestCase):
         self.assertFalse(self.voucher.is_expired())
         self.voucher.expiration_date = now().date() - timedelta(days=1)
         self.assertTrue(self.voucher.is_expired())
+
+
+class FakeCalendarServer:
+    """
+    A local stand-in for the Google Calendar API that answers batch requests
+    (multipart/mixed) for event insert, patch and delete.
+    """
+
+    def __init__(self):
+        self.events = {}  # event id -> body
+        self.batches = []  # number of calls in every batch received
+        self.fail_event_ids = set()
+        self._lock = threading.Lock()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers['Content-Length']))
+                message = BytesParser().parsebytes(
+                    f"Content-Type: {self.headers['Content-Type']}\r\n\r\n".encode() + body
+                )
+                parts = []
+                for part in message.get_payload():
+                    request_line, _, rest = part.get_payload().partition("\n")
+                    method, path, _ = request_line.split(" ", 2)
+                    payload = rest.split("\n\n", 1)[1] if "\n\n" in rest else ""
+                    status, response = server.handle(method, urlparse(path).path, payload)
+                    content_id = part["Content-ID"].strip("<>").replace(" + ", "+").split("+", 1)[1]
+                    parts.append(
+                        "--fake\r\nContent-Type: application/http\r\n"
+                        f"Content-ID: <response-fake + {content_id}>\r\n\r\n"
+                        f"HTTP/1.1 {status} OK\r\nContent-Type: application/json\r\n\r\n{json.dumps(response)}\r\n"
+                    )
+                with server._lock:
+                    server.batches.append(len(parts))
+                reply = ("".join(parts) + "--fake--").encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "multipart/mixed; boundary=fake")
+                self.send_header("Content-Length", str(len(reply)))
+                self.end_headers()
+                self.wfile.write(reply)
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.httpd.server_port}/"
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def handle(self, method, path, payload):
+        with self._lock:
+            event_id = path.rsplit("/events", 1)[1].strip("/")
+            if event_id in self.fail_event_ids:
+                return 500, {"error": {"code": 500, "message": "backend error"}}
+            if method == "POST":
+                event_id = f"evt{len(self.events) + 1}"
+                self.events[event_id] = json.loads(payload)
+                return 200, {"id": event_id}
+            if event_id not in self.events:
+                return 404, {"error": {"code": 404, "message": "Not Found"}}
+            if method == "PATCH":
+                self.events[event_id].update(json.loads(payload))
+                return 200, {"id": event_id}
+            del self.events[event_id]
+            return 200, {}
+
+    def service(self, user):
+        return build("calendar", "v3", http=httplib2.Http(), static_discovery=True, cache_discovery=False, client_options={"api_endpoint": self.url})
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class CalendarSyncEngineTests(TestCase):
+    def setUp(self):
+        self.server = FakeCalendarServer()
+        self.addCleanup(self.server.close)
+        self.instructor_user = UserAccount.objects.create(username="instructor", first_name="John", calendar_token="token")
+        self.instructor = Instructor.objects.create(user=self.instructor_user)
+        self.parent = UserAccount.objects.create(username="parent", calendar_token="token")
+        self.no_calendar = UserAccount.objects.create(username="no_calendar")
+        self.student = Student.objects.create(level=1, birthday=date(2015, 1, 1), first_name="Alice", last_name="Smith")
+        self.student.parents.set([self.parent, self.no_calendar])
+        self.lessons = []
+        for day in range(1, 61):
+            lesson = Lesson.objects.create(
+                date=date(2025, 1, 1) + timedelta(days=day), start_time=time(10, 0), end_time=time(11, 0), duration_in_minutes=60,
+            )
+            lesson.students.set([self.student])
+            lesson.instructors.set([self.instructor])
+            self.lessons.append(lesson)
+        self.built_for = []
+
+    def engine(self):
+        def factory(user):
+            self.built_for.append(user.pk)
+            return self.server.service(user)
+        return CalendarSyncEngine(service_factory=factory, workers=4, batch_uri=f"{self.server.url}batch/calendar/v3")
+
+    def test_lessons_are_synced_in_batches_per_user(self):
+        self.assertEqual(self.engine().sync(), (60, 0))
+
+        self.assertEqual(sorted(self.built_for), sorted([self.instructor_user.pk, self.parent.pk]))
+        self.assertEqual(sorted(self.server.batches), [10, 10, 50, 50])
+        self.assertEqual(len(self.server.events), 120)
+        lesson = Lesson.objects.get(pk=self.lessons[0].pk)
+        self.assertFalse(lesson.needs_calendar_sync)
+        self.assertEqual(set(lesson.calendar_event_ids), {str(self.instructor_user.pk), str(self.parent.pk)})
+        self.assertEqual(self.server.events[lesson.get_event_id(self.parent)]["start"]["dateTime"], "2025-01-02T10:00:00")
+
+    def test_changes_patch_unscheduled_delete_and_failures_stay_pending(self):
+        lesson = self.lessons[0]
+        self.engine().sync([lesson])
+        lesson.refresh_from_db()
+        parent_event = lesson.get_event_id(self.parent)
+        instructor_event = lesson.get_event_id(self.instructor_user)
+
+        lesson.start_time, lesson.end_time = time(12, 0), time(13, 0)
+        lesson.needs_calendar_sync = True
+        lesson.save()
+        self.server.fail_event_ids.add(instructor_event)
+        self.assertEqual(self.engine().sync([lesson]), (0, 1))
+        lesson.refresh_from_db()
+        self.assertTrue(lesson.needs_calendar_sync)
+        self.assertEqual(self.server.events[parent_event]["start"]["dateTime"], "2025-01-02T12:00:00")
+        self.assertEqual(lesson.get_event_id(self.instructor_user), instructor_event)
+
+        self.server.fail_event_ids.clear()
+        CalendarSyncState.objects.update(next_retry_at=None)
+        lesson.unschedule_lesson()
+        self.assertEqual(self.engine().sync([lesson]), (1, 0))
+        lesson.refresh_from_db()
+        self.assertEqual(lesson.calendar_event_ids, {})
+        self.assertNotIn(parent_event, self.server.events)
+        self.assertNotIn(instructor_event, self.server.events)
+
+    def test_unchanged_lessons_are_skipped_and_only_failed_pairs_retried(self):
+        lesson = self.lessons[0]
+        Lesson.objects.exclude(pk=lesson.pk).update(needs_calendar_sync=False)
+        self.engine().sync()
+        self.assertEqual(CalendarSyncState.objects.filter(lesson=lesson, last_error=None).count(), 2)
+
+        Lesson.objects.filter(pk=lesson.pk).update(needs_calendar_sync=True)
+        self.assertEqual(self.engine().sync(), (1, 0))
+        self.assertEqual(len(self.server.batches), 2)  # no calls for the unchanged lesson
+
+        lesson.refresh_from_db()
+        instructor_event = lesson.get_event_id(self.instructor_user)
+        self.server.fail_event_ids.add(instructor_event)
+        lesson.start_time, lesson.end_time = time(12, 0), time(13, 0)
+        lesson.needs_calendar_sync = True
+        lesson.save()
+        self.assertEqual(self.engine().sync(), (0, 1))
+        failed = CalendarSyncState.objects.get(lesson=lesson, user=self.instructor_user)
+        self.assertEqual((failed.operation, failed.attempts), (CalendarSyncState.PATCH, 1))
+        self.assertIn("backend error", failed.last_error)
+        self.assertGreater(failed.next_retry_at, now())
+        self.assertIsNone(CalendarSyncState.objects.get(lesson=lesson, user=self.parent).last_error)
+
+        # still backing off: nothing is sent
+        batches = len(self.server.batches)
+        self.assertEqual(self.engine().sync(), (0, 1))
+        self.assertEqual(len(self.server.batches), batches)
+        self.assertEqual(CalendarSyncState.objects.get(pk=failed.pk).attempts, 1)
+
+        self.server.fail_event_ids.clear()
+        CalendarSyncState.objects.filter(pk=failed.pk).update(next_retry_at=now() - timedelta(seconds=1))
+        self.assertEqual(self.engine().sync(), (1, 0))
+        self.assertEqual(self.server.batches[-1], 1)  # only the instructor's event is retried
+        retried = CalendarSyncState.objects.get(pk=failed.pk)
+        self.assertEqual((retried.attempts, retried.last_error, retried.next_retry_at), (0, None, None))
+        self.assertEqual(self.server.events[instructor_event]["start"]["dateTime"], "2025-01-02T12:00:00")
+
+
+class ICSFeedTests(TestCase):
+    def setUp(self):
+        self.parent = UserAccount.objects.create(username="parent")
+        self.other = UserAccount.objects.create(username="other")
+        self.student = Student.objects.create(level=1, birthday=date(2015, 1, 1), first_name="Alice", last_name="Smith")
+        self.student.parents.set([self.parent])
+        self.lesson = Lesson.objects.create(
+            date=now().date() + timedelta(days=1), start_time=time(10, 0), end_time=time(11, 0), duration_in_minutes=60,
+        )
+        self.lesson.students.set([self.student])
+        self.activity = Activity.objects.create(
+            name="Beach, cleanup", date=now().date() + timedelta(days=2), start_time=time(9, 0), duration_in_minutes=90,
+        )
+        self.activity.students.set([self.student])
+        other_lesson = Lesson.objects.create(date=now().date(), start_time=time(8, 0), duration_in_minutes=60)
+        other_lesson.instructors.set([Instructor.objects.create(user=self.other)])
+
+        client = APIClient()
+        client.force_authenticate(self.parent)
+        self.url = client.get(reverse("ics_feed_url")).json()["url"]
+
+    def test_feed_streams_the_users_events(self):
+        response = self.client.get(self.url)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        self.assertEqual(response["Content-Type"], "text/calendar; charset=utf-8")
+        body = b"".join(response.streaming_content).decode()
+        self.assertTrue(body.startswith("BEGIN:VCALENDAR\r\n"))
+        self.assertIn(f"UID:lesson-{self.lesson.pk}@mylessons", body)
+        self.assertIn(f"DTSTART;TZID=Europe/Lisbon:{self.lesson.date:%Y%m%d}T100000", body)
+        self.assertIn("SUMMARY:Alice Smith  Lesson", body)
+        self.assertIn("SUMMARY:Beach\\, cleanup", body)
+        self.assertIn(f"DTEND;TZID=Europe/Lisbon:{self.activity.date:%Y%m%d}T103000", body)
+        self.assertEqual(body.count("BEGIN:VEVENT"), 2)
+
+    def test_conditional_requests_and_invalidation(self):
+        first = self.client.get(self.url)
+        self.assertIn("Last-Modified", first)
+
+        with self.assertNumQueries(3):
+            cached = self.client.get(self.url, HTTP_IF_NONE_MATCH=first["ETag"])
+        self.assertEqual(cached.status_code, 304)
+
+        self.lesson.start_time = time(12, 0)
+        self.lesson.save()
+        changed = self.client.get(self.url, HTTP_IF_NONE_MATCH=first["ETag"])
+        self.assertEqual(changed.status_code, 200)
+        self.assertNotEqual(changed["ETag"], first["ETag"])
+
+    def test_tampered_token_is_rejected(self):
+        self.assertEqual(self.client.get(self.url.replace(f"/ics/{self.parent.pk}:", f"/ics/{self.other.pk}:")).status_code, 404)
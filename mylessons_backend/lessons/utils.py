@@ -0,0 +1,406 @@
+import datetime
+import hashlib
+import json
+import logging
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core import signing
+from django.db import connection, transaction
+from django.db.models import Count, Max, Q, prefetch_related_objects
+from django.utils import timezone
+from googleapiclient.errors import HttpError
+from googleapiclient.http import BatchHttpRequest
+
+from lessons.models import CalendarSyncState, Lesson
+
+logger = logging.getLogger(__name__)
+
+CALENDAR_BATCH_LIMIT = 50  # Google rejects batches with more than 50 calls
+CALENDAR_SYNC_WORKERS = 8
+CALENDAR_TIMEZONE = 'Europe/Lisbon'
+CALENDAR_RETRY_BASE_DELAY = datetime.timedelta(minutes=1)  # doubled after every failed attempt
+CALENDAR_RETRY_MAX_DELAY = datetime.timedelta(hours=6)
+
+
+def lesson_participants(lesson):
+    """Users whose calendar shows the lesson: instructors, monitors and the students' parents."""
+    instructors = {inst.user for inst in lesson.instructors.all()}
+    monitors = {mon.user for mon in lesson.monitors.all()}
+    parents = {parent for student in lesson.students.all() for parent in student.parents.all()}
+    return instructors | monitors | parents
+
+
+def lesson_event_body(lesson):
+    """The Google Calendar event for a scheduled lesson."""
+    start_dt = datetime.datetime.combine(lesson.date, lesson.start_time)
+    if lesson.end_time:
+        end_dt = datetime.datetime.combine(lesson.date, lesson.end_time)
+    else:
+        end_dt = start_dt + datetime.timedelta(minutes=lesson.duration_in_minutes)
+
+    location = None
+    if lesson.location:
+        addr = getattr(lesson.location, 'address', None)
+        location = lesson.location.name + (f", {addr}" if addr else "")
+
+    subject = lesson.sport.name if lesson.sport else ""
+    return {
+        'summary': f'{lesson.get_students_name()} {subject} Lesson',
+        'location': location,
+        'start': {'dateTime': start_dt.isoformat(), 'timeZone': CALENDAR_TIMEZONE},
+        'end': {'dateTime': end_dt.isoformat(), 'timeZone': CALENDAR_TIMEZONE},
+        'reminders': {
+            'useDefault': False,
+            'overrides': [
+                {'method': 'popup', 'minutes': 24 * 60},
+                {'method': 'popup', 'minutes': 60},
+                {'method': 'popup', 'minutes': 10},
+            ],
+        },
+    }
+
+
+def event_content_hash(body):
+    """Digest of an event body, to tell whether a lesson changed since its last sync."""
+    return hashlib.sha256(json.dumps(body, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+def calendar_retry_delay(attempts):
+    return min(CALENDAR_RETRY_BASE_DELAY * 2 ** (attempts - 1), CALENDAR_RETRY_MAX_DELAY)
+
+
+CalendarOperation = namedtuple('CalendarOperation', 'lesson op event_id body content_hash')
+
+
+class CalendarSyncEngine:
+    """
+    Pushes lessons flagged with needs_calendar_sync to their participants'
+    Google Calendars. Lessons are grouped by user so every user's service is
+    built once, each user's changes go out as batch requests of up to
+    CALENDAR_BATCH_LIMIT calls and users are synced concurrently on a bounded
+    thread pool.
+
+    Every (lesson, user) pair has a CalendarSyncState journal row. Pairs whose
+    event already has the same content are skipped, and failed pairs are
+    retried on their own with exponential backoff. A lesson stays flagged
+    until all of its pairs are synced.
+
+    service_factory(user) returns the Calendar service of a user (defaults to
+    users.utils.get_calendar_service). batch_uri overrides the batch endpoint
+    from the discovery document, which is how tests point it at a local server.
+    """
+
+    PREFETCH = ('instructors__user', 'monitors__user', 'students__parents')
+
+    def __init__(self, service_factory=None, workers=CALENDAR_SYNC_WORKERS, batch_size=CALENDAR_BATCH_LIMIT, batch_uri=None):
+        if service_factory is None:
+            from users.utils import get_calendar_service
+            service_factory = get_calendar_service
+        self.service_factory = service_factory
+        self.workers = workers
+        self.batch_size = min(batch_size, CALENDAR_BATCH_LIMIT)
+        self.batch_uri = batch_uri
+
+    def pending_lessons(self):
+        return (
+            Lesson.objects.filter(needs_calendar_sync=True)
+            .select_related('sport', 'location')
+            .prefetch_related(*self.PREFETCH)
+        )
+
+    def plan(self, lessons, states, current_time):
+        """
+        Groups the calendar operations by user. Returns ({user_id: (user, ops)},
+        deferred lesson ids): ops are CalendarOperations and deferred lessons
+        have a pair still waiting for its retry. states maps (lesson id,
+        user id) to CalendarSyncState. Participants that were removed from a
+        lesson get its event deleted. Event bodies are built here, so the
+        worker threads never query the database.
+        """
+        plan = {}
+        deferred = set()
+
+        def add(user, lesson, op, event_id, body):
+            content_hash = event_content_hash(body) if body else ''
+            state = states.get((lesson.pk, user.pk))
+            if state is not None:
+                if state.next_retry_at and state.next_retry_at > current_time:
+                    deferred.add(lesson.pk)
+                    return
+                if op == CalendarSyncState.PATCH and not state.last_error and state.content_hash == content_hash:
+                    return
+            plan.setdefault(user.pk, (user, []))[1].append(CalendarOperation(lesson, op, event_id, body, content_hash))
+
+        removed = []
+        for lesson in lessons:
+            participants = {user.pk: user for user in lesson_participants(lesson)}
+            body = lesson_event_body(lesson) if lesson.date and lesson.start_time else None
+            for user_id, user in participants.items():
+                if not user.calendar_token:
+                    continue
+                event_id = lesson.calendar_event_ids.get(str(user_id))
+                if body:
+                    add(user, lesson, CalendarSyncState.PATCH if event_id else CalendarSyncState.INSERT, event_id, body)
+                elif event_id:
+                    add(user, lesson, CalendarSyncState.DELETE, event_id, None)
+            removed.extend(
+                (int(uid), lesson, event_id) for uid, event_id in lesson.calendar_event_ids.items()
+                if event_id and int(uid) not in participants
+            )
+
+        if removed:
+            from users.models import UserAccount
+            users = UserAccount.objects.exclude(calendar_token__isnull=True).exclude(calendar_token='').in_bulk({uid for uid, _, _ in removed})
+            for user_id, lesson, event_id in removed:
+                if user_id in users:
+                    add(users[user_id], lesson, CalendarSyncState.DELETE, event_id, None)
+        return plan, deferred
+
+    def sync(self, lessons=None):
+        """
+        Syncs the given lessons (all pending ones by default), saves the new
+        event ids and journals every call. Returns (synced, pending) lesson
+        counts; pending lessons have a pair that failed or waits for a retry.
+        """
+        if lessons is None:
+            lessons = list(self.pending_lessons())
+        else:
+            lessons = list(lessons)
+            prefetch_related_objects(lessons, 'sport', 'location', *self.PREFETCH)
+        if not lessons:
+            return 0, 0
+        current_time = timezone.now()
+        states = {
+            (state.lesson_id, state.user_id): state
+            for state in CalendarSyncState.objects.filter(lesson_id__in=[lesson.pk for lesson in lessons])
+        }
+        plan, pending = self.plan(lessons, states, current_time)
+
+        results = {}
+        if plan:
+            with ThreadPoolExecutor(max_workers=max(1, min(self.workers, len(plan)))) as executor:
+                for user_id, outcome in zip(plan, executor.map(lambda item: self._sync_user(*item), plan.values())):
+                    results[user_id] = outcome
+
+        journal = []
+        for user_id, (user, ops) in plan.items():
+            for operation in ops:
+                lesson = operation.lesson
+                event_id, error = results[user_id][lesson]
+                if event_id:
+                    lesson.calendar_event_ids[str(user_id)] = event_id
+                else:
+                    lesson.calendar_event_ids.pop(str(user_id), None)
+
+                if error is None:
+                    journal.append(CalendarSyncState(
+                        lesson=lesson, user_id=user_id, operation=operation.op, content_hash=operation.content_hash,
+                        attempts=0, last_error=None, next_retry_at=None, synced_at=current_time,
+                    ))
+                    continue
+                pending.add(lesson.pk)
+                previous = states.get((lesson.pk, user_id))
+                attempts = (previous.attempts if previous else 0) + 1
+                journal.append(CalendarSyncState(
+                    lesson=lesson, user_id=user_id, operation=operation.op,
+                    content_hash=previous.content_hash if previous else '',
+                    attempts=attempts, last_error=error,
+                    next_retry_at=current_time + calendar_retry_delay(attempts),
+                    synced_at=previous.synced_at if previous else None,
+                ))
+
+        with transaction.atomic():
+            if journal:
+                CalendarSyncState.objects.bulk_create(
+                    journal, update_conflicts=True, unique_fields=['lesson', 'user'],
+                    update_fields=['operation', 'content_hash', 'attempts', 'last_error', 'next_retry_at', 'synced_at'],
+                )
+            for lesson in lessons:
+                lesson.needs_calendar_sync = lesson.pk in pending
+                if not lesson.needs_calendar_sync:
+                    lesson.last_calendar_sync = current_time
+            Lesson.objects.bulk_update(
+                lessons, ['calendar_event_ids', 'needs_calendar_sync', 'last_calendar_sync'], batch_size=500
+            )
+        return len(lessons) - len(pending), len(pending)
+
+    def _sync_user(self, user, ops):
+        """
+        Runs one user's operations on a worker thread. Returns
+        {lesson: (event_id, error)}; event_id is '' after a delete.
+        """
+        outcome = {}
+        try:
+            service = self.service_factory(user)
+            for start in range(0, len(ops), self.batch_size):
+                self._execute_batch(service, ops[start:start + self.batch_size], outcome)
+        except Exception as e:
+            logger.warning("Calendar sync failed for user %s: %s", user.pk, e)
+            for operation in ops:
+                outcome.setdefault(operation.lesson, (operation.event_id, str(e)))
+        finally:
+            # refreshing a token saves it through this thread's own connection
+            connection.close()
+        return outcome
+
+    def _execute_batch(self, service, ops, outcome):
+        by_request_id = {}
+
+        def callback(request_id, response, exception):
+            operation = by_request_id[request_id]
+            gone = isinstance(exception, HttpError) and exception.resp.status in (404, 410)
+            if exception is None:
+                event_id = '' if operation.op == CalendarSyncState.DELETE else response['id']
+                outcome[operation.lesson] = (event_id, None)
+            elif operation.op == CalendarSyncState.DELETE and gone:
+                outcome[operation.lesson] = ('', None)  # already gone
+            elif operation.op == CalendarSyncState.PATCH and gone:
+                # deleted on the user's side: forget it so the retry inserts it again
+                outcome[operation.lesson] = ('', str(exception))
+            else:
+                outcome[operation.lesson] = (operation.event_id, str(exception))
+
+        if self.batch_uri:
+            batch = BatchHttpRequest(callback=callback, batch_uri=self.batch_uri)
+        else:
+            batch = service.new_batch_http_request(callback=callback)
+        events = service.events()
+        for index, operation in enumerate(ops):
+            if operation.op == CalendarSyncState.INSERT:
+                request = events.insert(calendarId='primary', body=operation.body)
+            elif operation.op == CalendarSyncState.PATCH:
+                request = events.patch(calendarId='primary', eventId=operation.event_id, body=operation.body)
+            else:
+                request = events.delete(calendarId='primary', eventId=operation.event_id)
+            request_id = str(index)
+            by_request_id[request_id] = operation
+            batch.add(request, request_id=request_id)
+        batch.execute()
+
+
+ICS_FEED_SALT = 'lessons.ics_feed'
+ICS_FEED_PAST_DAYS = 30  # keep recent lessons in subscribed calendars for a while
+ICS_FEED_CHUNK_SIZE = 500
+
+
+def ics_feed_token(user):
+    """Signed token of a user's iCalendar feed URL."""
+    return signing.Signer(salt=ICS_FEED_SALT).sign(str(user.pk))
+
+
+def ics_feed_user_id(token):
+    """The user id signed in an ics_feed_token, or None if the signature is wrong."""
+    try:
+        return int(signing.Signer(salt=ICS_FEED_SALT).unsign(token))
+    except (signing.BadSignature, ValueError):
+        return None
+
+
+def ics_feed_querysets(user_id, today=None):
+    """Lessons and activities of the user's feed: as instructor, monitor or parent."""
+    from events.models import Activity
+    start = (today or timezone.localdate()) - datetime.timedelta(days=ICS_FEED_PAST_DAYS)
+    lessons = Lesson.objects.filter(
+        Q(instructors__user_id=user_id) | Q(monitors__user_id=user_id) | Q(students__parents__id=user_id),
+        date__gte=start, start_time__isnull=False,
+    ).distinct()
+    activities = Activity.objects.filter(
+        Q(instructors__user_id=user_id) | Q(monitors__id=user_id) | Q(students__parents__id=user_id),
+        date__gte=start,
+    ).distinct()
+    return lessons, activities
+
+
+def ics_feed_version(user_id, today=None):
+    """
+    (etag, last_modified) of a user's feed, from one aggregate query per
+    model. Count and max id change when events are added or removed,
+    updated_at when one is edited.
+    """
+    lessons, activities = ics_feed_querysets(user_id, today)
+    parts = []
+    last_modified = None
+    for queryset in (lessons, activities):
+        stats = queryset.aggregate(count=Count('id', distinct=True), max_id=Max('id'), updated=Max('updated_at'))
+        parts.append(f"{stats['count']}-{stats['max_id']}-{stats['updated'].isoformat() if stats['updated'] else ''}")
+        if stats['updated'] and (last_modified is None or stats['updated'] > last_modified):
+            last_modified = stats['updated']
+    etag = hashlib.sha256(f"{user_id}|{'|'.join(parts)}".encode('utf-8')).hexdigest()[:32]
+    return etag, last_modified
+
+
+def _ics_escape(value):
+    return (
+        str(value).replace('\\', '\\\\').replace(';', '\\;').replace(',', '\\,')
+        .replace('\r\n', '\\n').replace('\n', '\\n')
+    )
+
+
+def _ics_line(line):
+    # RFC 5545 lines are folded at 75 octets
+    encoded = line.encode('utf-8')
+    if len(encoded) <= 75:
+        return line + '\r\n'
+    chunks, current = [], b''
+    for char in line:
+        char_bytes = char.encode('utf-8')
+        if len(current) + len(char_bytes) > (75 if not chunks else 74):
+            chunks.append(current.decode('utf-8'))
+            current = b''
+        current += char_bytes
+    chunks.append(current.decode('utf-8'))
+    return '\r\n '.join(chunks) + '\r\n'
+
+
+def _ics_event(uid, stamp, start, end, summary, location=None, description=None):
+    lines = [
+        'BEGIN:VEVENT',
+        f'UID:{uid}',
+        f"DTSTAMP:{stamp.astimezone(datetime.timezone.utc).strftime('%Y%m%dT%H%M%SZ')}",
+        f"DTSTART;TZID={CALENDAR_TIMEZONE}:{start.strftime('%Y%m%dT%H%M%S')}",
+        f"DTEND;TZID={CALENDAR_TIMEZONE}:{end.strftime('%Y%m%dT%H%M%S')}",
+        f'SUMMARY:{_ics_escape(summary)}',
+    ]
+    if location:
+        lines.append(f'LOCATION:{_ics_escape(location)}')
+    if description:
+        lines.append(f'DESCRIPTION:{_ics_escape(description)}')
+    lines.append('END:VEVENT')
+    return ''.join(_ics_line(line) for line in lines)
+
+
+def iter_ics_feed(user_id, today=None):
+    """
+    Yields a user's iCalendar feed event by event, reading the lessons and
+    activities in chunks so large feeds are never built in memory. Lesson
+    events match the ones pushed to Google Calendar.
+    """
+    lessons, activities = ics_feed_querysets(user_id, today)
+    yield ''.join(_ics_line(line) for line in (
+        'BEGIN:VCALENDAR', 'VERSION:2.0', 'PRODID:-//MyLessons//Lessons//EN', 'CALSCALE:GREGORIAN',
+        'METHOD:PUBLISH', 'X-WR-CALNAME:MyLessons', f'X-WR-TIMEZONE:{CALENDAR_TIMEZONE}',
+    ))
+
+    lessons = (
+        lessons.select_related('sport', 'location').prefetch_related('students')
+        .order_by('date', 'start_time', 'id')
+    )
+    for lesson in lessons.iterator(chunk_size=ICS_FEED_CHUNK_SIZE):
+        body = lesson_event_body(lesson)
+        yield _ics_event(
+            f'lesson-{lesson.pk}@mylessons', lesson.updated_at,
+            datetime.datetime.fromisoformat(body['start']['dateTime']),
+            datetime.datetime.fromisoformat(body['end']['dateTime']),
+            body['summary'], body['location'],
+        )
+
+    for activity in activities.order_by('date', 'start_time', 'id').iterator(chunk_size=ICS_FEED_CHUNK_SIZE):
+        start = datetime.datetime.combine(activity.date, activity.start_time)
+        if activity.end_time:
+            end = datetime.datetime.combine(activity.date, activity.end_time)
+        else:
+            end = start + datetime.timedelta(minutes=activity.duration_in_minutes)
+        yield _ics_event(f'activity-{activity.pk}@mylessons', activity.updated_at, start, end, activity.name, description=activity.description)
+
+    yield _ics_line('END:VCALENDAR')
@@ -12,6 +12,12 @@ from rest_framework.decorators import api_view, permission_classes
 from rest_framework.response import Response
 from rest_framework.permissions import IsAuthenticated
 from .models import Lesson, Pack
+from .utils import ics_feed_token, ics_feed_user_id, ics_feed_version, iter_ics_feed
+from django.http import Http404, StreamingHttpResponse
+from django.urls import reverse
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
+from django.views.decorators.http import require_GET
 from django.utils.timezone import now
 from rest_framework import status
 from django.shortcuts import get_object_or_404
@@ -679,71 +685,44 @@ def schedule_private_lesson(request):
 
     if reschedule_success:
         if lesson.school:
-                # Notify parents
-                for parent in lesson.packs.all()[0].parents.all():
-                    Notification.create_notification(
-                        user=parent,
-                        subject=lesson.school.get_notification_template(f"{lesson.type}_class_scheduled_subject_parent").format(
-                            students=lesson.get_students_name()
-                        ),
-                        message=lesson.school.get_notification_template(f"{lesson.type}_class_scheduled_message_parent").format(
-                            parent_name=parent.first_name,
-                            students=lesson.get_students_name(),
-                            class_number=lesson.class_number,
-                            number_of_classes=lesson.packs.all()[0].number_of_classes,
-                            date=new_date_obj,
-                            start_time=lesson.start_time,
-                            duration_in_minutes=lesson.duration_in_minutes,
-                            instructor_name=f"{lesson.get_instructors_name()}" if len(lesson.instructors.all()) > 0 else "Not Assigned yet"
-                        ),
-                        lessons=[lesson],
-                        school=lesson.school,
-                        type="Parent",
-                    )
-
-                # Notify instructor
-                for instructor in lesson.instructors.all():
-                    Notification.create_notification(
-                        user=instructor.user,
-                        subject=lesson.school.get_notification_template(f"{lesson.type}_class_scheduled_subject_instructor").format(
-                            students=lesson.get_students_name()
-                        ),
-                        message=lesson.school.get_notification_template(f"{lesson.type}_class_scheduled_message_instructor").format(
-                            instructor_name=f"{instructor.user.first_name} {instructor.user.last_name}",
-                            students=lesson.get_students_name(),
-                            class_number=lesson.class_number,
-                            number_of_classes=lesson.packs.all()[0].number_of_classes,
-                            date=new_date_obj,
-                            start_time=lesson.start_time,
-                            duration_in_minutes=lesson.duration_in_minutes
-                        ),
-                        lessons=[lesson],
-                        school=lesson.school,
-                        type="Instructor",
-                    )
-
-                # Notify school admin
-                for admin in lesson.school.admins.all():
-                    Notification.create_notification(
-                        user=admin,
-                        subject=lesson.school.get_notification_template(f"{lesson.type}_class_scheduled_subject_admin").format(
-                            students=lesson.get_students_name()
-                        ),
-                        message=lesson.school.get_notification_template(f"{lesson.type}_class_scheduled_message_admin").format(
-                            students=lesson.get_students_name(),
-                            class_number=lesson.class_number,
-                            number_of_classes=lesson.packs.all()[0].number_of_classes,
-                            date=new_date_obj,
-                            start_time=lesson.start_time,
-                            duration_in_minutes=lesson.duration_in_minutes,
-                            instructor_name=f"{lesson.get_instructors_name()}" if len(lesson.instructors.all()) > 0 else "Not Assigned yet",
-                            price=lesson.price,
-                            currency=lesson.school.currency if lesson.price else ""
-                        ),
-                        lessons=[lesson],
-                        school=lesson.school,
-                        type="Admin",
-                    )
+            pack = lesson.packs.all()[0]
+            instructors = list(lesson.instructors.select_related("user"))
+            instructors_name = f"{lesson.get_instructors_name()}" if instructors else "Not Assigned yet"
+            context = dict(
+                students=lesson.get_students_name(),
+                class_number=lesson.class_number,
+                number_of_classes=pack.number_of_classes,
+                date=new_date_obj,
+                start_time=lesson.start_time,
+                duration_in_minutes=lesson.duration_in_minutes,
+            )
+            template_key = f"{lesson.type}_class_scheduled"
+
+            # Notify parents
+            Notification.fan_out(
+                pack.parents.all(), template_key, {**context, "instructor_name": instructors_name},
+                school=lesson.school, type="Parent", lessons=[lesson],
+                recipient_context=lambda parent: {"parent_name": parent.first_name},
+            )
+
+            # Notify instructor
+            Notification.fan_out(
+                [instructor.user for instructor in instructors], template_key, context,
+                school=lesson.school, type="Instructor", lessons=[lesson],
+                recipient_context=lambda user: {"instructor_name": f"{user.first_name} {user.last_name}"},
+            )
+
+            # Notify school admin
+            Notification.fan_out(
+                lesson.school.admins.all(), template_key,
+                {
+                    **context,
+                    "instructor_name": instructors_name,
+                    "price": lesson.price,
+                    "currency": lesson.school.currency if lesson.price else "",
+                },
+                school=lesson.school, type="Admin", lessons=[lesson],
+            )
         return Response({"message": "Aula agendada com sucesso!"}, status=status.HTTP_200_OK)
     else:
         return Response({"error": "Não foi possível agendar. Data e horário não disponíveis."},
@@ -954,61 +933,26 @@ def schedule_multiple_lessons(request):
     # Build the full details once
     lessons_details_all = build_lessons_details(final_results)
 
-    # ——— Parent notifications ———
-    subj_tpl = school.get_notification_template(
-        f"{lesson.type}_class_multiple_scheduled_subject_parent"
-    )
-    msg_tpl  = school.get_notification_template(
-        f"{lesson.type}_class_multiple_scheduled_message_parent"
+    context = dict(
+        number_of_classes=num_classes,
+        students=students_str,
+        lessons_details=lessons_details_all,
     )
+    template_key = f"{lessons[0].type}_class_multiple_scheduled"
 
-    for parent in pack.parents.all():
-        subject = subj_tpl.format(
-            number_of_classes=num_classes,
-            students=students_str
-        )
-        message = msg_tpl.format(
-            parent_name=parent.first_name,
-            number_of_classes=num_classes,
-            students=students_str,
-            lessons_details=lessons_details_all
-        )
-        Notification.create_notification(
-            user=parent,
-            subject=subject,
-            message=message,
-            lessons=lessons,
-            school=school,
-            type="Parent",
-        )
+    # ——— Parent notifications ———
+    Notification.fan_out(
+        pack.parents.all(), template_key, context,
+        school=school, type="Parent", lessons=lessons,
+        recipient_context=lambda parent: {"parent_name": parent.first_name},
+    )
 
     # ——— Admin notifications ———
-    subj_tpl = school.get_notification_template(
-        f"{lesson.type}_class_multiple_scheduled_subject_admin"
-    )
-    msg_tpl  = school.get_notification_template(
-        f"{lesson.type}_class_multiple_scheduled_message_admin"
+    Notification.fan_out(
+        school.admins.all(), template_key, context,
+        school=school, type="Admin", lessons=lessons,
     )
 
-    for admin in school.admins.all():
-        subject = subj_tpl.format(
-            number_of_classes=num_classes,
-            students=students_str
-        )
-        message = msg_tpl.format(
-            number_of_classes=num_classes,
-            students=students_str,
-            lessons_details=lessons_details_all
-        )
-        Notification.create_notification(
-            user=admin,
-            subject=subject,
-            message=message,
-            lessons=lessons,
-            school=school,
-            type="Admin",
-        )
-
     # ——— Instructor notifications ———
     from collections import defaultdict
     by_instr = defaultdict(list)
@@ -1016,15 +960,10 @@ def schedule_multiple_lessons(request):
         for instr_id in entry["instructor_ids"]:
             by_instr[instr_id].append(entry)
 
-    subj_tpl = school.get_notification_template(
-        f"{lesson.type}_class_multiple_scheduled_subject_instructor"
-    )
-    msg_tpl  = school.get_notification_template(
-        f"{lesson.type}_class_multiple_scheduled_message_instructor"
-    )
-
+    lessons_by_id = {l.id: l for l in lessons}
+    instructors_by_id = Instructor.objects.select_related("user").in_bulk([int(i) for i in by_instr])
     for instr_id, entries in by_instr.items():
-        instr = Instructor.objects.get(id=instr_id)
+        instr = instructors_by_id[int(instr_id)]
         # build only this instructor’s lessons
         mini_rows = []
         for e in entries:
@@ -1037,23 +976,16 @@ def schedule_multiple_lessons(request):
             })
         details_i = build_lessons_details(mini_rows)
 
-        subject = subj_tpl.format(
-            lesson_count=len(entries),
-            students=students_str
-        )
-        message = msg_tpl.format(
-            instructor_name=instr.user.first_name,
-            lesson_count=len(entries),
-            students=students_str,
-            lessons_details=details_i
-        )
-        Notification.create_notification(
-            user=instr.user,
-            subject=subject,
-            message=message,
-            lessons=[Lesson.objects.get(id=int(e["lesson_id"])) for e in entries],
-            school=school,
-            type="Instructor",
+        Notification.fan_out(
+            [instr.user], template_key,
+            dict(
+                instructor_name=instr.user.first_name,
+                lesson_count=len(entries),
+                students=students_str,
+                lessons_details=details_i,
+            ),
+            school=school, type="Instructor",
+            lessons=[lessons_by_id[int(e["lesson_id"])] for e in entries],
         )
 
     return Response(final_results, status=200)
@@ -1755,4 +1687,38 @@ def update_pack_expiration_date(request):
             "pack_id": pack.id,
             "expiration_date": pack.expiration_date.isoformat()
         }
-    )
\ No newline at end of file
+    )
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def ics_feed_url(request):
+    """
+    Returns the user's private iCalendar subscription URL. Calendar apps can
+    poll it instead of having lessons pushed through the Google Calendar API.
+    """
+    url = request.build_absolute_uri(reverse('lesson_ics_feed', args=[ics_feed_token(request.user)]))
+    return Response({"url": url, "webcal_url": "webcal://" + url.split("://", 1)[1]})
+
+@require_GET
+def ics_feed(request, token):
+    """
+    The signed iCalendar feed of a user's lessons and activities. It needs
+    no login (calendar apps can't send one), answers conditional requests
+    with 304 and streams the body.
+    """
+    user_id = ics_feed_user_id(token)
+    if user_id is None or not UserAccount.objects.filter(pk=user_id, is_active=True).exists():
+        raise Http404
+
+    etag, last_modified = ics_feed_version(user_id)
+    etag = f'"{etag}"'
+    last_modified_ts = int(last_modified.timestamp()) if last_modified else None
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified_ts)
+    if response is None:
+        response = StreamingHttpResponse(iter_ics_feed(user_id), content_type='text/calendar; charset=utf-8')
+        response['Content-Disposition'] = 'inline; filename="mylessons.ics"'
+    response['ETag'] = etag
+    if last_modified_ts:
+        response['Last-Modified'] = http_date(last_modified_ts)
+    response['Cache-Control'] = 'private, max-age=300'
+    return response
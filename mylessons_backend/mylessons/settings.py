@@ -22,6 +22,12 @@ FERNET_KEY = env('MY_APP_FERNET_KEY')
 if not FERNET_KEY:
     raise RuntimeError('Missing MY_APP_FERNET_KEY in .env')
 
+# Service account of the default Firebase app (see notifications.utils.init_firebase_app)
+FIREBASE_CREDENTIALS = env(
+    'FIREBASE_CREDENTIALS',
+    default=os.path.join(BASE_DIR, 'my-lessons-460316-firebase-adminsdk-fbsvc-3a1cf73ff7.json'),
+)
+
 # Security Settings
 SECRET_KEY = 'your-secret-key'
 DEBUG = True  # Change to False in production
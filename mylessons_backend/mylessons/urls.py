@@ -17,7 +17,7 @@ Including another URLconf
 from django.contrib import admin
 from django.urls import path, include
 from django.contrib.auth import views as auth_views
-from schools.views import BulkImportView, ExcelTemplateView
+from schools.views import BulkImportView, ExcelTemplateView, import_job_status, resume_import_job
 from users.views import exchange_code
 from django.conf import settings
 from django.conf.urls.static import static
@@ -35,6 +35,8 @@ urlpatterns = [
     path('api/events/', include('events.urls')),
     path('api/import-excel/', BulkImportView.as_view(), name='bulk-import'),
     path('api/import-excel/template/', ExcelTemplateView.as_view(), name='excel-template'),
+    path('api/import-excel/jobs/<int:job_id>/', import_job_status, name='import-job-status'),
+    path('api/import-excel/jobs/<int:job_id>/resume/', resume_import_job, name='import-job-resume'),
     path(
         'password-reset-confirm/<uidb64>/<token>/',
         auth_views.PasswordResetConfirmView.as_view(
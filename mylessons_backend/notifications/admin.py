@@ -1,11 +1,11 @@
 from django.contrib import admin
-from .models import Notification
+from .models import Notification, NotificationDeliveryAttempt
 from datetime import timezone
 
 @admin.register(Notification)
 class NotificationAdmin(admin.ModelAdmin):
-    list_display = ('id', 'type', 'user', 'subject', 'message', 'sent_at', 'date_read', 'created_at')
-    list_filter = ('sent_at', 'date_read')
+    list_display = ('id', 'type', 'user', 'subject', 'message', 'sent_at', 'date_read', 'created_at', 'push_status', 'push_attempts')
+    list_filter = ('sent_at', 'date_read', 'push_status')
     search_fields = ('user__first_name', 'user__last_name', 'subject', 'message')
     readonly_fields = ('sent_at', 'date_read')
     
@@ -19,7 +19,12 @@ class NotificationAdmin(admin.ModelAdmin):
     mark_as_read.short_description = "Mark selected notifications as read"
 
     def resend_notification(self, request, queryset):
-        for notification in queryset:
-            notification.send()
+        Notification.bulk_send_notifications(queryset.select_related('user'))
         self.message_user(request, "Selected notifications resent.")
     resend_notification.short_description = "Email selected notifications"
+
+
+@admin.register(NotificationDeliveryAttempt)
+class NotificationDeliveryAttemptAdmin(admin.ModelAdmin):
+    list_display = ('id', 'notification', 'attempt', 'status', 'error', 'created_at')
+    list_filter = ('status',)
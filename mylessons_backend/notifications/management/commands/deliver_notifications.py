@@ -0,0 +1,33 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+from django.core.management.base import BaseCommand
+from notifications.models import Notification
+from notifications.utils import PushDispatcher, init_firebase_app
+
+
+class Command(BaseCommand):
+    help = 'Deliver pending push notifications from the notification outbox'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500, help='Notifications claimed per batch')
+        parser.add_argument('--workers', type=int, default=8, help='Concurrent FCM multicast requests')
+        parser.add_argument('--loop', action='store_true', help='Keep polling instead of exiting when the outbox is empty')
+        parser.add_argument('--interval', type=float, default=5.0, help='Seconds between polls with --loop')
+
+    def handle(self, *args, **options):
+        init_firebase_app()
+        sent = failed = 0
+        with ThreadPoolExecutor(max_workers=options['workers']) as executor:
+            dispatcher = PushDispatcher(executor=executor)
+            while True:
+                batch = Notification.claim_pending_pushes(batch_size=options['batch_size'])
+                if batch:
+                    results = Notification.deliver_pushes(batch, dispatcher=dispatcher)
+                    sent += results.count(True)
+                    failed += results.count(False)
+                    continue
+                if not options['loop']:
+                    break
+                time.sleep(options['interval'])
+
+        self.stdout.write(f'Delivered {sent} push notifications, {failed} failed attempts.')
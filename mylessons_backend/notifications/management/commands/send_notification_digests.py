@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+from notifications.models import Notification
+
+
+class Command(BaseCommand):
+    help = "Group the notifications waiting for users' digests into one summary per user"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'frequency', choices=['hourly', 'daily'],
+            help='Which digest to build; schedule "hourly" every hour and "daily" once a day',
+        )
+
+    def handle(self, *args, **options):
+        digests = Notification.build_digests(options['frequency'])
+        self.stdout.write(f"Queued {len(digests)} {options['frequency']} digests.")
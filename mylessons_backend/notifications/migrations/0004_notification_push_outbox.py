@@ -0,0 +1,64 @@
+# Generated by Django 5.1.5 on 2026-10-19 15:10
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+
+
+def mark_existing_as_sent(apps, schema_editor):
+    """Notifications created before the outbox were already pushed synchronously."""
+    Notification = apps.get_model('notifications', 'Notification')
+    Notification.objects.update(push_status='sent')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('events', '0003_remove_birthdayparty_student_birthdayparty_students_and_more'),
+        ('lessons', '0009_pack_unpaid_school_date_idx'),
+        ('notifications', '0003_initial'),
+        ('schools', '0005_alter_review_options_remove_review_date_and_more'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='NotificationDeliveryAttempt',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('attempt', models.PositiveIntegerField()),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('sending', 'Sending'), ('sent', 'Sent'), ('failed', 'Failed')], max_length=10)),
+                ('error', models.TextField(blank=True, default='')),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+            options={
+                'ordering': ['notification', 'attempt'],
+            },
+        ),
+        migrations.AddField(
+            model_name='notification',
+            name='next_push_attempt_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='notification',
+            name='push_attempts',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='notification',
+            name='push_status',
+            field=models.CharField(choices=[('pending', 'Pending'), ('sending', 'Sending'), ('sent', 'Sent'), ('failed', 'Failed')], default='pending', max_length=10),
+        ),
+        migrations.RunPython(mark_existing_as_sent, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='notification',
+            index=models.Index(fields=['push_status', 'next_push_attempt_at'], name='notificatio_push_st_a30fe2_idx'),
+        ),
+        migrations.AddField(
+            model_name='notificationdeliveryattempt',
+            name='notification',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='delivery_attempts', to='notifications.notification'),
+        ),
+    ]
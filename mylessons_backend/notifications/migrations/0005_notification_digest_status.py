@@ -0,0 +1,23 @@
+# Generated by Django 5.1.5 on 2026-10-19 15:19
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('notifications', '0004_notification_push_outbox'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='notification',
+            name='push_status',
+            field=models.CharField(choices=[('pending', 'Pending'), ('sending', 'Sending'), ('sent', 'Sent'), ('failed', 'Failed'), ('digest', 'Waiting for digest'), ('digested', 'Sent in digest')], default='pending', max_length=10),
+        ),
+        migrations.AlterField(
+            model_name='notificationdeliveryattempt',
+            name='status',
+            field=models.CharField(choices=[('pending', 'Pending'), ('sending', 'Sending'), ('sent', 'Sent'), ('failed', 'Failed'), ('digest', 'Waiting for digest'), ('digested', 'Sent in digest')], max_length=10),
+        ),
+    ]
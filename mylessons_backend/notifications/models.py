@@ -1,11 +1,19 @@
-from django.db import models
+from collections import defaultdict
+from datetime import timedelta
+from django.db import models, transaction
+from django.db.models import Q
 from django.utils.timezone import now
 from schools.models import School
-from .utils import notify_user
+from .utils import EmailBatch, PushDispatcher
 import logging
 
 logger = logging.getLogger(__name__)
 
+NOTIFICATION_FROM_EMAIL = 'mylessons.test@gmail.com'
+PUSH_MAX_ATTEMPTS = 5
+PUSH_RETRY_BASE_DELAY = timedelta(seconds=30)  # doubled after every failed attempt
+PUSH_CLAIM_LEASE = timedelta(minutes=5)  # claimed rows are retried after this if the worker dies
+
 class Notification(models.Model):
     id = models.AutoField(primary_key=True)
     user = models.ForeignKey(
@@ -30,30 +38,37 @@ class Notification(models.Model):
     date_read = models.DateTimeField(null=True, blank=True)
     created_at = models.DateTimeField(null=True, blank=True)
 
+    PUSH_PENDING = "pending"
+    PUSH_SENDING = "sending"
+    PUSH_SENT = "sent"
+    PUSH_FAILED = "failed"
+    PUSH_DIGEST = "digest"  # waiting for the user's next digest
+    PUSH_DIGESTED = "digested"  # delivered as part of a digest
+    PUSH_STATUS_CHOICES = [
+        (PUSH_PENDING, "Pending"),
+        (PUSH_SENDING, "Sending"),
+        (PUSH_SENT, "Sent"),
+        (PUSH_FAILED, "Failed"),
+        (PUSH_DIGEST, "Waiting for digest"),
+        (PUSH_DIGESTED, "Sent in digest"),
+    ]
+    DIGEST_TYPE = "Digest"
+    push_status = models.CharField(max_length=10, choices=PUSH_STATUS_CHOICES, default=PUSH_PENDING)
+    push_attempts = models.PositiveIntegerField(default=0)
+    next_push_attempt_at = models.DateTimeField(null=True, blank=True)
+
     def __str__(self):
         return f"Notification for {self.user} - {self.message[:30]}"
 
     class Meta:
         ordering = ['-sent_at']
+        indexes = [models.Index(fields=['push_status', 'next_push_attempt_at'])]
 
     def send(self):
         """
         Marks the notification as sent, records the timestamp, and sends an email if needed.
         """
-        self.sent_at = now()
-        self.save()
-
-        # Send email if needed
-        if hasattr(self.user, 'email') and self.user.email:
-            from django.core.mail import send_mail
-
-            send_mail(
-                self.subject,
-                self.message,
-                'mylessons.test@gmail.com',  # Sender email address
-                [self.user.email],
-                fail_silently=False,
-            )
+        self.bulk_send_notifications([self])
 
     def mark_as_read(self):
         """
@@ -65,7 +80,9 @@ class Notification(models.Model):
     @classmethod
     def create_notification(cls, user, subject, message, school=None, lessons=None, activities=None, packs=None, type=None):
         """
-        Creates a notification with optional associations.
+        Creates a notification with optional associations. The push is not
+        sent here: the notification is stored as pending, in the caller's
+        transaction, and delivered by the deliver_notifications worker.
         """
         notification = cls.objects.create(
             user=user,
@@ -74,6 +91,8 @@ class Notification(models.Model):
             school=school,
             type=type,
             created_at=now(),
+            next_push_attempt_at=now(),
+            push_status=cls.initial_push_status(user),
         )
 
         if lessons:
@@ -83,23 +102,234 @@ class Notification(models.Model):
         if activities:
             notification.activities.set(activities)
 
-        notification.save()
-        
-        try:
-            notify_user(user=user, title=subject, body=message)
-        except Exception:
-            # logs full traceback at ERROR level
-            logger.exception(
-                "Failed to send push notification for Notification(id=%s) to user %s",
-                notification.id,
-                user.pk,
-            )
         return notification
 
     @classmethod
-    def bulk_send_notifications(cls, notifications):
+    def fan_out(cls, recipients, template_key, context, school, type=None, packs=None, lessons=None, activities=None, recipient_context=None):
         """
-        Sends multiple notifications in bulk.
+        Creates one notification per recipient from the school's
+        "{template_key}_subject_{role}" / "{template_key}_message_{role}"
+        templates (role is type in lowercase; a subject without role is used
+        when there is no role-specific one). Nothing is created when the
+        school has no message template for the role.
+
+        context holds the placeholders shared by every recipient and
+        recipient_context(user) the per-recipient ones (e.g. parent_name).
+        The notifications are inserted with one bulk_create and each M2M
+        relation with one bulk insert into its through table.
         """
+        role = (type or "").lower()
+        subject_template = (
+            school.get_notification_template(f"{template_key}_subject_{role}")
+            or school.get_notification_template(f"{template_key}_subject")
+            or ""
+        )
+        message_template = school.get_notification_template(f"{template_key}_message_{role}")
+
+        unique_recipients = list({user.pk: user for user in recipients}.values())
+        if not unique_recipients or not message_template:
+            return []
+
+        created_at = now()
+        notifications = []
+        for user in unique_recipients:
+            values = {**context, **(recipient_context(user) if recipient_context else {})}
+            notifications.append(cls(
+                user=user,
+                subject=subject_template.format(**values),
+                message=message_template.format(**values),
+                school=school,
+                type=type,
+                created_at=created_at,
+                next_push_attempt_at=created_at,
+                push_status=cls.initial_push_status(user),
+            ))
+        # the pks come back from bulk_create on PostgreSQL and SQLite
+        notifications = cls.objects.bulk_create(notifications)
+
+        for field, objects in (("lessons", lessons), ("packs", packs), ("activities", activities)):
+            if not objects:
+                continue
+            through = getattr(cls, field).through
+            target_column = f"{getattr(cls, field).field.m2m_reverse_field_name()}_id"
+            through.objects.bulk_create([
+                through(notification_id=notification.pk, **{target_column: obj.pk})
+                for notification in notifications
+                for obj in objects
+            ])
+        return notifications
+
+    @classmethod
+    def initial_push_status(cls, user):
+        """Users who asked for a digest get their pushes in the next one."""
+        if getattr(user, "notification_digest", "immediate") != "immediate":
+            return cls.PUSH_DIGEST
+        return cls.PUSH_PENDING
+
+    @classmethod
+    def build_digests(cls, frequency):
+        """
+        Replaces the pushes waiting for the digest of every user with the
+        given frequency ("hourly" or "daily") by one summary notification per
+        user, grouped by school and type. Uses one query to read the queue,
+        one bulk insert for the summaries and one update for the originals.
+        Returns the summary notifications, which go through the outbox as usual.
+
+        The hourly run also sweeps the queue of users who are back on
+        immediate pushes, in case the setting was changed without going
+        through release_digest_queue (e.g. from the admin).
+        """
+        frequencies = [frequency, "immediate"] if frequency == "hourly" else [frequency]
+        with transaction.atomic():
+            queued = list(
+                cls.objects.select_for_update(of=('self',))
+                .filter(push_status=cls.PUSH_DIGEST, user__notification_digest__in=frequencies)
+                .select_related('school')
+                .order_by('user_id', 'school_id', 'type', 'created_at', 'id')
+                .only('id', 'user_id', 'school__name', 'type', 'subject')
+            )
+            if not queued:
+                return []
+
+            by_user = defaultdict(lambda: defaultdict(list))
+            for notification in queued:
+                by_user[notification.user_id][(notification.school, notification.type)].append(notification)
+
+            created_at = now()
+            digests = []
+            for user_id, groups in by_user.items():
+                total = sum(len(notifications) for notifications in groups.values())
+                lines = []
+                for (school, type), notifications in groups.items():
+                    header = f"{school.name if school else 'MyLessons'} - {type or 'General'} ({len(notifications)})"
+                    lines.append(header)
+                    lines.extend(f"- {notification.subject}" for notification in notifications)
+                    lines.append("")
+                schools = {school for school, _ in groups}
+                digests.append(cls(
+                    user_id=user_id,
+                    school=schools.pop() if len(schools) == 1 else None,
+                    type=cls.DIGEST_TYPE,
+                    subject=f"You have {total} new notification{'s' if total != 1 else ''}",
+                    message="\n".join(lines).strip(),
+                    created_at=created_at,
+                    next_push_attempt_at=created_at,
+                ))
+            digests = cls.objects.bulk_create(digests)
+            cls.objects.filter(pk__in=[notification.pk for notification in queued]).update(push_status=cls.PUSH_DIGESTED)
+        return digests
+
+    @classmethod
+    def release_digest_queue(cls, user):
+        """
+        Moves the pushes waiting for a user's digest to the outbox, for when
+        they switch to immediate pushes. Returns how many were released.
+        """
+        return cls.objects.filter(user=user, push_status=cls.PUSH_DIGEST).update(
+            push_status=cls.PUSH_PENDING, next_push_attempt_at=now(),
+        )
+
+    @classmethod
+    def claim_pending_pushes(cls, batch_size=100):
+        """
+        Claims up to batch_size notifications whose push is due, marking them
+        as sending so that concurrent workers do not pick them up too. A claim
+        expires after PUSH_CLAIM_LEASE, so a crashed worker's rows are retried.
+        """
+        current_time = now()
+        with transaction.atomic():
+            ids = list(
+                cls.objects.select_for_update(skip_locked=True)
+                .filter(push_status__in=[cls.PUSH_PENDING, cls.PUSH_SENDING])
+                .filter(Q(next_push_attempt_at__isnull=True) | Q(next_push_attempt_at__lte=current_time))
+                .order_by('id')
+                .values_list('id', flat=True)[:batch_size]
+            )
+            cls.objects.filter(id__in=ids).update(
+                push_status=cls.PUSH_SENDING,
+                next_push_attempt_at=current_time + PUSH_CLAIM_LEASE,
+            )
+        return list(cls.objects.filter(id__in=ids).select_related('user').order_by('id'))
+
+    def deliver_push(self, dispatcher=None):
+        return self.deliver_pushes([self], dispatcher=dispatcher)[0]
+
+    @classmethod
+    def deliver_pushes(cls, notifications, dispatcher=None):
+        """
+        Sends the pushes of a batch of notifications through one
+        PushDispatcher call and records one attempt per notification.
+        Failures are retried with exponential backoff until PUSH_MAX_ATTEMPTS.
+        Returns whether each notification was delivered.
+        """
+        dispatcher = dispatcher or PushDispatcher()
+        errors = dispatcher.send([
+            (notification.pk, notification.user_id, notification.subject, notification.message)
+            for notification in notifications
+        ])
+
+        attempts = []
+        for notification in notifications:
+            error = errors[notification.pk]
+            notification.push_attempts += 1
+            if error is None:
+                notification.push_status = cls.PUSH_SENT
+                notification.next_push_attempt_at = None
+            else:
+                logger.warning(
+                    "Failed to send push notification for Notification(id=%s) to user %s: %s",
+                    notification.pk,
+                    notification.user_id,
+                    error,
+                )
+                if notification.push_attempts >= PUSH_MAX_ATTEMPTS:
+                    notification.push_status = cls.PUSH_FAILED
+                    notification.next_push_attempt_at = None
+                else:
+                    notification.push_status = cls.PUSH_PENDING
+                    notification.next_push_attempt_at = now() + PUSH_RETRY_BASE_DELAY * 2 ** (notification.push_attempts - 1)
+            attempts.append(NotificationDeliveryAttempt(
+                notification=notification,
+                attempt=notification.push_attempts,
+                status=cls.PUSH_SENT if error is None else cls.PUSH_FAILED,
+                error=error or "",
+            ))
+
+        NotificationDeliveryAttempt.objects.bulk_create(attempts)
+        cls.objects.bulk_update(notifications, ['push_status', 'push_attempts', 'next_push_attempt_at'])
+        return [notification.push_status == cls.PUSH_SENT for notification in notifications]
+
+    @classmethod
+    def bulk_send_notifications(cls, notifications, connection=None):
+        """
+        Emails multiple notifications over one mail connection and marks them
+        all as sent with a single update.
+        """
+        notifications = list(notifications)
+        if not notifications:
+            return 0
+
+        batch = EmailBatch(connection=connection, from_email=NOTIFICATION_FROM_EMAIL)
         for notification in notifications:
-            notification.send()
+            if notification.user.email:
+                batch.add(notification.subject, notification.message, [notification.user.email])
+        sent = batch.send()
+
+        sent_at = now()
+        cls.objects.filter(pk__in=[notification.pk for notification in notifications]).update(sent_at=sent_at)
+        for notification in notifications:
+            notification.sent_at = sent_at
+        return sent
+
+class NotificationDeliveryAttempt(models.Model):
+    notification = models.ForeignKey(Notification, on_delete=models.CASCADE, related_name="delivery_attempts")
+    attempt = models.PositiveIntegerField()
+    status = models.CharField(max_length=10, choices=Notification.PUSH_STATUS_CHOICES)
+    error = models.TextField(blank=True, default="")
+    created_at = models.DateTimeField(default=now)
+
+    class Meta:
+        ordering = ['notification', 'attempt']
+
+    def __str__(self):
+        return f"Attempt {self.attempt} of Notification(id={self.notification_id}): {self.status}"
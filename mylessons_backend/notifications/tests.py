@@ -5,7 +5,24 @@ from users.models import UserAccount, Student, Instructor
 from lessons.models import Pack, Lesson
 from schools.models import School
 from events.models import Activity
-from notifications.models import Notification
+from notifications.models import Notification, PUSH_MAX_ATTEMPTS
+from notifications.utils import EmailBatch, FCM_MULTICAST_LIMIT, PushDispatcher
+from django.core import mail
+from django.core.mail import get_connection
+from django.template.loader import get_template
+from fcm_django.models import FCMDevice
+from django.core.management import call_command
+from django.test import override_settings
+from firebase_admin import messaging
+from unittest import mock
+from django.urls import reverse
+from rest_framework.test import APIClient
+import json
+import os
+import tempfile
+import firebase_admin
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
 
 class NotificationModelTests(TestCase):
 
@@ -153,4 +170,250 @@ class NotificationModelTests(TestCase):
         notifications = Notification.objects.all()
         self.assertEqual(notifications[0].subject, "Notification 1")  # Most recent
         self.assertEqual(notifications[1].subject, "Notification 2")
-        self.assertEqual(notifications[2].subject, "Notification 3")  # Oldest
\ No newline at end of file
+        self.assertEqual(notifications[2].subject, "Notification 3")  # Oldest
+
+class FakeFCMClient:
+    """Local stand-in for firebase_admin.messaging."""
+
+    def __init__(self, dead_tokens=(), error=None):
+        self.dead_tokens = set(dead_tokens)
+        self.error = error
+        self.messages = []
+
+    def send_each_for_multicast(self, message):
+        self.messages.append(message)
+        if self.error:
+            raise self.error
+        return messaging.BatchResponse([
+            messaging.SendResponse(None, messaging.UnregisteredError("gone"))
+            if token in self.dead_tokens else messaging.SendResponse({"name": f"msg-{token}"}, None)
+            for token in message.tokens
+        ])
+
+
+class NotificationOutboxTests(TestCase):
+
+    def setUp(self):
+        self.user = UserAccount.objects.create(username="parent")
+        FCMDevice.objects.create(user=self.user, registration_id="token-1", type="android")
+
+    def test_create_notification_does_not_push(self):
+        with mock.patch("notifications.utils.PushDispatcher.send") as send:
+            notification = Notification.create_notification(user=self.user, subject="Booked", message="Pack booked")
+        send.assert_not_called()
+        self.assertEqual(notification.push_status, Notification.PUSH_PENDING)
+
+    def test_claimed_notifications_are_delivered_once(self):
+        notification = Notification.create_notification(user=self.user, subject="Booked", message="Pack booked")
+
+        batch = Notification.claim_pending_pushes()
+        self.assertEqual(batch, [notification])
+        self.assertEqual(Notification.claim_pending_pushes(), [])
+
+        client = FakeFCMClient()
+        self.assertTrue(batch[0].deliver_push(dispatcher=PushDispatcher(client=client)))
+        self.assertEqual(client.messages[0].tokens, ["token-1"])
+        self.assertEqual(client.messages[0].notification.title, "Booked")
+        notification.refresh_from_db()
+        self.assertEqual(notification.push_status, Notification.PUSH_SENT)
+        self.assertEqual(list(notification.delivery_attempts.values_list("status", flat=True)), ["sent"])
+
+    def test_failed_push_is_retried_with_backoff(self):
+        notification = Notification.create_notification(user=self.user, subject="Booked", message="Pack booked")
+        dispatcher = PushDispatcher(client=FakeFCMClient(error=RuntimeError("FCM down")))
+
+        for attempt in range(1, PUSH_MAX_ATTEMPTS + 1):
+            notification.deliver_push(dispatcher=dispatcher)
+            if attempt == 1:
+                self.assertEqual(notification.push_status, Notification.PUSH_PENDING)
+                self.assertGreater(notification.next_push_attempt_at, now())
+                self.assertEqual(Notification.claim_pending_pushes(), [])
+
+        notification.refresh_from_db()
+        self.assertEqual(notification.push_status, Notification.PUSH_FAILED)
+        self.assertEqual(notification.delivery_attempts.count(), PUSH_MAX_ATTEMPTS)
+        self.assertEqual(notification.delivery_attempts.first().error, "FCM down")
+
+    def test_deliver_command_initializes_firebase(self):
+        key = rsa.generate_private_key(public_exponent=65537, key_size=2048).private_bytes(
+            serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption(),
+        ).decode()
+        with tempfile.NamedTemporaryFile("w", suffix=".json", delete=False) as service_account:
+            json.dump({
+                "type": "service_account", "project_id": "mylessons-test", "private_key_id": "1",
+                "private_key": key, "client_email": "worker@mylessons-test.iam.gserviceaccount.com",
+                "client_id": "1", "token_uri": "https://oauth2.googleapis.com/token",
+            }, service_account)
+        self.addCleanup(os.unlink, service_account.name)
+        if firebase_admin._apps:
+            firebase_admin.delete_app(firebase_admin.get_app())
+        self.addCleanup(lambda: firebase_admin._apps and firebase_admin.delete_app(firebase_admin.get_app()))
+        notification = Notification.create_notification(user=self.user, subject="Booked", message="Pack booked")
+
+        # only the HTTP call is replaced: the default messaging client still
+        # has to find the default app the command initialized
+        sent = messaging.BatchResponse([messaging.SendResponse({"name": "msg-1"}, None)])
+        with override_settings(FIREBASE_CREDENTIALS=service_account.name), \
+                mock.patch.object(messaging._MessagingService, "send_each", return_value=sent):
+            call_command("deliver_notifications", stdout=mock.MagicMock())
+
+        notification.refresh_from_db()
+        self.assertEqual(notification.push_status, Notification.PUSH_SENT)
+
+
+class NotificationDigestTests(TestCase):
+
+    def setUp(self):
+        self.school = School.objects.create(name="Surf School")
+        self.other_school = School.objects.create(name="Ski School")
+        self.daily = UserAccount.objects.create(username="daily", notification_digest=UserAccount.DIGEST_DAILY)
+        self.hourly = UserAccount.objects.create(username="hourly", notification_digest=UserAccount.DIGEST_HOURLY)
+        self.immediate = UserAccount.objects.create(username="immediate")
+
+    def test_digest_users_are_not_pushed_immediately(self):
+        queued = Notification.create_notification(user=self.daily, subject="Booked", message="Pack booked")
+        pushed = Notification.create_notification(user=self.immediate, subject="Booked", message="Pack booked")
+
+        self.assertEqual(queued.push_status, Notification.PUSH_DIGEST)
+        self.assertEqual(Notification.claim_pending_pushes(), [pushed])
+
+    def test_digest_groups_by_school_and_type(self):
+        for subject in ("Lesson booked", "Lesson moved"):
+            Notification.create_notification(user=self.daily, subject=subject, message="", school=self.school, type="Parent")
+        Notification.create_notification(user=self.daily, subject="Pack booked", message="", school=self.other_school, type="Parent")
+        Notification.create_notification(user=self.hourly, subject="Lesson booked", message="", school=self.school, type="Instructor")
+
+        # savepoint, read, insert, update, release
+        with self.assertNumQueries(5):
+            digests = Notification.build_digests("daily")
+
+        self.assertEqual(len(digests), 1)
+        digest = Notification.objects.get(type=Notification.DIGEST_TYPE)
+        self.assertEqual(digest.user, self.daily)
+        self.assertEqual(digest.push_status, Notification.PUSH_PENDING)
+        self.assertEqual(digest.subject, "You have 3 new notifications")
+        self.assertIn("Surf School - Parent (2)\n- Lesson booked\n- Lesson moved", digest.message)
+        self.assertIn("Ski School - Parent (1)\n- Pack booked", digest.message)
+        self.assertEqual(Notification.objects.filter(push_status=Notification.PUSH_DIGESTED).count(), 3)
+        self.assertEqual(Notification.objects.filter(user=self.hourly, push_status=Notification.PUSH_DIGEST).count(), 1)
+        self.assertEqual(Notification.build_digests("daily"), [])
+
+    def test_switching_to_immediate_releases_the_queue(self):
+        queued = Notification.create_notification(user=self.daily, subject="Booked", message="Pack booked")
+        client = APIClient()
+        client.force_authenticate(self.daily)
+
+        response = client.post(reverse("notification_digest"), {"notification_digest": "immediate"}, format="json")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(Notification.claim_pending_pushes(), [queued])
+
+    def test_hourly_run_sweeps_users_back_on_immediate(self):
+        Notification.create_notification(user=self.daily, subject="Booked", message="Pack booked")
+        UserAccount.objects.filter(pk=self.daily.pk).update(notification_digest=UserAccount.DIGEST_IMMEDIATE)
+
+        self.assertEqual(Notification.build_digests("daily"), [])
+        self.assertEqual([digest.user_id for digest in Notification.build_digests("hourly")], [self.daily.pk])
+
+
+class PushDispatcherTests(TestCase):
+
+    def setUp(self):
+        self.users = [UserAccount.objects.create(username=f"user{i}") for i in range(3)]
+        for i, user in enumerate(self.users):
+            FCMDevice.objects.create(user=user, registration_id=f"token-{i}", type="android")
+        FCMDevice.objects.create(user=self.users[0], registration_id="token-0b", type="ios")
+
+    def test_one_device_query_and_one_multicast_per_message(self):
+        client = FakeFCMClient()
+        pushes = [(user.pk, user.pk, "Hello", "Same body") for user in self.users]
+        with self.assertNumQueries(1):
+            results = PushDispatcher(client=client).send(pushes)
+
+        self.assertEqual(len(client.messages), 1)
+        self.assertEqual(sorted(client.messages[0].tokens), ["token-0", "token-0b", "token-1", "token-2"])
+        self.assertEqual(results, {user.pk: None for user in self.users})
+
+    def test_multicasts_are_split_in_batches(self):
+        user = UserAccount.objects.create(username="many_devices")
+        FCMDevice.objects.bulk_create([
+            FCMDevice(user=user, registration_id=f"bulk-{i}", type="android") for i in range(FCM_MULTICAST_LIMIT + 1)
+        ])
+        client = FakeFCMClient()
+        PushDispatcher(client=client).send([("key", user.pk, "Hello", "Body")])
+        self.assertEqual([len(message.tokens) for message in client.messages], [FCM_MULTICAST_LIMIT, 1])
+
+    def test_unregistered_tokens_are_pruned(self):
+        client = FakeFCMClient(dead_tokens={"token-0", "token-1"})
+        results = PushDispatcher(client=client).send([(user.pk, user.pk, "Hi", "Body") for user in self.users[:2]])
+
+        self.assertFalse(FCMDevice.objects.filter(registration_id__in=["token-0", "token-1"]).exists())
+        self.assertTrue(FCMDevice.objects.filter(registration_id="token-0b").exists())
+        # a dead token is not a delivery error: the user has no device left
+        self.assertEqual(results, {self.users[0].pk: None, self.users[1].pk: None})
+
+
+class NotificationFanOutTests(TestCase):
+
+    def setUp(self):
+        self.school = School.objects.create(name="Test School", currency="EUR")
+        self.parents = [UserAccount.objects.create(username=f"parent{i}", first_name=f"Parent{i}") for i in range(3)]
+        self.pack = Pack.objects.create(date=date(2025, 1, 1), number_of_classes=2, number_of_classes_left=2,
+                                        duration_in_minutes=60, price=100, school=self.school, type="private")
+        self.lessons = [Lesson.objects.create(date=date(2025, 1, i), duration_in_minutes=60, school=self.school)
+                        for i in (2, 3)]
+
+    def test_fan_out_renders_and_links_in_bulk(self):
+        context = dict(students="Alice", lessons_details="...", number_of_classes=2)
+        # templates, bulk insert of notifications and one insert per relation
+        with self.assertNumQueries(3):
+            notifications = Notification.fan_out(
+                self.parents + [self.parents[0]], "private_class_multiple_scheduled", context,
+                school=self.school, type="Parent", packs=[self.pack], lessons=self.lessons,
+                recipient_context=lambda user: {"parent_name": user.first_name},
+            )
+
+        self.assertEqual(len(notifications), 3)
+        notification = Notification.objects.get(user=self.parents[1])
+        self.assertIn("Parent1", notification.message)
+        self.assertEqual(notification.subject, "Your 2 Private Classes Scheduled for Alice")
+        self.assertEqual(notification.push_status, Notification.PUSH_PENDING)
+        self.assertEqual(set(notification.lessons.all()), set(self.lessons))
+        self.assertEqual(list(notification.packs.all()), [self.pack])
+
+    def test_fan_out_without_template_creates_nothing(self):
+        notifications = Notification.fan_out(self.parents, "group_pack_purchased", {}, school=self.school, type="Instructor")
+        self.assertEqual(notifications, [])
+        self.assertFalse(Notification.objects.exists())
+
+
+class EmailBatchTests(TestCase):
+
+    def setUp(self):
+        self.users = [UserAccount.objects.create(username=f"user{i}", email=f"user{i}@example.com") for i in range(3)]
+        self.users.append(UserAccount.objects.create(username="no_email"))
+        self.notifications = [
+            Notification.objects.create(user=user, subject="Subject", message=f"Message {i}")
+            for i, user in enumerate(self.users)
+        ]
+
+    def test_bulk_send_uses_one_connection_and_one_update(self):
+        connection = get_connection()
+        with mock.patch.object(connection, "send_messages", wraps=connection.send_messages) as send_messages:
+            with self.assertNumQueries(1):
+                sent = Notification.bulk_send_notifications(self.notifications, connection=connection)
+
+        send_messages.assert_called_once()
+        self.assertEqual(sent, 3)
+        self.assertEqual([message.to for message in mail.outbox], [[user.email] for user in self.users[:3]])
+        self.assertFalse(Notification.objects.filter(sent_at__isnull=True).exists())
+
+    def test_template_is_compiled_once_per_key(self):
+        batch = EmailBatch()
+        with mock.patch("notifications.utils.get_template", wraps=get_template) as loader:
+            for user in self.users[:3]:
+                batch.add("Receipt", "", [user.email], html_template="payments/receipt_email.html",
+                          context={"receipt": {"receipt_number": user.pk, "items": []}})
+        loader.assert_called_once_with("payments/receipt_email.html")
+        self.assertEqual(batch.send(), 3)
+        self.assertIn(f"Payment Receipt - {self.users[0].pk}", mail.outbox[0].alternatives[0][0])
@@ -1,21 +1,148 @@
 import os
+from collections import defaultdict
 import firebase_admin
-from firebase_admin import credentials
+from firebase_admin import credentials, messaging
 from fcm_django.models import FCMDevice
-from firebase_admin.messaging import Message, Notification
+from firebase_admin.messaging import MulticastMessage, Notification
 from django.conf import settings
+from django.core.mail import EmailMultiAlternatives, get_connection
+from django.template.loader import get_template
+from django.utils.html import strip_tags
+
+FCM_MULTICAST_LIMIT = 500  # max tokens per FCM multicast request
+# tokens that will never work again and are removed from FCMDevice
+DEAD_TOKEN_ERRORS = (messaging.UnregisteredError, messaging.SenderIdMismatchError)
+
+
+def init_firebase_app():
+    """
+    Initializes the default Firebase app from settings.FIREBASE_CREDENTIALS
+    unless this process already has one, and returns it. Every entry point
+    that sends pushes or verifies Firebase tokens (the web workers, the
+    deliver_notifications worker) calls it first.
+    """
+    if not firebase_admin._apps:
+        firebase_admin.initialize_app(credentials.Certificate(settings.FIREBASE_CREDENTIALS))
+    return firebase_admin.get_app()
+
+
+class PushDispatcher:
+    """
+    Sends push notifications to many users at once: the device tokens of
+    every user are loaded in one query, pushes with the same title and body
+    are sent as FCM multicasts of up to FCM_MULTICAST_LIMIT tokens, and
+    unregistered tokens are pruned from the results.
+
+    client is anything with firebase_admin.messaging's send_each_for_multicast
+    (tests use a local stand-in) and executor an optional concurrent.futures
+    executor to send the multicasts in parallel.
+    """
+
+    def __init__(self, client=messaging, executor=None):
+        self.client = client
+        self.executor = executor
+
+    def send(self, pushes):
+        """
+        pushes is a list of (key, user_id, title, body). Returns a dict with,
+        for every key, None if the push was delivered (or the user has no
+        device left to deliver to) or the error message otherwise.
+        """
+        tokens_by_user = defaultdict(list)
+        devices = FCMDevice.objects.filter(
+            user_id__in={user_id for _, user_id, _, _ in pushes}, active=True
+        ).values_list('user_id', 'registration_id')
+        for user_id, token in devices:
+            tokens_by_user[user_id].append(token)
+
+        targets_by_content = defaultdict(list)
+        for key, user_id, title, body in pushes:
+            for token in tokens_by_user.get(user_id, []):
+                targets_by_content[(title, body)].append((key, token))
+
+        chunks = [
+            (title, body, targets[i:i + FCM_MULTICAST_LIMIT])
+            for (title, body), targets in targets_by_content.items()
+            for i in range(0, len(targets), FCM_MULTICAST_LIMIT)
+        ]
+        send = self.executor.map if self.executor else map
+
+        delivered, errors, dead_tokens = set(), {}, []
+        for (_, _, targets), (responses, error) in zip(chunks, send(self._send_chunk, chunks)):
+            for index, (key, token) in enumerate(targets):
+                exception = error if responses is None else responses[index].exception
+                if exception is None:
+                    delivered.add(key)
+                elif isinstance(exception, DEAD_TOKEN_ERRORS):
+                    dead_tokens.append(token)
+                else:
+                    errors.setdefault(key, str(exception))
+
+        if dead_tokens:
+            FCMDevice.objects.filter(registration_id__in=dead_tokens).delete()
+
+        return {
+            key: None if key in delivered else errors.get(key)
+            for key, _, _, _ in pushes
+        }
+
+    def _send_chunk(self, chunk):
+        title, body, targets = chunk
+        message = MulticastMessage(
+            tokens=[token for _, token in targets],
+            notification=Notification(title=title, body=body),
+        )
+        try:
+            return self.client.send_each_for_multicast(message).responses, None
+        except Exception as e:
+            return None, e
 
 
 def notify_user(user, title, body):
-    # Build the FCM Message object
-    msg = Message(
-        notification=Notification(
-            title=title,
-            body=body,
-        ),
-        # you could also add .data={...} or other fields here
-    )
-
-    # Bulk-send to all of this user’s devices
-    devices = FCMDevice.objects.filter(user=user)
-    devices.send_message(msg)
\ No newline at end of file
+    error = PushDispatcher().send([(user.pk, user.pk, title, body)])[user.pk]
+    if error:
+        raise RuntimeError(error)
+
+
+class EmailBatch:
+    """
+    Collects emails and sends them all over a single backend connection
+    (one SMTP session) with send_messages. Templates are loaded and compiled
+    once per template name for the whole batch.
+    """
+
+    def __init__(self, connection=None, from_email=None):
+        self.connection = connection
+        self.from_email = from_email or settings.DEFAULT_FROM_EMAIL
+        self.messages = []
+        self._templates = {}
+
+    def add(self, subject, body, to, html_template=None, context=None, html=None):
+        """
+        Queues one email. With html_template the body is rendered from it
+        (using context), or html can be given already rendered; a plain text
+        version is derived from the HTML.
+        """
+        if html:
+            body = strip_tags(html)
+        elif html_template:
+            template = self._templates.get(html_template)
+            if template is None:
+                template = self._templates[html_template] = get_template(html_template)
+            html = template.render(context or {})
+            body = strip_tags(html)
+
+        message = EmailMultiAlternatives(subject, body, self.from_email, to)
+        if html:
+            message.attach_alternative(html, "text/html")
+        self.messages.append(message)
+        return message
+
+    def send(self, fail_silently=False):
+        """Sends every queued email and returns how many were sent."""
+        if not self.messages:
+            return 0
+        connection = self.connection or get_connection(fail_silently=fail_silently)
+        sent = connection.send_messages(self.messages) or 0
+        self.messages = []
+        return sent
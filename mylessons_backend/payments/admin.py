@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import Payment
+from .models import Payment, StripeEvent
 
 
 @admin.register(Payment)
@@ -9,4 +9,12 @@ class PaymentAdmin(admin.ModelAdmin):
     search_fields = ('user__username', 'description')  # Enable search by username and description
     ordering = ('-date', '-time')  # Default ordering by newest payments
     autocomplete_fields = ('user', 'packs', 'lessons', 'camp_orders', 'vouchers', 'instructor', 'monitor')  # Enable autocomplete for related fields
-    filter_horizontal = ('packs', 'lessons', 'camp_orders', 'vouchers')
\ No newline at end of file
+    filter_horizontal = ('packs', 'lessons', 'camp_orders', 'vouchers')
+
+
+@admin.register(StripeEvent)
+class StripeEventAdmin(admin.ModelAdmin):
+    list_display = ('event_id', 'type', 'status', 'attempts', 'received_at', 'processed_at')
+    list_filter = ('status', 'type')
+    search_fields = ('event_id', 'object_id')
+    raw_id_fields = ('payment',)
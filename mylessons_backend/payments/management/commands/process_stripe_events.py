@@ -0,0 +1,29 @@
+import time
+from django.core.management.base import BaseCommand
+from payments.models import StripeEvent
+
+
+class Command(BaseCommand):
+    help = 'Apply the Stripe webhook events stored by the webhook'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100, help='Events claimed per batch')
+        parser.add_argument('--loop', action='store_true', help='Keep polling instead of exiting when no event is due')
+        parser.add_argument('--interval', type=float, default=5.0, help='Seconds between polls with --loop')
+
+    def handle(self, *args, **options):
+        applied = failed = 0
+        while True:
+            batch = StripeEvent.claim_pending(batch_size=options['batch_size'])
+            if batch:
+                for event in batch:
+                    if event.apply():
+                        applied += 1
+                    else:
+                        failed += 1
+                continue
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
+
+        self.stdout.write(f'Applied {applied} Stripe events, {failed} failed attempts.')
@@ -0,0 +1,31 @@
+# Generated by Django 5.1.5 on 2026-10-19 15:55
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('events', '0004_activity_updated_at'),
+        ('lessons', '0012_packbooking'),
+        ('payments', '0005_paymentreceipt'),
+        ('schools', '0007_importjob_target'),
+        ('users', '0016_useraccount_notification_digest'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='payment',
+            index=models.Index(fields=['user', 'date', 'time', 'id'], name='payments_pa_user_id_58c7ad_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='payment',
+            index=models.Index(fields=['school', 'date', 'time', 'id'], name='payments_pa_school__bfb00f_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='payment',
+            index=models.Index(fields=['instructor', 'date', 'time', 'id'], name='payments_pa_instruc_c1f084_idx'),
+        ),
+    ]
@@ -1,8 +1,24 @@
-from django.db import models
-from django.utils.timezone import localtime, make_aware, is_naive
-from django.template.loader import render_to_string
-from django.core.mail import send_mail
-from django.conf import settings
+import json
+import logging
+from datetime import timedelta
+from decimal import Decimal
+from django.db import models, transaction
+from django.db.models import Q
+from django.utils.timezone import now
+from django.core.files.base import ContentFile
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import prefetch_related_objects
+from django.template.loader import get_template
+
+logger = logging.getLogger(__name__)
+
+RECEIPT_TEMPLATE = "payments/receipt_email.html"
+RECEIPT_PREFETCH = (
+    "packs", "lessons", "camp_orders__student", "activities", "birthday_parties", "vouchers__packs", "vouchers__lessons",
+)
+STRIPE_EVENT_MAX_ATTEMPTS = 8
+STRIPE_EVENT_RETRY_BASE_DELAY = timedelta(seconds=30)  # doubled after every failed attempt
+STRIPE_EVENT_CLAIM_LEASE = timedelta(minutes=5)  # claimed events are retried after this if the worker dies
     
 class Payment(models.Model):
     old_id_str = models.CharField(max_length=255, unique=True, blank=True, null=True)
@@ -72,11 +88,24 @@ class Payment(models.Model):
         
     def generate_receipt(self):
         """
-        Generates a receipt for the payment, including all relevant details.
+        The receipt of the payment: its stored snapshot once issued, or else
+        the current details of the payment.
         """
-        time_value = self.time
-        if is_naive(time_value):
-            time_value = make_aware(time_value)
+        receipt = PaymentReceipt.objects.filter(payment=self).first()
+        if receipt:
+            return receipt.data
+        prefetch_related_objects([self], *RECEIPT_PREFETCH)
+        return self.build_receipt_data()
+
+    def build_receipt_data(self):
+        """
+        Receipt details from the payment's current state. Prefetch
+        RECEIPT_PREFETCH first when building several receipts.
+        """
+        currency = getattr(self.school, "currency", "EUR")
+
+        def price(value, sign=""):
+            return f"{sign}{value or 0:.2f} {currency}"
 
         receipt_data = {
             "receipt_number": f"RCP-{self.id}",
@@ -87,10 +116,10 @@ class Payment(models.Model):
             "time": self.time.strftime("%H:%M:%S"),
             "payer_name": f"{self.user.first_name} {self.user.last_name}",
             "payer_email": self.user.email,
-            "payment_method": self.description.get("method", "Unknown"),
+            "payment_method": self.description.get("method", "Unknown") if isinstance(self.description, dict) else "Unknown",
             "items": [],
-            "total_price": self.value,
-            "currency": getattr(self.school, "currency", "EUR"),
+            "total_price": str(self.value),
+            "currency": currency,
         }
 
         # Add purchased services to the receipt
@@ -98,64 +127,337 @@ class Payment(models.Model):
             receipt_data["items"].append({
                 "type": "Pack",
                 "name": f"{pack.number_of_classes} Lessons - {pack.duration_in_minutes} min",
-                "price": f"{pack.price:.2f} {receipt_data['currency']}"
+                "price": price(pack.price),
             })
 
         for lesson in self.lessons.all():
             receipt_data["items"].append({
                 "type": "Lesson",
                 "name": f"Lesson - {lesson.duration_in_minutes} min",
-                "price": f"{lesson.price:.2f} {receipt_data['currency']}"
+                "price": price(lesson.price),
             })
 
         for camp in self.camp_orders.all():
             receipt_data["items"].append({
                 "type": "Camp Enrollment",
-                "name": camp.name,
-                "price": f"{camp.price:.2f} {receipt_data['currency']}"
+                "name": f"Camp for {camp.student.first_name} {camp.student.last_name} on {camp.date:%Y-%m-%d}",
+                "price": price(camp.price),
             })
 
-        for activity in self.activities.all():  # Fixed iteration over activities
+        for activity in self.activities.all():
             receipt_data["items"].append({
                 "type": "Activity",
                 "name": activity.name,
-                "price": f"{activity.price:.2f} {receipt_data['currency']}"
+                "price": price(activity.price),
             })
 
         for party in self.birthday_parties.all():
             receipt_data["items"].append({
                 "type": "Birthday Party",
-                "name": party.name,
-                "price": f"{party.price:.2f} {receipt_data['currency']}"
+                "name": f"Birthday Party on {party.date:%Y-%m-%d}",
+                "price": price(party.price),
             })
 
         for voucher in self.vouchers.all():
+            # a voucher is worth the packs and lessons it covers
+            value = sum(pack.price for pack in voucher.packs.all()) + sum(lesson.price or 0 for lesson in voucher.lessons.all())
             receipt_data["items"].append({
                 "type": "Voucher",
-                "name": voucher.code,
-                "price": f"-{voucher.value:.2f} {receipt_data['currency']}"
+                "name": f"Voucher {voucher.id} - valid until {voucher.expiration_date:%Y-%m-%d}",
+                "price": price(value),
             })
 
         return receipt_data
 
+    @classmethod
+    def issue_receipts(cls, payments):
+        """
+        Renders and stores the receipts of payments that have none yet, with
+        the related items of all of them prefetched at once. Receipts are
+        never rendered again afterwards. Returns {payment id: PaymentReceipt}.
+        """
+        from payments.utils import render_receipt_pdf
+
+        payments = list(payments)
+        receipts = {receipt.payment_id: receipt for receipt in PaymentReceipt.objects.filter(payment__in=payments)}
+        missing = [payment for payment in payments if payment.pk not in receipts]
+        if not missing:
+            return receipts
+
+        prefetch_related_objects(missing, "school", "user", *RECEIPT_PREFETCH)
+        template = get_template(RECEIPT_TEMPLATE)
+        new_receipts = []
+        for payment in missing:
+            data = payment.build_receipt_data()
+            html = template.render({"receipt": data})
+            pdf = render_receipt_pdf(html)
+            new_receipts.append(PaymentReceipt(
+                payment=payment,
+                number=data["receipt_number"],
+                data=data,
+                html=html,
+                pdf=ContentFile(pdf, name=f"{data['receipt_number']}.pdf") if pdf else None,
+            ))
+        PaymentReceipt.objects.bulk_create(new_receipts, ignore_conflicts=True)
+        receipts.update((receipt.payment_id, receipt) for receipt in PaymentReceipt.objects.filter(payment__in=missing))
+        return receipts
+
+    @classmethod
+    def issue_receipts_on_commit(cls, payments):
+        """
+        Issues the receipts once the current transaction commits, so that
+        rendering them doesn't hold the locks of a settlement or booking and
+        can't roll it back. A failure is logged and the receipt is issued
+        when it is first requested instead.
+        """
+        payments = list(payments)
+
+        def issue():
+            try:
+                cls.issue_receipts(payments)
+            except Exception:
+                logger.exception("Failed to issue the receipts of payments %s", [payment.pk for payment in payments])
+
+        transaction.on_commit(issue)
+
+    def get_payout_user(self):
+        """
+        Returns the staff member this payment pays out to, or None if it is a
+        regular payment for services.
+
+        A payment is a payout if it has an instructor or monitor set, or if it
+        has no packs, lessons, activities, camp orders, birthday parties or
+        vouchers and its user is staff (admin, instructor or monitor) of the
+        payment's school.
+        """
+        if self.instructor_id:
+            return self.instructor.user
+        if self.monitor_id:
+            return self.monitor.user
+
+        related = (self.packs, self.lessons, self.activities, self.camp_orders, self.birthday_parties, self.vouchers)
+        if not self.school or any(rel.exists() for rel in related):
+            return None
+
+        school = self.school
+        if (school.admins.filter(pk=self.user_id).exists()
+                or school.instructors.filter(user_id=self.user_id).exists()
+                or school.monitors.filter(user_id=self.user_id).exists()):
+            return self.user
+        return None
 
     def send_receipt_email(self):
         """
         Sends the payment receipt to the user's email.
         """
-        receipt_data = self.generate_receipt()
-        subject = f"Payment Receipt - {receipt_data['receipt_number']}"
+        return Payment.send_receipt_emails([self])
 
-        message = render_to_string("payments/receipt_email.html", {"receipt": receipt_data})
+    @classmethod
+    def send_receipt_emails(cls, payments, connection=None):
+        """
+        Sends the receipts of several payments over one mail connection,
+        compiling the receipt template once.
+        """
+        from notifications.utils import EmailBatch
 
-        send_mail(
-            subject,
-            message,
-            settings.DEFAULT_FROM_EMAIL,
-            [self.user.email],
-            fail_silently=False,
-        )
+        payments = [payment for payment in payments if payment.user.email]
+        receipts = cls.issue_receipts(payments)
+        batch = EmailBatch(connection=connection)
+        for payment in payments:
+            receipt = receipts[payment.pk]
+            batch.add(f"Payment Receipt - {receipt.number}", "", [payment.user.email], html=receipt.html)
+        return batch.send()
 
     class Meta:
         ordering = ['-date', '-time']  # Newest payments appear first
+        # cover the (date, time, id) keyset of the payment history pages
+        indexes = [
+            models.Index(fields=["user", "date", "time", "id"]),
+            models.Index(fields=["school", "date", "time", "id"]),
+            models.Index(fields=["instructor", "date", "time", "id"]),
+        ]
 
+
+class PaymentReceipt(models.Model):
+    """
+    The receipt of a payment as issued: its details, the rendered HTML and,
+    where WeasyPrint can run, a PDF. Stored once and never updated, so
+    resends and downloads serve exactly what was issued.
+    """
+    payment = models.OneToOneField(Payment, on_delete=models.CASCADE, related_name="receipt")
+    number = models.CharField(max_length=50)
+    data = models.JSONField(encoder=DjangoJSONEncoder)
+    html = models.TextField()
+    pdf = models.FileField(upload_to="receipts/", blank=True, null=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return self.number
+
+    def save(self, *args, **kwargs):
+        if not self._state.adding:
+            raise ValueError("Issued receipts can't be changed.")
+        super().save(*args, **kwargs)
+
+
+class StripeEvent(models.Model):
+    """
+    A verified Stripe webhook event, stored once per Stripe event id so that
+    redelivered events are ignored. The webhook only records the event; the
+    process_stripe_events worker applies it (creating the Payment and
+    lowering the packs' debt) and retries failures with backoff.
+    """
+    PENDING = "pending"
+    PROCESSING = "processing"
+    PROCESSED = "processed"
+    IGNORED = "ignored"  # event types that need no action
+    FAILED = "failed"
+    STATUS_CHOICES = [
+        (PENDING, "Pending"),
+        (PROCESSING, "Processing"),
+        (PROCESSED, "Processed"),
+        (IGNORED, "Ignored"),
+        (FAILED, "Failed"),
+    ]
+
+    PAYMENT_INTENT_SUCCEEDED = "payment_intent.succeeded"
+    CHECKOUT_SESSION_COMPLETED = "checkout.session.completed"
+    CHECKOUT_SESSION_ASYNC_PAYMENT_SUCCEEDED = "checkout.session.async_payment_succeeded"
+    CHECKOUT_SESSION_TYPES = [CHECKOUT_SESSION_COMPLETED, CHECKOUT_SESSION_ASYNC_PAYMENT_SUCCEEDED]
+
+    event_id = models.CharField(max_length=255, unique=True)
+    type = models.CharField(max_length=100)
+    object_id = models.CharField(max_length=255, blank=True, db_index=True)  # id of the session or intent
+    payload = models.JSONField()
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=PENDING)
+    attempts = models.PositiveIntegerField(default=0)
+    last_error = models.TextField(blank=True, null=True)
+    next_attempt_at = models.DateTimeField(blank=True, null=True)
+    received_at = models.DateTimeField(auto_now_add=True)
+    processed_at = models.DateTimeField(blank=True, null=True)
+    payment = models.ForeignKey(Payment, on_delete=models.SET_NULL, null=True, blank=True, related_name="stripe_events")
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["status", "next_attempt_at"]),
+        ]
+
+    def __str__(self):
+        return f"{self.type} {self.event_id} ({self.status})"
+
+    @property
+    def data_object(self):
+        return self.payload.get("data", {}).get("object", {})
+
+    @classmethod
+    def record(cls, event):
+        """
+        Stores a verified webhook event (as a dict). Returns (event, created);
+        a redelivered event is not stored again.
+        """
+        return cls.objects.get_or_create(
+            event_id=event["id"],
+            defaults={
+                "type": event["type"],
+                "object_id": event.get("data", {}).get("object", {}).get("id", ""),
+                "payload": event,
+            },
+        )
+
+    @classmethod
+    def claim_pending(cls, batch_size=100):
+        """
+        Claims up to batch_size events that are due, marking them as processing
+        so that concurrent workers do not pick them up too. A claim expires
+        after STRIPE_EVENT_CLAIM_LEASE, so a crashed worker's events are retried.
+        """
+        current_time = now()
+        with transaction.atomic():
+            ids = list(
+                cls.objects.select_for_update(skip_locked=True)
+                .filter(status__in=[cls.PENDING, cls.PROCESSING])
+                .filter(Q(next_attempt_at__isnull=True) | Q(next_attempt_at__lte=current_time))
+                .order_by("id")
+                .values_list("id", flat=True)[:batch_size]
+            )
+            cls.objects.filter(id__in=ids).update(
+                status=cls.PROCESSING,
+                next_attempt_at=current_time + STRIPE_EVENT_CLAIM_LEASE,
+            )
+        return list(cls.objects.filter(id__in=ids).order_by("id"))
+
+    def apply(self):
+        """
+        Applies the event in one transaction with its status, so it takes
+        effect exactly once. Returns whether it was applied.
+        """
+        try:
+            with transaction.atomic():
+                event = type(self).objects.select_for_update().get(pk=self.pk)
+                if event.status in (self.PROCESSED, self.IGNORED):
+                    return True
+                handler = {
+                    self.PAYMENT_INTENT_SUCCEEDED: event._apply_payment_intent_succeeded,
+                }.get(event.type)
+                event.status = self.PROCESSED if handler else self.IGNORED
+                if handler:
+                    event.payment = handler()
+                event.attempts += 1
+                event.last_error = None
+                event.next_attempt_at = None
+                event.processed_at = now()
+                event.save(update_fields=["status", "payment", "attempts", "last_error", "next_attempt_at", "processed_at"])
+        except Exception as e:
+            logger.exception("Failed to apply Stripe event %s", self.event_id)
+            self.attempts += 1
+            self.last_error = str(e)
+            if self.attempts >= STRIPE_EVENT_MAX_ATTEMPTS:
+                self.status = self.FAILED
+                self.next_attempt_at = None
+            else:
+                self.status = self.PENDING
+                self.next_attempt_at = now() + STRIPE_EVENT_RETRY_BASE_DELAY * 2 ** (self.attempts - 1)
+            self.save(update_fields=["status", "attempts", "last_error", "next_attempt_at"])
+            return False
+        self.refresh_from_db()
+        return True
+
+    def _apply_payment_intent_succeeded(self):
+        """
+        Settles a debt payment intent (see create_debt_payment_intent_view):
+        records a Payment of the amount received for the packs in its
+        metadata and lowers each pack's debt by its split amount, or clears
+        it. Intents without packs need no settlement.
+        """
+        from lessons.models import Pack
+        from users.models import UserAccount
+
+        intent = self.data_object
+        metadata = intent.get("metadata") or {}
+        pack_ids = json.loads(metadata.get("pack_ids") or "[]")
+        if not pack_ids:
+            return None
+        pack_amounts = json.loads(metadata.get("pack_amounts") or "null") or {}
+        user = UserAccount.objects.get(pk=metadata["user_id"])
+        packs = list(Pack.objects.select_for_update().filter(id__in=pack_ids).order_by("id"))
+
+        payment = Payment.objects.create(
+            value=Decimal(intent.get("amount_received", intent.get("amount", 0))) / 100,
+            user=user,
+            school=packs[0].school if packs else None,
+            description={
+                "debt_payment": "Payment record for debt update",
+                "pack_ids": pack_ids,
+                "pack_amounts": pack_amounts or None,
+                "stripe_payment_intent": intent.get("id"),
+            },
+        )
+        payment.packs.set(packs)
+        for pack in packs:
+            try:
+                amount = Decimal(str(pack_amounts.get(str(pack.id), pack.debt)))
+            except Exception:
+                amount = pack.debt
+            pack.update_debt(amount)
+        Payment.issue_receipts_on_commit([payment])
+        return payment
@@ -0,0 +1,34 @@
+from django.db.models.signals import post_delete, post_save
+from django.db.models import Q
+from django.dispatch import receiver
+from lessons.models import Lesson, Pack
+from .models import Payment
+from .utils import invalidate_revenue_forecast
+
+
+@receiver([post_save, post_delete], sender=Payment)
+@receiver([post_save, post_delete], sender=Pack)
+def invalidate_school_revenue_forecast(sender, instance, **kwargs):
+    """
+    Drops the cached revenue forecast of the school whenever one of its
+    payments or packs changes. Bulk writes send no signals, so they call
+    invalidate_revenue_forecast themselves.
+    """
+    if instance.school_id:
+        invalidate_revenue_forecast(instance.school_id)
+
+
+@receiver([post_save, post_delete], sender=Lesson)
+def invalidate_lesson_revenue_forecast(sender, instance, **kwargs):
+    """
+    Rescheduling a lesson or marking it as given moves the forecast of its
+    school, or of its packs' schools for lessons without one.
+    """
+    if instance.school_id:
+        school_ids = {instance.school_id}
+    else:
+        school_ids = set(Pack.objects.filter(
+            Q(lessons_many=instance.pk) | Q(pk=instance.pack_id), school__isnull=False,
+        ).values_list("school_id", flat=True))
+    for school_id in school_ids:
+        invalidate_revenue_forecast(school_id)
@@ -1,3 +1,505 @@
-from django.test import TestCase
+import hashlib
+import hmac
+import io
+import json
+import tempfile
+import time
+from datetime import time as datetime_time
+from unittest import mock
+from django.conf import settings
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import APIClient
+from events.models import CampOrder
+from django.urls import reverse
+from django.utils.timezone import now
+from django.core.cache import cache
+from django.core import mail
+from datetime import date, timedelta
+from decimal import Decimal
+from lessons.models import Lesson, Pack, Voucher
+from schools.models import School
+from users.models import BalanceEntry, Instructor, Monitor, Student, UserAccount
+from payments.models import Payment, PaymentReceipt, StripeEvent
+from payments.utils import debt_summary, forecast_school_revenue, get_revenue_forecast, render_receipt_pdf, run_payout_batch, unpaid_pack_items, REVENUE_FORECAST_CACHE_KEY
 
-# Create your tests here.
+
+class RevenueForecastTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.school = School.objects.create(name="Test School")
+        self.user = UserAccount.objects.create(username="parent")
+        # Monday, so week 0 starts on the same day.
+        self.today = date(2025, 3, 3)
+
+    def make_pack(self, debt, classes_left, expiration_date=None):
+        return Pack.objects.create(
+            date=self.today,
+            number_of_classes=classes_left,
+            number_of_classes_left=classes_left,
+            duration_in_minutes=60,
+            price=debt,
+            debt=debt,
+            expiration_date=expiration_date,
+            school=self.school,
+        )
+
+    def test_debt_spread_over_scheduled_lessons_and_expiration(self):
+        pack = self.make_pack(Decimal("100.00"), 4, expiration_date=self.today + timedelta(weeks=3))
+        for offset in (1, 8):
+            lesson = Lesson.objects.create(date=self.today + timedelta(days=offset), duration_in_minutes=60)
+            lesson.packs.add(pack)
+
+        forecast = forecast_school_revenue(self.school.id, weeks=4, start=self.today)
+
+        self.assertEqual([w["from_scheduled_lessons"] for w in forecast["weeks"]], ["25.00", "25.00", "0.00", "0.00"])
+        self.assertEqual([w["from_expiring_packs"] for w in forecast["weeks"]], ["0.00", "0.00", "0.00", "50.00"])
+        self.assertEqual(forecast["total_outstanding_debt"], "100.00")
+
+    def test_expired_beyond_horizon_and_unscheduled_debt(self):
+        self.make_pack(Decimal("30.00"), 2, expiration_date=self.today - timedelta(days=10))
+        self.make_pack(Decimal("40.00"), 2, expiration_date=self.today + timedelta(weeks=10))
+        self.make_pack(Decimal("50.00"), 2)
+
+        forecast = forecast_school_revenue(self.school.id, weeks=2, start=self.today)
+
+        self.assertEqual(forecast["weeks"][0]["expected"], "30.00")
+        self.assertEqual(forecast["beyond_horizon"], "40.00")
+        self.assertEqual(forecast["unscheduled"], "50.00")
+
+    def test_cache_invalidated_on_payment_and_pack_changes(self):
+        key = REVENUE_FORECAST_CACHE_KEY.format(school_id=self.school.id)
+        get_revenue_forecast(self.school.id)
+        self.assertIsNotNone(cache.get(key))
+
+        Payment.objects.create(value=10, user=self.user, school=self.school, description={})
+        self.assertIsNone(cache.get(key))
+
+        get_revenue_forecast(self.school.id)
+        pack = self.make_pack(Decimal("20.00"), 1)
+        self.assertIsNone(cache.get(key))
+
+        # lessons: saved one by one, through a pack, or bulk created
+        lesson = Lesson.objects.create(date=self.today, duration_in_minutes=60)
+        lesson.packs.add(pack)
+        get_revenue_forecast(self.school.id)
+        lesson.date = self.today + timedelta(days=1)
+        lesson.save()
+        self.assertIsNone(cache.get(key))
+
+        get_revenue_forecast(self.school.id)
+        pack.create_private_classes()
+        self.assertIsNone(cache.get(key))
+
+
+class DebtServiceTests(TestCase):
+
+    def setUp(self):
+        self.school = School.objects.create(name="Test School")
+        self.student = Student.objects.create(first_name="Alice", last_name="Smith")
+        self.today = date(2025, 6, 30)
+
+    def make_pack(self, debt, days_ago):
+        pack = Pack.objects.create(
+            date=self.today - timedelta(days=days_ago),
+            number_of_classes=4,
+            number_of_classes_left=4,
+            duration_in_minutes=60,
+            price=debt,
+            debt=debt,
+            school=self.school,
+        )
+        pack.students.add(self.student)
+        return pack
+
+    def test_totals_and_aging_buckets(self):
+        self.make_pack(Decimal("10.00"), 0)
+        self.make_pack(Decimal("20.00"), 30)
+        self.make_pack(Decimal("30.00"), 31)
+        self.make_pack(Decimal("40.00"), 75)
+        self.make_pack(Decimal("50.00"), 120)
+        self.make_pack(Decimal("0.00"), 120)
+
+        with self.assertNumQueries(1):
+            summary = debt_summary(Pack.objects.filter(school=self.school), today=self.today)
+
+        self.assertEqual(summary["current_debt"], "150.00")
+        self.assertEqual(summary["count"], 5)
+        self.assertEqual(summary["aging"], {"0-30": "30.00", "31-60": "30.00", "61-90": "40.00", "90+": "50.00"})
+
+    def test_items_are_paginated_with_labels(self):
+        packs = [self.make_pack(Decimal("10.00"), days_ago) for days_ago in (5, 4, 3)]
+        queryset = Pack.objects.filter(school=self.school)
+
+        with self.assertNumQueries(2):
+            items, has_more = unpaid_pack_items(queryset, page=1, page_size=2, today=self.today)
+        self.assertTrue(has_more)
+        self.assertEqual([item["pack_id"] for item in items], [str(packs[0].id), str(packs[1].id)])
+        self.assertEqual(items[0]["students_name"], packs[0].get_students_name())
+        self.assertEqual(items[0]["description"], str(packs[0]))
+
+        items, has_more = unpaid_pack_items(queryset, page=2, page_size=2, today=self.today)
+        self.assertFalse(has_more)
+        self.assertEqual([item["pack_id"] for item in items], [str(packs[2].id)])
+
+    def test_school_view_lists_every_item_unless_paged(self):
+        for days_ago in range(3):
+            self.make_pack(Decimal("10.00"), days_ago)
+        admin = UserAccount.objects.create(username="admin", current_role="Admin", current_school_id=self.school.id)
+        client = APIClient()
+        client.force_authenticate(admin)
+        url = reverse("school_unpaid_items")
+
+        self.assertEqual(len(client.get(url, {"page_size": 2}).data["data"]), 3)
+        paged = client.get(url, {"page": 1, "page_size": 2}).data
+        self.assertEqual((len(paged["data"]), paged["has_more"]), (2, True))
+        for params in ({"page": "abc"}, {"page": 1, "page_size": "many"}):
+            self.assertEqual(client.get(url, params).status_code, 400)
+
+
+class ReceiptEmailTests(TestCase):
+
+    def test_receipts_sent_in_one_batch(self):
+        school = School.objects.create(name="Test School")
+        user = UserAccount.objects.create(username="parent", first_name="Ana", email="ana@example.com")
+        payments = [
+            Payment.objects.create(value=value, user=user, school=school, description={"method": "card"})
+            for value in (10, 20)
+        ]
+
+        self.assertEqual(Payment.send_receipt_emails(payments), 2)
+
+        self.assertEqual([message.subject for message in mail.outbox],
+                         [f"Payment Receipt - RCP-{payment.id}" for payment in payments])
+        self.assertIn("Thank you for your payment, Ana", mail.outbox[0].alternatives[0][0])
+
+
+class StripeWebhookTests(TestCase):
+
+    def setUp(self):
+        self.school = School.objects.create(name="Test School")
+        self.user = UserAccount.objects.create(username="parent")
+        self.pack = Pack.objects.create(
+            date=date(2025, 3, 3), number_of_classes=4, number_of_classes_left=4, duration_in_minutes=60,
+            price=Decimal("100.00"), debt=Decimal("100.00"), school=self.school,
+        )
+
+    def post_event(self, event, secret=settings.STRIPE_WEBHOOK_SECRET):
+        """Posts the event signed the way Stripe signs webhook payloads."""
+        payload = json.dumps(event)
+        timestamp = int(time.time())
+        signature = hmac.new(secret.encode(), f"{timestamp}.{payload}".encode(), hashlib.sha256).hexdigest()
+        return self.client.post(
+            reverse("stripe_webhook"), payload, content_type="application/json",
+            HTTP_STRIPE_SIGNATURE=f"t={timestamp},v1={signature}",
+        )
+
+    def intent_event(self, event_id="evt_1", user_id=None, amounts=None):
+        return {
+            "id": event_id,
+            "object": "event",
+            "type": "payment_intent.succeeded",
+            "data": {"object": {
+                "id": "pi_1",
+                "object": "payment_intent",
+                "amount": 4000,
+                "amount_received": 4000,
+                "metadata": {
+                    "user_id": str(user_id or self.user.pk),
+                    "pack_ids": json.dumps([self.pack.pk]),
+                    "pack_amounts": json.dumps(amounts if amounts is not None else {str(self.pack.pk): 40.0}),
+                },
+            }},
+        }
+
+    def test_verified_events_are_stored_once(self):
+        self.assertEqual(self.post_event(self.intent_event()).status_code, 200)
+        self.assertEqual(self.post_event(self.intent_event()).status_code, 200)
+        self.assertEqual(self.post_event(self.intent_event("evt_2"), secret="whsec_wrong").status_code, 400)
+
+        self.assertEqual(list(StripeEvent.objects.values_list("event_id", "status")), [("evt_1", StripeEvent.PENDING)])
+        # acknowledged before anything is settled
+        self.assertFalse(Payment.objects.exists())
+
+    def test_worker_settles_the_debt_once(self):
+        self.post_event(self.intent_event())
+        call_command("process_stripe_events", stdout=io.StringIO())
+        self.post_event(self.intent_event())
+        call_command("process_stripe_events", stdout=io.StringIO())
+        self.assertTrue(StripeEvent.objects.get().apply())
+
+        payment = Payment.objects.get()
+        self.assertEqual((payment.value, payment.user, payment.school), (Decimal("40.00"), self.user, self.school))
+        self.assertEqual(list(payment.packs.all()), [self.pack])
+        self.pack.refresh_from_db()
+        self.assertEqual((self.pack.debt, self.pack.is_paid), (Decimal("60.00"), False))
+        event = StripeEvent.objects.get()
+        self.assertEqual((event.status, event.payment), (StripeEvent.PROCESSED, payment))
+
+    def test_receipt_failure_does_not_undo_the_settlement(self):
+        self.post_event(self.intent_event())
+        with mock.patch("payments.models.get_template", side_effect=RuntimeError("template broken")), \
+                self.captureOnCommitCallbacks(execute=True) as callbacks:
+            self.assertTrue(StripeEvent.claim_pending()[0].apply())
+
+        self.assertEqual(len(callbacks), 1)
+        payment = Payment.objects.get()
+        self.assertFalse(PaymentReceipt.objects.exists())
+        client = APIClient()
+        client.force_authenticate(self.user)
+        self.assertEqual(client.get(reverse("payment_receipt", args=[payment.pk])).status_code, 200)
+        self.assertTrue(PaymentReceipt.objects.filter(payment=payment).exists())
+
+    def test_receipt_without_pdf_when_rendering_fails(self):
+        html = mock.Mock(return_value=mock.Mock(write_pdf=mock.Mock(side_effect=ValueError("bad font"))))
+        with mock.patch("payments.utils._weasyprint_html", return_value=html):
+            self.assertIsNone(render_receipt_pdf("<p>receipt</p>"))
+
+    def test_debt_record_refuses_card_payments_settled_by_stripe(self):
+        self.post_event(self.intent_event())
+        call_command("process_stripe_events", stdout=io.StringIO())
+        client = APIClient()
+        client.force_authenticate(self.user)
+        url = reverse("create_debt_payment_record")
+        amounts = {str(self.pack.pk): 40.0}
+
+        # what older app builds post after paying by card
+        self.assertEqual(client.post(url, {"pack_amounts": amounts}, format="json").status_code, 409)
+        self.assertEqual(client.post(url, {"pack_amounts": amounts, "user": self.user.pk, "payment_intent": "pi_1"}, format="json").status_code, 409)
+        self.pack.refresh_from_db()
+        self.assertEqual((self.pack.debt, Payment.objects.count()), (Decimal("60.00"), 1))
+
+        # a payment taken outside Stripe
+        self.assertEqual(client.post(url, {"pack_amounts": {str(self.pack.pk): 10.0}, "user": self.user.pk}, format="json").status_code, 201)
+        self.pack.refresh_from_db()
+        self.assertEqual(self.pack.debt, Decimal("50.00"))
+
+    def test_failed_event_is_retried_with_backoff(self):
+        self.post_event(self.intent_event(user_id=999999))
+        call_command("process_stripe_events", stdout=io.StringIO())
+
+        event = StripeEvent.objects.get()
+        self.assertEqual((event.status, event.attempts), (StripeEvent.PENDING, 1))
+        self.assertGreater(event.next_attempt_at, now())
+        self.assertEqual(StripeEvent.claim_pending(), [])
+        self.assertFalse(Payment.objects.exists())
+
+    def test_verify_payment_reads_local_events(self):
+        session_event = {
+            "id": "evt_3",
+            "object": "event",
+            "type": "checkout.session.completed",
+            "data": {"object": {"id": "cs_1", "object": "checkout.session", "payment_status": "paid"}},
+        }
+        with mock.patch("stripe.checkout.Session.retrieve", side_effect=AssertionError("Stripe was called")):
+            before = self.client.get(reverse("verify_payment"), {"session_id": "cs_1"}).json()
+            self.post_event(session_event)
+            after = self.client.get(reverse("verify_payment"), {"session_id": "cs_1"}).json()
+
+        self.assertEqual(before, {"verified": False, "pending": True})
+        self.assertEqual(after, {"verified": True, "pending": False})
+
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp())
+class PaymentReceiptTests(TestCase):
+
+    def setUp(self):
+        self.school = School.objects.create(name="Test School", currency="EUR")
+        self.user = UserAccount.objects.create(username="parent", first_name="Ana", email="ana@example.com")
+        self.student = Student.objects.create(first_name="Rui", last_name="Costa")
+        self.payment = Payment.objects.create(value=Decimal("90.00"), user=self.user, school=self.school, description={"method": "card"})
+        pack = Pack.objects.create(
+            date=date(2025, 3, 3), number_of_classes=4, number_of_classes_left=4, duration_in_minutes=60,
+            price=Decimal("80.00"), debt=0, school=self.school,
+        )
+        camp = CampOrder.objects.create(user=self.user, student=self.student, date=date(2025, 7, 1), time=datetime_time(9), price=Decimal("10.00"))
+        voucher = Voucher.objects.create(user=self.user, expiration_date=date(2025, 12, 31))
+        voucher.packs.add(pack)
+        self.payment.packs.add(pack)
+        self.payment.camp_orders.add(camp)
+        self.payment.vouchers.add(voucher)
+
+    def test_receipt_is_rendered_once_and_kept(self):
+        with CaptureQueriesContext(connection) as context:
+            receipt = Payment.issue_receipts([self.payment])[self.payment.pk]
+        issued_queries = len(context)
+
+        self.assertEqual([item["name"] for item in receipt.data["items"]], [
+            "4 Lessons - 60 min", "Camp for Rui Costa on 2025-07-01", f"Voucher {self.payment.vouchers.get().id} - valid until 2025-12-31",
+        ])
+        self.assertEqual(receipt.data["total_price"], "90.00")
+        self.assertIn("Camp for Rui Costa", receipt.html)
+        self.assertLess(issued_queries, 15)
+
+        # later changes don't alter what was issued
+        self.payment.packs.clear()
+        with CaptureQueriesContext(connection) as context:
+            again = Payment.issue_receipts([self.payment])[self.payment.pk]
+        self.assertEqual(len(context), 1)
+        self.assertEqual((again.pk, len(again.data["items"])), (receipt.pk, 3))
+        self.assertEqual(self.payment.generate_receipt(), receipt.data)
+        with self.assertRaises(ValueError):
+            again.save()
+
+    def test_payer_downloads_the_stored_receipt(self):
+        client = APIClient()
+        client.force_authenticate(self.user)
+
+        with mock.patch("payments.utils.render_receipt_pdf", return_value=b"%PDF-1.7 receipt"):
+            data = client.get(reverse("payment_receipt", args=[self.payment.pk]))
+        html = client.get(reverse("payment_receipt", args=[self.payment.pk]), {"output": "html"})
+        pdf = client.get(reverse("payment_receipt", args=[self.payment.pk]), {"output": "pdf"})
+
+        self.assertEqual(data.json()["receipt_number"], f"RCP-{self.payment.pk}")
+        self.assertContains(html, "Thank you for your payment, Ana")
+        self.assertEqual(b"".join(pdf.streaming_content), b"%PDF-1.7 receipt")
+        self.assertEqual(PaymentReceipt.objects.count(), 1)
+        client.force_authenticate(UserAccount.objects.create(username="stranger"))
+        self.assertEqual(client.get(reverse("payment_receipt", args=[self.payment.pk])).status_code, 404)
+
+
+class PaymentHistoryTests(TestCase):
+
+    def setUp(self):
+        self.school = School.objects.create(name="Test School")
+        self.other_school = School.objects.create(name="Other School")
+        self.user = UserAccount.objects.create(username="parent", current_role="Parent")
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        # two payments a day on the same time, to page through ties on (date, time)
+        for i in range(10):
+            payment = Payment.objects.create(
+                value=Decimal(10 * (i + 1)), user=self.user, description={"n": i},
+                school=self.school if i % 2 else self.other_school,
+            )
+            Payment.objects.filter(pk=payment.pk).update(date=date(2024, 1, 1 + i // 2), time=datetime_time(9))
+        self.pack = Pack.objects.create(
+            date=date(2024, 1, 1), number_of_classes=4, number_of_classes_left=4, duration_in_minutes=60,
+            price=Decimal("80.00"), debt=0, school=self.school,
+        )
+        Payment.objects.order_by("id").first().packs.add(self.pack)
+
+    def test_pages_follow_the_cursor_newest_first(self):
+        url = reverse("payment_history")
+        seen, cursor = [], None
+        while True:
+            params = {"page_size": 3, **({"cursor": cursor} if cursor else {})}
+            with CaptureQueriesContext(connection) as context:
+                response = self.client.get(url, params)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(len([q for q in context if "payments_payment" in q["sql"]]), 1)
+            seen += [item["id"] for item in response.data["data"]]
+            cursor = response.data["next_cursor"]
+            if not response.data["has_more"]:
+                break
+
+        expected = Payment.objects.order_by("-date", "-time", "-id").values_list("id", flat=True)
+        self.assertEqual(seen, [str(pk) for pk in expected])
+
+    def test_filters(self):
+        url = reverse("payment_history")
+
+        def amounts(**params):
+            response = self.client.get(url, params)
+            self.assertEqual(response.status_code, 200)
+            return sorted(Decimal(item["amount"]) for item in response.data)
+
+        self.assertEqual(amounts(date_from="2024-01-04", date_to="2024-01-05"), [70, 80, 90, 100])
+        self.assertEqual(amounts(school=self.school.id, max_amount="60"), [20, 40, 60])
+        self.assertEqual(amounts(min_amount="95"), [100])
+        self.assertEqual(amounts(type="pack"), [10])
+        self.assertEqual(amounts(type="payout"), [])
+        for params in ({"type": "refund"}, {"date_from": "yesterday"}, {"min_amount": "a lot"}, {"cursor": "nope"}):
+            self.assertEqual(self.client.get(url, params).status_code, 400)
+
+    def test_school_history_is_scoped_to_the_admin_school(self):
+        admin = UserAccount.objects.create(username="admin", current_role="Admin", current_school_id=self.school.id)
+        self.client.force_authenticate(admin)
+
+        response = self.client.get(reverse("school_payment_history"), {"min_amount": "50"})
+
+        self.assertEqual([item["amount"] for item in response.data], ["100.00", "80.00", "60.00"])
+        self.assertEqual(response.data[0]["school"], "Test School")
+
+    def test_full_list_unless_the_client_pages(self):
+        url = reverse("payment_history")
+        everything = self.client.get(url).data
+        first_page = self.client.get(url, {"page_size": 2}).data
+
+        self.assertEqual(len(everything), Payment.objects.filter(user=self.user).count())
+        self.assertEqual(first_page["data"], everything[:2])
+        self.assertTrue(first_page["has_more"])
+        self.assertEqual(self.client.get(url, {"page_size": "many"}).status_code, 400)
+
+
+class PayoutBatchTests(TestCase):
+
+    def setUp(self):
+        self.school = School.objects.create(name="Test School")
+        self.other_school = School.objects.create(name="Other School")
+        self.admin = UserAccount.objects.create(username="admin", current_role="Admin", current_school_id=self.school.id)
+        self.school.admins.add(self.admin)
+        self.instructors = []
+        for i in range(3):
+            user = UserAccount.objects.create(username=f"instructor{i}", first_name=f"Instructor {i}")
+            instructor = Instructor.objects.create(user=user)
+            self.school.instructors.add(instructor)
+            self.instructors.append(user)
+        monitor_user = UserAccount.objects.create(username="monitor", first_name="Monitor")
+        self.monitor = Monitor.objects.create(user=monitor_user)
+        self.school.monitors.add(self.monitor)
+
+        self.cutoff = now().date() - timedelta(days=1)
+        for i, user in enumerate(self.instructors):
+            user.update_balance(Decimal(20 * (i + 1)), "Lesson given", school=self.school)
+        self.instructors[0].update_balance(Decimal("5.00"), "Lesson elsewhere", school=self.other_school)
+        monitor_user.update_balance(Decimal("15.00"), "Camp day", school=self.school)
+        BalanceEntry.objects.update(created_at=now() - timedelta(days=2))
+        # earned after the cutoff: stays owed
+        self.instructors[1].update_balance(Decimal("7.00"), "Lesson today", school=self.school)
+
+    def test_pays_everyone_up_to_the_cutoff_in_fixed_queries(self):
+        with CaptureQueriesContext(connection) as context:
+            summary = run_payout_batch(self.school, self.cutoff, paid_by=self.admin)
+        statements = [q["sql"] for q in context if not q["sql"].startswith(("SAVEPOINT", "RELEASE"))]
+
+        self.assertEqual(len(statements), 5)
+        self.assertEqual(summary["total"], "135.00")
+        self.assertEqual(
+            {row["name"].strip(): (row["amount"], row["balance_after"]) for row in summary["payouts"]},
+            {
+                "Instructor 0": ("20.00", "5.00"),
+                "Instructor 1": ("40.00", "7.00"),
+                "Instructor 2": ("60.00", "0.00"),
+                "Monitor": ("15.00", "0.00"),
+            },
+        )
+        payouts = Payment.objects.filter(school=self.school)
+        self.assertEqual(payouts.count(), 4)
+        self.assertEqual(payouts.get(monitor=self.monitor).value, Decimal("15.00"))
+        self.assertEqual(
+            [u.balance for u in UserAccount.objects.filter(pk__in=[u.pk for u in self.instructors]).order_by("pk")],
+            [Decimal("5.00"), Decimal("7.00"), Decimal("0.00")],
+        )
+        history = json.loads(self.instructors[1].get_balance_history_since_last_payout(school=self.school))
+        self.assertEqual([entry["message"] for entry in history], ["Lesson today"])
+
+        # nothing is owed up to the same cutoff anymore
+        again = run_payout_batch(self.school, self.cutoff)
+        self.assertEqual((again["paid_count"], again["total"]), (0, "0.00"))
+        self.assertEqual(Payment.objects.count(), 4)
+
+    def test_admin_runs_the_batch(self):
+        client = APIClient()
+        client.force_authenticate(self.admin)
+
+        response = client.post(reverse("payout_batch"), {"cutoff": self.cutoff.isoformat()}, format="json")
+
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual((response.data["paid_count"], response.data["staff_count"]), (4, 5))
+        self.assertEqual(client.post(reverse("payout_batch"), {"cutoff": "soon"}, format="json").status_code, 400)
+        client.force_authenticate(self.instructors[0])
+        self.assertEqual(client.post(reverse("payout_batch")).status_code, 403)
@@ -1,5 +1,5 @@
 from django.urls import path
-from .views import create_checkout_session_view, create_debt_payment_intent_view, create_debt_payment_record_view, create_payment_intent_view, instructor_payment_history, payment_history_view, payment_success, payment_failed, my_webhook_view, payments_debt_view, redulate_debt_view, school_payment_history_view, school_unpaid_items_view, test_payment, new_payment, unpaid_items_view, upcoming_payouts_view, verify_payment
+from .views import create_checkout_session_view, create_debt_payment_intent_view, create_debt_payment_record_view, create_payment_intent_view, instructor_payment_history, payment_history_view, payment_receipt_view, payment_success, payment_failed, payout_batch_view, my_webhook_view, payments_debt_view, redulate_debt_view, school_payment_history_view, school_unpaid_items_view, test_payment, new_payment, unpaid_items_view, upcoming_payouts_view, verify_payment
 
 urlpatterns = [
     path("payment-success/", payment_success, name="payment_success"),
@@ -13,11 +13,13 @@ urlpatterns = [
     path('debt/', payments_debt_view, name='payments_debt'),
     path('unpaid_items/', unpaid_items_view, name='unpaid_items'),
     path('history/', payment_history_view, name='payment_history'),
+    path('receipt/<int:payment_id>/', payment_receipt_view, name='payment_receipt'),
     path('redulate_debt/', redulate_debt_view, name='redulate_debt'),
     path('instructor_payment_history/', instructor_payment_history, name='instructor_payment_history'),
     path('school_unpaid_items/', school_unpaid_items_view, name='school_unpaid_items'),
     path('upcoming_payouts/', upcoming_payouts_view, name='upcoming_payouts'),
+    path('payout_batch/', payout_batch_view, name='payout_batch'),
     path('school_payment_history/', school_payment_history_view, name='school_payment_history'),
-    path('create_debt_payment_intent/', create_debt_payment_intent_view, name='school_payment_history'),
+    path('create_debt_payment_intent/', create_debt_payment_intent_view, name='create_debt_payment_intent'),
     path('create_debt_payment_record/', create_debt_payment_record_view, name='create_debt_payment_record'),
 ]
@@ -1,11 +1,27 @@
 import stripe
+import base64
 import json
+import logging
+from datetime import datetime, timedelta
+from decimal import Decimal, InvalidOperation
+from functools import lru_cache
+import numpy as np
 from django.conf import settings
-from users.models import UserAccount
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Case, Count, Exists, F, OuterRef, Prefetch, Q, Subquery, Sum, Value, When
+from django.utils.dateparse import parse_date, parse_time
+from django.utils.timezone import make_aware, now
+from users.models import BalanceEntry, Student, UserAccount
+from payments.models import Payment
+from users.utils import get_users_name
 from schools.models import School
-from lessons.models import Pack
+from lessons.models import Lesson, Pack
+from schools.pricing import quote_cart
 from django.views.decorators.csrf import csrf_exempt
 
+logger = logging.getLogger(__name__)
+
 stripe.api_key = settings.STRIPE_SECRET_KEY  # Store this in settings.py
 
 @csrf_exempt
@@ -14,13 +30,26 @@ def create_checkout_session(user, cart, discount=0):
     Creates a Stripe Checkout session for the user's cart.
     """
     line_items = []
-    total_price = 0
+    total_price = Decimal(0)
+
+    schools = {school.name: school for school in School.objects.filter(name__in={item.get("school_name") for item in cart})}
+    quotes, _ = quote_cart([
+        {
+            "school": schools.get(item.get("school_name")),
+            "type": item["type"],
+            "duration_in_minutes": item["duration_in_minutes"],
+            "number_of_students": len(item["student_ids_list"]),
+            "number_of_classes": item["number_of_classes"],
+        }
+        for item in cart
+    ])
 
-    for item in cart:
+    for item, quote in zip(cart, quotes):
         pack_type = item["type"]  # "group_pack" or "private_pack"
         num_classes = item["number_of_classes"]
         duration = item["duration_in_minutes"]
-        price = item["price"]  # Price BEFORE discount
+        # Price BEFORE discount, the school's own price when it has one
+        price = quote if quote is not None else Decimal(str(item["price"]))
         student_ids_list = item["student_ids_list"]
 
         total_price += price  # Sum up total price
@@ -40,7 +69,7 @@ def create_checkout_session(user, cart, discount=0):
         })
 
     # Apply discount to total
-    final_price = max(0, total_price - discount)
+    final_price = max(0, total_price - Decimal(str(discount)))
 
     session = stripe.checkout.Session.create(
         payment_method_types=["card"],
@@ -58,3 +87,449 @@ def create_checkout_session(user, cart, discount=0):
     print("Created session:", session)  # or use logging.info
 
     return session.url
+
+
+REVENUE_FORECAST_CACHE_KEY = "revenue_forecast:{school_id}"
+REVENUE_FORECAST_TIMEOUT = 60 * 60  # bounds staleness from lesson (re)scheduling
+
+
+def forecast_school_revenue(school_id, weeks=12, start=None):
+    """
+    Projects the expected cash-in per week for a school, starting on the
+    Monday of the current week.
+
+    Every pack with outstanding debt is expected to pay it off evenly across
+    its remaining classes: each scheduled-but-not-done lesson inside the
+    horizon brings in debt / number_of_classes_left in its week, and whatever
+    is not covered by scheduled lessons is expected by the pack's expiration
+    date (in the first week if the pack already expired). Debt of packs with
+    no expiration date and nothing scheduled is reported as "unscheduled".
+    """
+    start = start or now().date()
+    week_start = start - timedelta(days=start.weekday())
+    horizon_end = week_start + timedelta(weeks=weeks)
+    origin = np.datetime64(week_start, "D")
+
+    weekly_lessons = np.zeros(weeks)
+    weekly_expiring = np.zeros(weeks)
+    beyond_horizon = unscheduled = total_debt = 0.0
+
+    packs = list(
+        Pack.objects.filter(school_id=school_id, debt__gt=0, is_suspended=False)
+        .order_by("id")
+        .values_list("id", "debt", "number_of_classes_left", "expiration_date")
+    )
+    if packs:
+        pack_ids, debts, classes_left, expirations = zip(*packs)
+        pack_ids = np.array(pack_ids)
+        debts = np.array(debts, dtype=float)
+        classes_left = np.array(classes_left, dtype=float)
+        total_debt = debts.sum()
+
+        # One row per (pack, lesson date) with the number of pending lessons.
+        lesson_rows = list(
+            Lesson.objects.filter(
+                packs__school_id=school_id,
+                packs__debt__gt=0,
+                packs__is_suspended=False,
+                is_done=False,
+                date__gte=start,
+                date__lt=horizon_end,
+            )
+            .values_list("packs", "date")
+            .annotate(count=Count("id"))
+        )
+        scheduled = np.zeros(len(pack_ids))
+        if lesson_rows:
+            lesson_pack_ids, lesson_dates, counts = zip(*lesson_rows)
+            pack_index = np.searchsorted(pack_ids, np.array(lesson_pack_ids))
+            counts = np.array(counts, dtype=float)
+            scheduled = np.bincount(pack_index, weights=counts, minlength=len(pack_ids))
+
+        share = debts / np.maximum(np.maximum(classes_left, scheduled), 1)
+        if lesson_rows:
+            lesson_weeks = (np.array(lesson_dates, dtype="datetime64[D]") - origin).astype(int) // 7
+            weekly_lessons = np.bincount(lesson_weeks, weights=counts * share[pack_index], minlength=weeks)
+
+        remainder = np.clip(debts - scheduled * share, 0, None)
+        has_expiration = np.array([d is not None for d in expirations])
+        expiration_days = np.array(
+            [d if d is not None else week_start for d in expirations], dtype="datetime64[D]"
+        )
+        expiration_weeks = np.clip((expiration_days - origin).astype(int) // 7, 0, None)
+        in_horizon = has_expiration & (expiration_weeks < weeks)
+
+        weekly_expiring = np.bincount(
+            expiration_weeks[in_horizon], weights=remainder[in_horizon], minlength=weeks
+        )
+        beyond_horizon = remainder[has_expiration & ~in_horizon].sum()
+        unscheduled = remainder[~has_expiration].sum()
+
+    weekly_total = weekly_lessons + weekly_expiring
+    return {
+        "school_id": school_id,
+        "generated_on": start.isoformat(),
+        "weeks": [
+            {
+                "week_start": (week_start + timedelta(weeks=i)).isoformat(),
+                "from_scheduled_lessons": f"{weekly_lessons[i]:.2f}",
+                "from_expiring_packs": f"{weekly_expiring[i]:.2f}",
+                "expected": f"{weekly_total[i]:.2f}",
+            }
+            for i in range(weeks)
+        ],
+        "beyond_horizon": f"{beyond_horizon:.2f}",
+        "unscheduled": f"{unscheduled:.2f}",
+        "total_outstanding_debt": f"{total_debt:.2f}",
+    }
+
+
+def get_revenue_forecast(school_id, weeks=12):
+    """
+    Returns the revenue forecast for a school, served from the cache while it
+    is still from today and no Payment or Pack of the school has changed.
+    """
+    key = REVENUE_FORECAST_CACHE_KEY.format(school_id=school_id)
+    forecasts = cache.get(key) or {}
+    today = now().date().isoformat()
+
+    forecast = forecasts.get(weeks)
+    if forecast is None or forecast["generated_on"] != today:
+        forecast = forecast_school_revenue(school_id, weeks=weeks)
+        forecasts[weeks] = forecast
+        cache.set(key, forecasts, REVENUE_FORECAST_TIMEOUT)
+    return forecast
+
+
+def invalidate_revenue_forecast(school_id):
+    cache.delete(REVENUE_FORECAST_CACHE_KEY.format(school_id=school_id))
+
+
+DEBT_PAGE_SIZE = 50
+# (label, min age in days, max age in days), age counted from the pack date
+DEBT_AGING_BUCKETS = (
+    ("0-30", None, 30),
+    ("31-60", 31, 60),
+    ("61-90", 61, 90),
+    ("90+", 91, None),
+)
+
+
+def debt_summary(packs, today=None):
+    """
+    Totals the outstanding debt of a Pack queryset and splits it into aging
+    buckets, all in a single aggregate query.
+    """
+    today = today or now().date()
+    aggregates = {"total": Sum("debt"), "count": Count("id")}
+    for label, min_age, max_age in DEBT_AGING_BUCKETS:
+        bucket = Q()
+        if min_age is not None:
+            bucket &= Q(date__lte=today - timedelta(days=min_age))
+        if max_age is not None:
+            bucket &= Q(date__gt=today - timedelta(days=max_age + 1))
+        aggregates[label] = Sum("debt", filter=bucket)
+
+    result = packs.filter(debt__gt=0).aggregate(**aggregates)
+    return {
+        "current_debt": f"{result['total'] or 0:.2f}",
+        "count": result["count"],
+        "aging": {
+            label: f"{result[label] or 0:.2f}" for label, _, _ in DEBT_AGING_BUCKETS
+        },
+    }
+
+
+def unpaid_pack_items(packs, page=None, page_size=DEBT_PAGE_SIZE, today=None):
+    """
+    Lists the packs with outstanding debt, oldest first, with their labels
+    (students' names and the str(pack) description) computed from one
+    annotated query plus one prefetch instead of several queries per pack.
+
+    Returns (items, has_more). Without a page every item is returned.
+    """
+    today = today or now().date()
+    packs = (
+        packs.filter(debt__gt=0)
+        .annotate(
+            scheduled_lessons=Count(
+                "lessons_many",
+                filter=Q(lessons_many__date__isnull=False, lessons_many__start_time__isnull=False),
+                distinct=True,
+            ),
+            unscheduled_private_lessons=Count(
+                "lessons_many",
+                filter=Q(lessons_many__is_done=False) & (
+                    Q(lessons_many__date__lt=today)
+                    | Q(lessons_many__date=None)
+                    | Q(lessons_many__start_time=None)
+                ),
+                distinct=True,
+            ),
+        )
+        .prefetch_related(Prefetch("students", queryset=Student.objects.order_by("id")))
+        .order_by("date", "id")
+    )
+
+    has_more = False
+    if page is not None:
+        start = (page - 1) * page_size
+        # one extra row tells whether there is a next page without a COUNT
+        packs = list(packs[start:start + page_size + 1])
+        has_more = len(packs) > page_size
+        packs = packs[:page_size]
+
+    items = []
+    for pack in packs:
+        students_name = get_users_name(list(pack.students.all()))
+        if pack.type == "private":
+            unscheduled = pack.unscheduled_private_lessons
+        elif pack.type == "group":
+            unscheduled = max(pack.number_of_classes - pack.scheduled_lessons, 0)
+        else:
+            unscheduled = None
+        items.append({
+            "pack_id": str(pack.id),
+            "students_name": students_name,
+            "date": pack.date.strftime("%Y-%m-%d") if pack.date else "",
+            "time": pack.date_time.strftime("%H:%M") if pack.date_time else "09:00",
+            "description": f"{pack.type} pack for {students_name}, {pack.number_of_classes_left}/{pack.number_of_classes} lessons left, {unscheduled} number of unscheduled lessons",
+            "amount": f"{pack.debt:.2f}",
+        })
+    return items, has_more
+
+
+HISTORY_PAGE_SIZE = 50
+# ?type= of the history endpoints -> the Payment relation that marks it
+PAYMENT_HISTORY_TYPES = {
+    "pack": "packs",
+    "lesson": "lessons",
+    "camp": "camp_orders",
+    "activity": "activities",
+    "party": "birthday_parties",
+    "voucher": "vouchers",
+}
+
+
+def encode_history_cursor(payment):
+    raw = f"{payment.date.isoformat()}|{payment.time.isoformat()}|{payment.id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_history_cursor(cursor):
+    try:
+        day, time, pk = base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+        day, time, pk = parse_date(day), parse_time(time), int(pk)
+    except (ValueError, UnicodeError):
+        raise ValueError("Invalid cursor.")
+    if day is None or time is None:
+        raise ValueError("Invalid cursor.")
+    return day, time, pk
+
+
+def filter_payment_history(payments, params):
+    """
+    Applies the history filters found in params (request.GET): date_from,
+    date_to, school, min_amount, max_amount and type (one of
+    PAYMENT_HISTORY_TYPES or "payout"). Raises ValueError on a bad value.
+    """
+    for param, lookup in (("date_from", "date__gte"), ("date_to", "date__lte")):
+        if params.get(param):
+            try:
+                day = parse_date(params[param])
+            except ValueError:
+                day = None
+            if day is None:
+                raise ValueError(f"{param} must be a YYYY-MM-DD date.")
+            payments = payments.filter(**{lookup: day})
+
+    if params.get("school"):
+        try:
+            payments = payments.filter(school_id=int(params["school"]))
+        except ValueError:
+            raise ValueError("school must be a school id.")
+
+    for param, lookup in (("min_amount", "value__gte"), ("max_amount", "value__lte")):
+        if params.get(param):
+            try:
+                payments = payments.filter(**{lookup: Decimal(params[param])})
+            except InvalidOperation:
+                raise ValueError(f"{param} must be a number.")
+
+    payment_type = params.get("type")
+    if payment_type == "payout":
+        payments = payments.filter(Q(instructor__isnull=False) | Q(monitor__isnull=False))
+    elif payment_type in PAYMENT_HISTORY_TYPES:
+        # EXISTS on the through table keeps one row per payment, no DISTINCT
+        through = getattr(payments.model, PAYMENT_HISTORY_TYPES[payment_type]).through
+        payments = payments.filter(Exists(through.objects.filter(payment_id=OuterRef("pk"))))
+    elif payment_type:
+        raise ValueError(f"type must be one of: {', '.join([*PAYMENT_HISTORY_TYPES, 'payout'])}.")
+    return payments
+
+
+def payment_history_page(payments, params, page_size=HISTORY_PAGE_SIZE):
+    """
+    One page of a filtered Payment queryset, newest first, using keyset
+    pagination on (date, time, id): ?cursor= is the next_cursor of the
+    previous page, so every page costs the same index range scan however
+    deep it is. page_size=None returns every row in one page.
+
+    Returns (items, next_cursor); next_cursor is None on the last page.
+    Raises ValueError on a bad filter or cursor.
+    """
+    payments = filter_payment_history(payments, params)
+    if params.get("cursor"):
+        day, time, pk = decode_history_cursor(params["cursor"])
+        payments = payments.filter(
+            Q(date__lt=day)
+            | Q(date=day, time__lt=time)
+            | Q(date=day, time=time, id__lt=pk)
+        )
+
+    # one extra row tells whether there is a next page without a COUNT
+    payments = payments.select_related("school").order_by("-date", "-time", "-id")
+    payments = list(payments[:page_size + 1] if page_size else payments)
+    next_cursor = None
+    if page_size and len(payments) > page_size:
+        next_cursor = encode_history_cursor(payments[page_size - 1])
+        payments = payments[:page_size]
+
+    items = []
+    for pay in payments:
+        items.append({
+            "id": str(pay.id),
+            "date": pay.date.strftime("%Y-%m-%d"),
+            "time": pay.time.strftime("%H:%M"),
+            "school": pay.school.name if pay.school else "",
+            "description": pay.description,
+            "amount": str(pay.value),
+        })
+    return items, next_cursor
+
+
+def run_payout_batch(school, cutoff, paid_by=None):
+    """
+    Pays out every staff member (admin, instructor or monitor) of the school
+    what they earned there since their last payout, up to the end of the
+    cutoff date.
+
+    In one transaction: the staff rows are locked, the amounts owed come
+    from a single aggregate over the balance ledger, the payout Payments and
+    their ledger markers are bulk created and the paid amounts are taken off
+    the balances with one conditional UPDATE, so running it twice for the
+    same cutoff pays nothing the second time.
+
+    Returns the payout summary document.
+    """
+    cutoff_at = min(make_aware(datetime.combine(cutoff, datetime.max.time())), now())
+    staff_ids = UserAccount.objects.filter(
+        Q(school_admins=school) | Q(instructor_profile__schools=school) | Q(monitor_profile__schools=school)
+    ).values("pk")
+
+    with transaction.atomic():
+        staff = {
+            row["pk"]: row
+            for row in UserAccount.objects.select_for_update(of=("self",))
+            .filter(pk__in=staff_ids)
+            .values("pk", "first_name", "last_name", "balance", "instructor_profile", "monitor_profile")
+        }
+
+        previous_payouts = BalanceEntry.objects.filter(user=OuterRef("user"), school=school, is_payout=True)
+        last_payout_at = previous_payouts.order_by("-created_at").values("created_at")[:1]
+        owed = (
+            BalanceEntry.objects.filter(
+                user__in=list(staff), school=school, is_payout=False, created_at__lte=cutoff_at,
+            )
+            .filter(Q(created_at__gt=Subquery(last_payout_at)) | ~Exists(previous_payouts))
+            .values("user")
+            .annotate(amount=Sum("amount"), entries=Count("id"))
+            .filter(amount__gt=0)
+            .order_by("user")
+        )
+        owed = {row["user"]: row for row in owed}
+
+        payouts = []
+        if owed:
+            UserAccount.objects.filter(pk__in=owed).update(balance=F("balance") - Case(
+                *[When(pk=user_id, then=Value(row["amount"])) for user_id, row in owed.items()],
+                default=Value(Decimal("0.00")),
+            ))
+            payments = Payment.objects.bulk_create([
+                Payment(
+                    value=row["amount"],
+                    user_id=user_id,
+                    school=school,
+                    instructor_id=staff[user_id]["instructor_profile"],
+                    monitor_id=None if staff[user_id]["instructor_profile"] else staff[user_id]["monitor_profile"],
+                    description={
+                        "type": "payout",
+                        "cutoff": cutoff.isoformat(),
+                        "entries": row["entries"],
+                        "paid_by": paid_by.pk if paid_by else None,
+                    },
+                )
+                for user_id, row in owed.items()
+            ])
+            # the markers close the paid period at the cutoff, so entries
+            # recorded after it stay owed for the next run
+            BalanceEntry.objects.bulk_create([
+                BalanceEntry(
+                    user_id=payment.user_id,
+                    school=school,
+                    amount=-payment.value,
+                    balance_after=staff[payment.user_id]["balance"] - payment.value,
+                    message=f"Payout of {payment.value}",
+                    is_payout=True,
+                    payment=payment,
+                    created_at=cutoff_at,
+                )
+                for payment in payments
+            ])
+            for payment in payments:
+                row = staff[payment.user_id]
+                payouts.append({
+                    "user_id": str(payment.user_id),
+                    "name": f"{row['first_name']} {row['last_name']}",
+                    "payment_id": str(payment.pk),
+                    "entries": owed[payment.user_id]["entries"],
+                    "amount": f"{payment.value:.2f}",
+                    "balance_after": f"{row['balance'] - payment.value:.2f}",
+                })
+
+    return {
+        "school": school.name,
+        "cutoff": cutoff.isoformat(),
+        "paid_at": now().isoformat(),
+        "staff_count": len(staff),
+        "paid_count": len(payouts),
+        "total": f"{sum((row['amount'] for row in owed.values()), Decimal('0.00')):.2f}",
+        "currency": school.currency,
+        "payouts": payouts,
+    }
+
+
+@lru_cache(maxsize=None)
+def _weasyprint_html():
+    try:
+        from weasyprint import HTML
+    except (ImportError, OSError) as e:
+        logger.warning("Receipt PDFs are disabled, WeasyPrint can't be loaded: %s", e)
+        return None
+    return HTML
+
+
+def render_receipt_pdf(html):
+    """
+    PDF of a rendered receipt, or None where WeasyPrint can't run (it needs
+    the Pango system libraries, which are not installed everywhere) or fails
+    on the document; the receipt is then issued without a PDF.
+    """
+    HTML = _weasyprint_html()
+    if HTML is None:
+        return None
+    try:
+        return HTML(string=html).write_pdf()
+    except Exception:
+        logger.exception("Failed to render a receipt PDF")
+        return None
@@ -1,6 +1,6 @@
 from decimal import Decimal
 from events.models import Activity, BirthdayParty, CampOrder
-from payments.models import Payment
+from payments.models import Payment, StripeEvent
 from rest_framework.decorators import api_view, permission_classes
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
@@ -14,12 +14,12 @@ from users.models import Instructor, Monitor, Student, UserAccount
 from schools.models import School
 from lessons.models import Lesson, Pack, Voucher
 from mylessons import settings
-from .utils import create_checkout_session
+from .utils import DEBT_PAGE_SIZE, HISTORY_PAGE_SIZE, create_checkout_session, debt_summary, payment_history_page, run_payout_batch, unpaid_pack_items
 import logging
 from datetime import datetime, timedelta
 from django.utils.timezone import now
 from django.db import transaction
-from django.http import HttpResponse
+from django.http import FileResponse, HttpResponse
 from django.db.models import Q
 
 
@@ -29,6 +29,38 @@ stripe.api_key = settings.STRIPE_SECRET_KEY
 
 #stripe listen --forward-to 127.0.0.1:8000/stripe/webhook
 
+
+def _get_page(request):
+    """?page= as an int, None if absent. Raises ValueError if it isn't a number."""
+    page = request.GET.get('page')
+    return max(1, int(page)) if page else None
+
+
+def _get_page_size(request, default=DEBT_PAGE_SIZE):
+    return min(100, max(1, int(request.GET.get('page_size', default))))
+
+
+def _payment_history_response(request, payments):
+    """
+    The filtered history as a plain list of every row, as the app reads it,
+    or, once the client sends ?cursor= or ?page_size=, one keyset page with
+    its next_cursor.
+    """
+    paginated = "cursor" in request.GET or "page_size" in request.GET
+    try:
+        data, next_cursor = payment_history_page(
+            payments, request.GET, page_size=_get_page_size(request, HISTORY_PAGE_SIZE) if paginated else None
+        )
+    except ValueError as e:
+        return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+    if not paginated:
+        return Response(data, status=status.HTTP_200_OK)
+    return Response({
+        "data": data,
+        "next_cursor": next_cursor,
+        "has_more": next_cursor is not None,
+    }, status=status.HTTP_200_OK)
+
 @api_view(['POST'])
 @permission_classes([IsAuthenticated])
 def new_payment(request):
@@ -110,6 +142,10 @@ def new_payment(request):
                 payment.monitor = Monitor.objects.get(id=monitor_id)
 
             payment.save()
+
+            payout_user = payment.get_payout_user()
+            if payout_user:
+                payout_user.record_payout(payment)
             
             # Send receipt email using Payment model's method
             payment.send_receipt_email()
@@ -219,6 +255,8 @@ def create_debt_payment_intent_view(request):
                 metadata={
                     "user_id": str(request.user.id) if request.user.is_authenticated else "anonymous",
                     "pack_ids": json.dumps(pack_ids),
+                    # settled by the payment_intent.succeeded webhook (StripeEvent)
+                    "pack_amounts": json.dumps(data.get("amounts")),
                 }
             )
             return JsonResponse({"clientSecret": intent.client_secret}, status=200)
@@ -278,15 +316,29 @@ def create_debt_payment_record_view(request):
     and each pack’s debt is updated with its corresponding amount.
     Otherwise, the total is calculated based on each pack’s full price.
 
+    This records payments made outside Stripe for a "user" (e.g. cash taken
+    by the school). Card payments are settled from Stripe's
+    payment_intent.succeeded event, so a record without a "user" (what
+    older app builds posted after paying by card) or for a
+    "payment_intent" Stripe has already notified is refused with a 409
+    rather than lowering the debt a second time.
+
     Returns a JSON response with a success message and the new payment's ID.
     """
     data = request.data
     pack_amounts = data.get("pack_amounts", None)
+    payment_intent = data.get("payment_intent")
+    if payment_intent and StripeEvent.objects.filter(
+        object_id=payment_intent, type=StripeEvent.PAYMENT_INTENT_SUCCEEDED
+    ).exists():
+        return Response({"error": "This payment was already recorded from Stripe."}, status=status.HTTP_409_CONFLICT)
     user = data.get("user", None)
     if user is None:
-        user = request.user
-    else:
-        user = UserAccount.objects.get(pk=user)
+        return Response(
+            {"error": "Card payments are recorded from Stripe; only payments for a user can be added here."},
+            status=status.HTTP_409_CONFLICT,
+        )
+    user = UserAccount.objects.get(pk=user)
 
     if pack_amounts:
         # Expecting pack_amounts to be a mapping (keys as pack IDs, values as amounts).
@@ -345,6 +397,8 @@ def create_debt_payment_record_view(request):
         else:
             pack.update_debt(pack.debt)
 
+    Payment.issue_receipts_on_commit([payment])
+
     return Response(
         {
             "message": "Debt payment record created successfully.",
@@ -370,21 +424,17 @@ def payment_failed(request):
 
 # TODO now seccess and cancel url and views
 
-stripe.api_key = 'sk_test_51QmkhlJwT5CCGmges88003pOz7TdN6vzhZquphq13zUEAm9PJqncJU7kcYgKhpYu1cUGjlIsPveyXYn7hKjpOnhG00jYIoinVr'
-endpoint_secret = 'whsec_5EcGjLPpcfMjRNDpGVbahPjQWAyZgGmZ'
-
-# Using Django
 @csrf_exempt
 def my_webhook_view(request):
-    logger.debug("WEBHOOK WAS HIT!!")
+    """
+    Stripe webhook. Verified events are stored once per event id and
+    acknowledged right away; the process_stripe_events worker applies them.
+    """
     payload = request.body
-    sig_header = request.META['HTTP_STRIPE_SIGNATURE']
-    event = None
+    sig_header = request.META.get('HTTP_STRIPE_SIGNATURE', '')
 
     try:
-        event = stripe.Webhook.construct_event(
-        payload, sig_header, endpoint_secret
-        )
+        stripe.Webhook.construct_event(payload, sig_header, settings.STRIPE_WEBHOOK_SECRET)
     except ValueError as e:
         # Invalid payload
         logger.debug('Error parsing payload: {}'.format(str(e)))
@@ -394,42 +444,55 @@ def my_webhook_view(request):
         logger.debug('Error verifying webhook signature: {}'.format(str(e)))
         return HttpResponse(status=400)
 
-    # Handle the event
-    if event.type == 'payment_intent.succeeded':
-        payment_intent = event.data.object # contains a stripe.PaymentIntent
-        logger.debug('PaymentIntent was successful!')
-    elif event.type == 'payment_method.attached':
-        payment_method = event.data.object # contains a stripe.PaymentMethod
-        logger.debug('PaymentMethod was attached to a Customer!')
-    # ... handle other event types
-    else:
-        logger.debug('Unhandled event type {}'.format(event.type))
-
+    event, created = StripeEvent.record(json.loads(payload))
+    logger.debug('Stripe event %s %s', event.event_id, 'stored' if created else 'already stored')
     return HttpResponse(status=200)
 
 @csrf_exempt
 def verify_payment(request):
+    """
+    Whether a Checkout Session (session_id) or a PaymentIntent
+    (payment_intent) was paid, from the webhook events received so far.
+    "pending" is true while Stripe hasn't notified us yet.
+    """
     session_id = request.GET.get("session_id")
-    if not session_id:
+    payment_intent_id = request.GET.get("payment_intent")
+    if not session_id and not payment_intent_id:
         return JsonResponse({"error": "No session_id provided."}, status=400)
 
-    try:
-        # Set your secret key
-        stripe.api_key = settings.STRIPE_SECRET_KEY
-
-        # Retrieve the Checkout Session
-        session = stripe.checkout.Session.retrieve(session_id)
-
-        # Check the payment status.
-        # The session object has a 'payment_status' field that should be 'paid' if successful.
-        if session.payment_status == "paid":
-            return JsonResponse({"verified": True})
-        else:
-            return JsonResponse({"verified": False})
-    except Exception as e:
-        return JsonResponse({"error": str(e)}, status=500)
+    if session_id:
+        events = StripeEvent.objects.filter(object_id=session_id, type__in=StripeEvent.CHECKOUT_SESSION_TYPES)
+        verified = any(event.data_object.get("payment_status") == "paid" for event in events)
+    else:
+        events = StripeEvent.objects.filter(object_id=payment_intent_id, type=StripeEvent.PAYMENT_INTENT_SUCCEEDED)
+        verified = events.exists()
+    return JsonResponse({"verified": verified, "pending": not verified})
     
     
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def payment_receipt_view(request, payment_id):
+    """
+    The stored receipt of a payment, for its payer or the school's admins:
+    its details as JSON, or ?output=html / ?output=pdf for the rendered copy.
+    """
+    payment = Payment.objects.filter(
+        Q(user=request.user) | Q(school__admins=request.user), pk=payment_id,
+    ).distinct().first()
+    if payment is None:
+        return Response({"detail": "Payment not found."}, status=status.HTTP_404_NOT_FOUND)
+
+    receipt = Payment.issue_receipts([payment])[payment.pk]
+    output = request.GET.get("output")
+    if output == "html":
+        return HttpResponse(receipt.html, content_type="text/html")
+    if output == "pdf":
+        if not receipt.pdf:
+            return Response({"detail": "No PDF is available for this receipt."}, status=status.HTTP_404_NOT_FOUND)
+        return FileResponse(receipt.pdf.open("rb"), content_type="application/pdf", filename=f"{receipt.number}.pdf")
+    return Response(receipt.data, status=status.HTTP_200_OK)
+
+
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
 def payments_debt_view(request):
@@ -441,9 +504,8 @@ def payments_debt_view(request):
     if getattr(user, 'current_role', None) != "Parent":
         return Response({"detail": "This endpoint is not available for your role."}, status=status.HTTP_200_OK)
     
-    unpaid_packs = Pack.objects.filter(parents=user, debt__gt=0)
-    total_debt = sum([pack.debt for pack in unpaid_packs]) if unpaid_packs.exists() else Decimal('0.00')
-    return Response({"current_debt": str(total_debt)}, status=status.HTTP_200_OK)
+    summary = debt_summary(Pack.objects.filter(parents=user))
+    return Response({"current_debt": summary["current_debt"], "aging": summary["aging"]}, status=status.HTTP_200_OK)
 
 
 @api_view(['GET'])
@@ -458,16 +520,11 @@ def unpaid_items_view(request):
     if getattr(user, 'current_role', None) != "Parent":
         return Response({"detail": "This endpoint is not available for your role."}, status=status.HTTP_200_OK)
     
-    unpaid_packs = Pack.objects.filter(parents=user, debt__gt=0)
-    items = []
-    for pack in unpaid_packs:
-        items.append({
-            "pack_id": str(pack.id),
-            "date": pack.date.strftime("%Y-%m-%d") if pack.date else "",
-            "time": pack.date_time.strftime("%H:%M") if pack.date_time else "09:00",
-            "description": str(pack),  # Adjust as needed.
-            "amount": str(pack.debt) if pack.debt else "0.00",
-        })
+    try:
+        page = _get_page(request)
+    except ValueError:
+        return Response({"error": "page must be an integer."}, status=status.HTTP_400_BAD_REQUEST)
+    items, _ = unpaid_pack_items(Pack.objects.filter(parents=user), page=page)
     return Response(items, status=status.HTTP_200_OK)
 
 
@@ -475,31 +532,23 @@ def unpaid_items_view(request):
 @permission_classes([IsAuthenticated])
 def payment_history_view(request):
     """
-    Returns the full payment history for the current user.
-    For Parent users, for each Payment, returns:
+    Returns the current Parent user's payment history, newest first, one
+    page at a time: ?cursor= (the previous page's next_cursor) and
+    ?page_size=, filtered by ?date_from=, ?date_to=, ?school=,
+    ?min_amount=, ?max_amount= and ?type=.
+    For each Payment, returns:
+      - id
       - date (formatted as "YYYY-MM-DD")
       - time (formatted as "HH:mm")
       - school (the school name, if available)
       - description (which is a JSON field or string)
       - amount
-    Filtering is done on the front end.
     """
     user = request.user
     if getattr(user, 'current_role', None) != "Parent":
         return Response({"detail": "This endpoint is not available for your role."}, status=status.HTTP_200_OK)
-    
-    payments = Payment.objects.filter(user=user).order_by('-date', '-time')
-    history = []
-    for pay in payments:
-        history.append({
-            "date": pay.date.strftime("%Y-%m-%d"),
-            "time": pay.time.strftime("%H:%M"),
-            "school": pay.school.name if pay.school else "",
-            "description": pay.description,
-            "amount": str(pay.value),
-        })
-    
-    return Response(history, status=status.HTTP_200_OK)
+
+    return _payment_history_response(request, Payment.objects.filter(user=user))
 
 
 @api_view(['POST'])
@@ -513,49 +562,32 @@ def redulate_debt_view(request):
     if getattr(user, 'current_role', None) != "Parent":
         return Response({"detail": "This endpoint is not available for your role."}, status=status.HTTP_200_OK)
     
-    unpaid_packs = Pack.objects.filter(parents=user, debt__gt=0)
-    total_debt = sum([pack.debt for pack in unpaid_packs]) if unpaid_packs.exists() else Decimal('0.00')
-    # Optionally perform additional logic (such as updating model values) here.
-    return Response({"message": "Debt recalculated", "current_debt": str(total_debt)}, status=status.HTTP_200_OK)
+    summary = debt_summary(Pack.objects.filter(parents=user))
+    return Response({"message": "Debt recalculated", "current_debt": summary["current_debt"], "aging": summary["aging"]}, status=status.HTTP_200_OK)
 
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
 def instructor_payment_history(request):
     """
-    Returns the full payment history for the current user.
-    For Parent users, for each Payment, returns:
-      - date (formatted as "YYYY-MM-DD")
-      - time (formatted as "HH:mm")
-      - school (the school name, if available)
-      - description (which is a JSON field or string)
-      - amount
-    Filtering is done on the front end.
+    Returns the payments made to the current Instructor user, paginated and
+    filtered like payment_history_view.
     """
     user = request.user
     if getattr(user, 'current_role', None) != "Instructor":
         return Response({"detail": "This endpoint is not available for your role."}, status=status.HTTP_200_OK)
-    
-    payments = Payment.objects.filter(instructor=user.instructor_profile).order_by('-date', '-time')
-    history = []
-    for pay in payments:
-        history.append({
-            "date": pay.date.strftime("%Y-%m-%d"),
-            "time": pay.time.strftime("%H:%M"),
-            "school": pay.school.name if pay.school else "",
-            "description": pay.description,
-            "amount": str(pay.value),
-        })
-    
-    return Response(history, status=status.HTTP_200_OK)
+
+    return _payment_history_response(request, Payment.objects.filter(instructor=user.instructor_profile))
 
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
 def school_unpaid_items_view(request):
     """
-    Returns a list of unpaid items (packs with debt > 0) for the Admin's school.
+    Returns the unpaid items (packs with debt > 0) for the Admin's school,
+    all of them or, with ?page=, one page of ?page_size= items, together
+    with the school's total debt and its aging buckets.
     For each pack, returns:
       - the pack's ID,
-      - the result of pack.getStudentsName(),
+      - the result of pack.get_students_name(),
       - the pack's date (formatted as "YYYY-MM-DD"),
       - the pack's debt.
     Accessible only if request.user.current_role == "Admin".
@@ -567,20 +599,22 @@ def school_unpaid_items_view(request):
     if not school_id:
         return Response({"error": "School not found for user."}, status=status.HTTP_400_BAD_REQUEST)
     
+    try:
+        page, page_size = _get_page(request), _get_page_size(request)
+    except ValueError:
+        return Response({"error": "page and page_size must be integers."}, status=status.HTTP_400_BAD_REQUEST)
+
     school = get_object_or_404(School, id=school_id)
-    packs = Pack.objects.filter(school=school, debt__gt=0)
-    
-    data = []
-    for pack in packs:
-        data.append({
-            "pack_id": str(pack.id),
-            "students_name": pack.get_students_name(),  # Call the method to get students' names.
-            "date": pack.date.strftime("%Y-%m-%d") if pack.date else "",
-            "time": pack.date_time.strftime("%H:%M") if pack.date_time else "09:00",
-            "amount": str(pack.debt) if pack.debt else "0.00",
-            "description": str(pack),
-        })
-    return Response(data, status=status.HTTP_200_OK)
+    packs = Pack.objects.filter(school=school)
+
+    summary = debt_summary(packs)
+    data, has_more = unpaid_pack_items(packs, page=page, page_size=page_size)
+    return Response({
+        "data": data,
+        "has_more": has_more,
+        "current_debt": summary["current_debt"],
+        "aging": summary["aging"],
+    }, status=status.HTTP_200_OK)
 
 
 @api_view(['GET'])
@@ -609,13 +643,13 @@ def upcoming_payouts_view(request):
 
     # Convert instructors to UserAccount objects via Instructor.user
     instructors = set()
-    for instructor in school.instructors.all():
+    for instructor in school.instructors.select_related("user"):
         if hasattr(instructor, 'user') and instructor.user:
             instructors.add(instructor.user)
 
     # Convert monitors to UserAccount objects via Monitor.user
     monitors = set()
-    for monitor in school.monitors.all():
+    for monitor in school.monitors.select_related("user"):
         if hasattr(monitor, 'user') and monitor.user:
             monitors.add(monitor.user)
 
@@ -636,25 +670,48 @@ def upcoming_payouts_view(request):
             "name": str(user),
             "current_balance": str(user.balance),
             "roles": user_roles,
-            "description": user.get_balance_history_since_last_payout(),
+            "description": user.get_balance_history_since_last_payout(school=school),
         })
 
     return Response(data, status=status.HTTP_200_OK)
 
 
 
+@api_view(['POST'])
+@permission_classes([IsAuthenticated])
+def payout_batch_view(request):
+    """
+    Pays out every staff member of the Admin's school what they earned up to
+    ?cutoff= / "cutoff" (YYYY-MM-DD, default today) and returns the payout
+    summary: the total and, per staff member paid, the amount, the payout
+    payment id and the balance left.
+    Accessible only if request.user.current_role == "Admin".
+    """
+    if getattr(request.user, 'current_role', None) != "Admin":
+        return Response({"error": "Not authorized."}, status=status.HTTP_403_FORBIDDEN)
+
+    school_id = getattr(request.user, 'current_school_id', None)
+    if not school_id:
+        return Response({"error": "School not found for user."}, status=status.HTTP_400_BAD_REQUEST)
+
+    school = get_object_or_404(School, id=school_id)
+    cutoff = request.data.get("cutoff") or request.GET.get("cutoff")
+    try:
+        cutoff = datetime.strptime(cutoff, "%Y-%m-%d").date() if cutoff else now().date()
+    except ValueError:
+        return Response({"error": "cutoff must be a YYYY-MM-DD date."}, status=status.HTTP_400_BAD_REQUEST)
+
+    summary = run_payout_batch(school, cutoff, paid_by=request.user)
+    return Response(summary, status=status.HTTP_201_CREATED if summary["payouts"] else status.HTTP_200_OK)
+
+
 
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
 def school_payment_history_view(request):
     """
-    Returns a list of all Payment objects for the Admin's school.
-    Each Payment includes:
-      - id,
-      - date (formatted as "YYYY-MM-DD"),
-      - time (formatted as "HH:MM"),
-      - value,
-      - description.
+    Returns the Payment objects of the Admin's school, paginated and
+    filtered like payment_history_view.
     Accessible only if request.user.current_role == "Admin".
     """
     if getattr(request.user, 'current_role', None) != "Admin":
@@ -665,15 +722,4 @@ def school_payment_history_view(request):
         return Response({"error": "School not found for user."}, status=status.HTTP_400_BAD_REQUEST)
     
     school = get_object_or_404(School, id=school_id)
-    payments = Payment.objects.filter(school=school).order_by('-date', '-time')
-    
-    data = []
-    for pay in payments:
-        data.append({
-            "id": str(pay.id),
-            "date": pay.date.strftime("%Y-%m-%d") if pay.date else "",
-            "time": pay.time.strftime("%H:%M") if pay.time else "",
-            "amount": str(pay.value),
-            "description": pay.description,
-        })
-    return Response(data, status=status.HTTP_200_OK)
+    return _payment_history_response(request, Payment.objects.filter(school=school))
@@ -0,0 +1,35 @@
+import datetime
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.dateparse import parse_date
+from django.utils.timezone import now
+from progress.models import ProgressReport
+from schools.models import School
+
+
+class Command(BaseCommand):
+    help = 'Generate progress reports for every student of a school (or of all schools) for a period'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--school', type=int, help='School id (defaults to every school)')
+        parser.add_argument('--start', help='Period start, YYYY-MM-DD (defaults to 30 days before --end)')
+        parser.add_argument('--end', help='Period end, YYYY-MM-DD (defaults to today)')
+
+    def handle(self, *args, **options):
+        end_date = parse_date(options['end']) if options['end'] else now().date()
+        start_date = parse_date(options['start']) if options['start'] else end_date - datetime.timedelta(days=30)
+        if not start_date or not end_date or start_date > end_date:
+            raise CommandError('Invalid period, expected --start <= --end in YYYY-MM-DD format.')
+
+        schools = School.objects.all()
+        if options['school']:
+            schools = schools.filter(id=options['school'])
+            if not schools.exists():
+                raise CommandError(f"School {options['school']} not found.")
+
+        total = 0
+        for school in schools:
+            reports = ProgressReport.generate_school_reports(school, start_date, end_date)
+            total += len(reports)
+            self.stdout.write(f'{school}: {len(reports)} reports')
+
+        self.stdout.write(self.style.SUCCESS(f'Generated {total} progress reports from {start_date} to {end_date}.'))
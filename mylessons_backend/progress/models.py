@@ -1,4 +1,6 @@
+from collections import defaultdict
 from django.db import models
+from django.db.models import Prefetch
 from users.models import Student, Instructor
 from lessons.models import Lesson
 from sports.models import Sport
@@ -94,38 +96,71 @@ class ProgressReport(models.Model):
 
     @classmethod
     def generate_report(cls, student, start_date, end_date):
+        return cls.generate_reports([student], start_date, end_date)[0]
+
+    @classmethod
+    def generate_reports(cls, students, start_date, end_date):
+        """
+        Creates one report per student for the period. Goals and progress
+        records of all the students are fetched in bulk and grouped in memory,
+        and the reports are inserted with a single bulk_create.
+        """
+        students = list(students)
+        student_ids = [student.id for student in students]
+
+        goals_by_student = defaultdict(list)
         goals = Goal.objects.filter(
-            student=student
+            student_id__in=student_ids
         ).exclude(
             target_date__lt=start_date
         ).exclude(
-            start_date__gt=end_date
-        )
+            start_datetime__date__gt=end_date
+        ).select_related('skill').order_by('id')
+        for goal in goals:
+            goals_by_student[goal.student_id].append(goal)
 
+        records_by_student = defaultdict(list)
         progress_records = ProgressRecord.objects.filter(
-            student=student,
+            student_id__in=student_ids,
             date__range=(start_date, end_date)
-        )
+        ).prefetch_related(
+            Prefetch('goals', queryset=Goal.objects.select_related('skill'))
+        ).order_by('date', 'id')
+        for record in progress_records:
+            records_by_student[record.student_id].append(record)
+
+        reports = [
+            cls(
+                student=student,
+                period_start=start_date,
+                period_end=end_date,
+                summary=cls.build_summary(
+                    student, start_date, end_date,
+                    goals_by_student[student.id], records_by_student[student.id],
+                ),
+            )
+            for student in students
+        ]
+        return cls.objects.bulk_create(reports)
 
-        summary = f"Progress report for {student} from {start_date} to {end_date}\n\n"
+    @classmethod
+    def generate_school_reports(cls, school, start_date, end_date):
+        return cls.generate_reports(school.students.order_by('id'), start_date, end_date)
 
-        summary += "Goals:\n"
+    @staticmethod
+    def build_summary(student, start_date, end_date, goals, progress_records):
+        lines = [f"Progress report for {student} from {start_date} to {end_date}", "", "Goals:"]
         for goal in goals:
             status = "Completed" if goal.is_completed else "In Progress"
-            summary += f"- {goal.skill.name}: {goal.description} ({status})\n"
+            lines.append(f"- {goal.skill.name}: {goal.description} ({status})")
 
-        summary += "\nProgress Records:\n"
+        lines += ["", "Progress Records:"]
         for record in progress_records:
-            lesson_info = f"Lesson ID: {record.lesson.id}" if record.lesson else f"Lesson Not Assigned"
-            summary += f"- Date: {record.date} | {lesson_info} | Skills Covered: {[skill.skill.name for skill in record.skills.all()]}\n"
-
-        return cls.objects.create(
-            student=student,
-            period_start=start_date,
-            period_end=end_date,
-            summary=summary
-        )
+            lesson_info = f"Lesson ID: {record.lesson_id}" if record.lesson_id else "Lesson Not Assigned"
+            skills = [goal.skill.name for goal in record.goals.all()]
+            lines.append(f"- Date: {record.date} | {lesson_info} | Skills Covered: {skills}")
 
+        return "\n".join(lines) + "\n"
 
     @classmethod
     def get_latest_report(cls, student):
@@ -138,4 +138,37 @@ class ProgressReportTests(TestCase):
             end_date=now().date() + timedelta(days=1)
         )
         latest_report = ProgressReport.get_latest_report(self.student)
-        self.assertEqual(report, latest_report)
\ No newline at end of file
+        self.assertEqual(report, latest_report)
+
+class BatchProgressReportTests(TestCase):
+
+    def setUp(self):
+        self.school = School.objects.create(name="Test School")
+        self.sport = Sport.objects.create(name="Surf")
+        self.skill = Skill.objects.create(name="Take off", sport=self.sport)
+        self.students = [Student.objects.create(first_name=f"Student{i}", last_name="Test") for i in range(3)]
+        self.school.students.set(self.students)
+        for student in self.students:
+            goal = Goal.objects.create(student=student, skill=self.skill, description=f"Goal of {student.first_name}",
+                                       target_date=now().date() + timedelta(days=30))
+            record = ProgressRecord.objects.create(student=student)
+            record.goals.add(goal)
+        self.today = now().date()
+
+    def test_generate_school_reports(self):
+        with self.assertNumQueries(5):
+            reports = ProgressReport.generate_school_reports(self.school, self.today - timedelta(days=1), self.today)
+
+        self.assertEqual(len(reports), 3)
+        self.assertEqual(ProgressReport.objects.count(), 3)
+        summary = ProgressReport.objects.get(student=self.students[1]).summary
+        self.assertIn("Goal of Student1", summary)
+        self.assertNotIn("Goal of Student0", summary)
+        self.assertIn("Lesson Not Assigned | Skills Covered: ['Take off']", summary)
+
+    def test_goals_outside_period_are_excluded(self):
+        Goal.objects.create(student=self.students[0], skill=self.skill, description="Old goal",
+                            target_date=self.today - timedelta(days=10))
+        report = ProgressReport.generate_report(self.students[0], self.today - timedelta(days=1), self.today)
+        self.assertNotIn("Old goal", report.summary)
+        self.assertIn("Goal of Student0", report.summary)
@@ -11,4 +11,5 @@ urlpatterns = [
     path('progress-records/', create_progress_record, name='create_progress_record'),
     path('progress-records/<int:record_id>/', update_progress_record, name='update_progress_record'),
     path('progress-record/', get_progress_record, name='update_progress_record'),
+    path('progress-reports/generate/', generate_progress_reports, name='generate_progress_reports'),
 ]
@@ -7,6 +7,7 @@ from rest_framework import status
 
 from .models import Skill, Goal, ProgressRecord, ProgressReport
 from users.models import Student
+from schools.models import School
 
 
 @api_view(['GET'])
@@ -315,3 +316,29 @@ def get_progress_record(request):
         return JsonResponse(data, status=status.HTTP_200_OK)
     except ProgressRecord.DoesNotExist:
         return JsonResponse({'error': 'Progress record not found'}, status=status.HTTP_404_NOT_FOUND)
+
+
+@api_view(['POST'])
+def generate_progress_reports(request):
+    """
+    Generates a progress report for every student of a school.
+    Expects a JSON body with 'school_id', 'start_date' and 'end_date' (YYYY-MM-DD).
+    Only admins of the school can generate its reports.
+    """
+    school = get_object_or_404(School, pk=request.data.get('school_id'))
+    if not school.admins.filter(pk=request.user.pk).exists():
+        return JsonResponse({'error': 'Not allowed to generate reports for this school'}, status=status.HTTP_403_FORBIDDEN)
+
+    start_date = parse_date(str(request.data.get('start_date', '')))
+    end_date = parse_date(str(request.data.get('end_date', '')))
+    if not start_date or not end_date or start_date > end_date:
+        return JsonResponse({'error': 'start_date and end_date are required, with start_date <= end_date'},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+    reports = ProgressReport.generate_school_reports(school, start_date, end_date)
+    data = {
+        'count': len(reports),
+        'period_start': start_date.isoformat(),
+        'period_end': end_date.isoformat(),
+    }
+    return JsonResponse(data, status=status.HTTP_201_CREATED)
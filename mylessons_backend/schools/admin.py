@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import Review, School
+from .models import ImportJob, Review, School
 
 
 @admin.register(Review)
@@ -18,3 +18,10 @@ class SchoolAdmin(admin.ModelAdmin):
         'instructors', 'students', 'parents', 'monitors', 'locations',
     )  # Enable better many-to-many management
     readonly_fields = ('logo',)  # Prevent accidental changes to the logo field
+
+
+@admin.register(ImportJob)
+class ImportJobAdmin(admin.ModelAdmin):
+    list_display = ('id', 'school', 'status', 'rows_done', 'created_at', 'finished_at')
+    list_filter = ('status',)
+    readonly_fields = ('progress', 'rows_done', 'error', 'locked_until', 'started_at', 'finished_at')
@@ -0,0 +1,91 @@
+import time
+
+import pandas as pd
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+
+from schools.models import School
+from schools.utils import BulkImporter
+
+
+class RollBack(Exception):
+    pass
+
+
+def benchmark_frames(students, lessons, packs, payments, user_id, prefix='bench'):
+    """A synthetic workbook (as DataFrames) shaped like a school's exported history."""
+    student_ids = [f'{prefix}-s{i}' for i in range(students)]
+    lesson_ids = [f'{prefix}-l{i}' for i in range(lessons)]
+    pack_ids = [f'{prefix}-p{i}' for i in range(packs)]
+    dates = pd.date_range('2023-01-01', periods=max(lessons, packs, 1), freq='h')
+    return {
+        'Students': pd.DataFrame({
+            'id': student_ids,
+            'first_name': [f'Student {i}' for i in range(students)],
+            'last_name': 'Benchmark',
+            'birthday': '2012-05-01',
+            'level': [i % 5 for i in range(students)],
+        }),
+        'Lessons': pd.DataFrame({
+            'id': lesson_ids,
+            'date': dates[:lessons].date,
+            'start_time': dates[:lessons].time,
+            'duration_in_minutes': 60,
+            'price': 25,
+            'type': 'private',
+            'is_done': [i % 3 == 0 for i in range(lessons)],
+            'student_ids': [student_ids[i % students] for i in range(lessons)],
+        }),
+        'Packs': pd.DataFrame({
+            'id': pack_ids,
+            'date': dates[:packs].date,
+            'number_of_classes': 5,
+            'price': 100,
+            'debt': [0 if i % 2 else 50 for i in range(packs)],
+            'student_ids': [student_ids[i % students] for i in range(packs)],
+            'lesson_ids': [','.join(lesson_ids[j] for j in range(i * 5, min(i * 5 + 5, lessons))) for i in range(packs)],
+        }),
+        'Payments': pd.DataFrame({
+            'id': [f'{prefix}-pay{i}' for i in range(payments)],
+            'value': 50,
+            'user_id': user_id,
+            'pack_ids': [pack_ids[i % packs] for i in range(payments)],
+        }),
+    }
+
+
+class Command(BaseCommand):
+    help = 'Time the bulk Excel importer on a synthetic workbook; everything is rolled back unless --keep'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--students', type=int, default=1000)
+        parser.add_argument('--lessons', type=int, default=10000)
+        parser.add_argument('--packs', type=int, default=2000)
+        parser.add_argument('--payments', type=int, default=2000)
+        parser.add_argument('--keep', action='store_true', help='Commit the imported rows')
+
+    def handle(self, *args, **options):
+        try:
+            with transaction.atomic():
+                school = School.objects.create(name='Import benchmark')
+                user, _ = get_user_model().objects.get_or_create(username='import-benchmark')
+                frames = benchmark_frames(options['students'], options['lessons'], options['packs'], options['payments'], user.pk)
+                importer = BulkImporter(school)
+                total = 0.0
+                for name, df in frames.items():
+                    start = time.perf_counter()
+                    with CaptureQueriesContext(connection) as queries:
+                        result = importer.run({name: df})[name.lower()]
+                    elapsed = time.perf_counter() - start
+                    total += elapsed
+                    self.stdout.write(
+                        f"{name}: {result.get('imported', 0)} rows in {elapsed:.2f}s"
+                        f" ({len(result.get('errors', []))} errors, {len(queries)} queries)"
+                    )
+                self.stdout.write(self.style.SUCCESS(f'Total: {total:.2f}s'))
+                if not options['keep']:
+                    raise RollBack
+        except RollBack:
+            pass
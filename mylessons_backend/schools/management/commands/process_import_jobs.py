@@ -0,0 +1,29 @@
+import time
+from django.core.management.base import BaseCommand
+from schools.models import ImportJob
+from schools.utils import IMPORT_CHUNK_SIZE
+
+
+class Command(BaseCommand):
+    help = 'Process queued bulk Excel imports in chunks, recording their progress'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=IMPORT_CHUNK_SIZE, help='Rows committed per transaction')
+        parser.add_argument('--loop', action='store_true', help='Keep polling instead of exiting when the queue is empty')
+        parser.add_argument('--interval', type=float, default=5.0, help='Seconds between polls with --loop')
+
+    def handle(self, *args, **options):
+        done = failed = 0
+        while True:
+            job = ImportJob.claim_next()
+            if job is not None:
+                if job.process(chunk_size=options['chunk_size']):
+                    done += 1
+                else:
+                    failed += 1
+                continue
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
+
+        self.stdout.write(f'Processed {done} import jobs, {failed} failed.')
@@ -0,0 +1,18 @@
+# Generated by Django 5.1.5 on 2026-10-19 15:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('schools', '0006_importjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='importjob',
+            name='target',
+            field=models.CharField(blank=True, default='', max_length=20),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 5.1.5 on 2026-10-19 16:05
+
+import uuid
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('schools', '0007_importjob_target'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='school',
+            name='pricing_version',
+            field=models.UUIDField(default=uuid.uuid4, editable=False),
+        ),
+    ]
@@ -2,9 +2,14 @@ import random
 import re
 import copy
 import logging
-from django.db import models
+import string
+from django.core.exceptions import ValidationError
+from datetime import timedelta
+from django.db import models, transaction
 from django.apps import apps
+from django.utils.timezone import now
 import uuid
+from .pricing import PayRules, PriceTable
 
 logger = logging.getLogger(__name__)
 
@@ -229,6 +234,32 @@ def default_notification_templates():
                 "- Start Time: {start_time}\n"
                 "- Duration: {duration_in_minutes} minutes"
             ),
+            "private_class_multiple_scheduled_subject_parent":
+            "Your {number_of_classes} Private Classes Scheduled for {students}",
+
+            "private_class_multiple_scheduled_subject_instructor":
+            "Your {lesson_count} Private Classes Scheduled for {students}",
+
+            "private_class_multiple_scheduled_subject_admin":
+            "{number_of_classes} Private Classes Scheduled for {students}",
+
+            "private_class_multiple_scheduled_message_parent": (
+            "Dear {parent_name},\n\n"
+            "Your {number_of_classes} private classes for {students} have been scheduled:\n\n"
+            "{lessons_details}"
+            ),
+
+            "private_class_multiple_scheduled_message_instructor": (
+            "Dear {instructor_name},\n\n"
+            "You’ve been booked for {lesson_count} private classes with {students}:\n\n"
+            "{lessons_details}"
+            ),
+
+            "private_class_multiple_scheduled_message_admin": (
+            "Dear Admin,\n\n"
+            "{number_of_classes} private classes have been scheduled for {students}:\n\n"
+            "{lessons_details}"
+            ),
             # New conflict-related notification templates
             "conflict_notification_subject": "Scheduling Conflict Detected: {conflict_type}",
             "conflict_notification_message_instructor": (
@@ -262,6 +293,113 @@ def default_notification_templates():
             ),
         }
 
+DEFAULT_NOTIFICATION_TEMPLATES = default_notification_templates()
+
+# "{family}_subject_{role}" / "{family}_message_{role}"; the role is optional
+_TEMPLATE_KEY_RE = re.compile(r"^(?P<family>.+?)_(subject|message)(_[a-z]+)?$")
+
+
+def get_template_placeholders(template):
+    """
+    Returns the names of the {placeholders} used by a str.format template.
+    Raises ValueError if the template is malformed or uses positional fields.
+    """
+    names = set()
+    for _, field_name, format_spec, _ in string.Formatter().parse(template):
+        if field_name is None:
+            continue
+        if field_name == "" or field_name.isdigit():
+            raise ValueError("positional placeholders are not supported")
+        names.add(re.split(r"[.\[]", field_name, maxsplit=1)[0])
+        if format_spec:
+            names |= get_template_placeholders(format_spec)
+    return names
+
+
+def _template_role(key):
+    """ "x_message_parent" -> ("x", "parent"); the role is None for a role-less subject."""
+    match = _TEMPLATE_KEY_RE.match(key)
+    if not match:
+        return key, None
+    return match.group("family"), (match.group(3) or "_")[1:] or None
+
+
+def _notification_template_placeholders():
+    # the context every Notification.fan_out call site passes, per template
+    # family and recipient role (lessons.models.Pack.book_new_pack,
+    # lessons.views, users.models notify_conflicts); a placeholder of another
+    # role's context would raise KeyError when the template is rendered
+    pack = {"students", "number_of_classes", "duration_minutes", "start_date", "total_price",
+            "currency", "school_name", "instructor_name"}
+    scheduled = {"students", "class_number", "number_of_classes", "date", "start_time",
+                 "duration_in_minutes", "instructor_name"}
+    multiple = {"number_of_classes", "students", "lessons_details"}
+    conflict = {"conflict_type", "date", "start_time", "end_time", "school_name"}
+    placeholders = {
+        ("conflict_notification", "instructor"): conflict | {"instructor_name"},
+        ("conflict_notification", "parent"): conflict | {"parent_name"},
+        ("expiration_alert", "parent"): {"parent_name", "students", "type", "days_until_expiration", "school_name"},
+    }
+    for lesson_type in ("group", "private"):
+        placeholders.update({
+            (f"{lesson_type}_pack_purchased", "parent"): pack | {"parent_name"},
+            (f"{lesson_type}_pack_purchased", "instructor"): pack,
+            (f"{lesson_type}_pack_purchased", "admin"): pack,
+            (f"{lesson_type}_class_scheduled", "parent"): scheduled | {"parent_name"},
+            (f"{lesson_type}_class_scheduled", "instructor"): scheduled,
+            (f"{lesson_type}_class_scheduled", "admin"): scheduled | {"price", "currency"},
+            (f"{lesson_type}_class_multiple_scheduled", "parent"): multiple | {"parent_name"},
+            (f"{lesson_type}_class_multiple_scheduled", "instructor"): {"instructor_name", "lesson_count", "students", "lessons_details"},
+            (f"{lesson_type}_class_multiple_scheduled", "admin"): multiple,
+        })
+    # a role-less subject stands in for every role without its own, so it
+    # may only use what all of them pass
+    for family in {family for family, _ in placeholders}:
+        placeholders[(family, None)] = set.intersection(*(
+            names for (other, _), names in placeholders.items() if other == family
+        ))
+    return placeholders
+
+
+NOTIFICATION_TEMPLATE_PLACEHOLDERS = _notification_template_placeholders()
+
+
+def validate_notification_templates(templates):
+    """
+    Checks that every template parses and only uses placeholders its family
+    and role are rendered with, so that a bad edit fails here instead of at
+    .format() time when notifications are sent.
+    """
+    errors = []
+    for key, template in (templates or {}).items():
+        if not isinstance(template, str):
+            errors.append(f"{key}: template must be a string.")
+            continue
+        try:
+            used = get_template_placeholders(template)
+        except ValueError as e:
+            errors.append(f"{key}: {e}.")
+            continue
+        allowed = NOTIFICATION_TEMPLATE_PLACEHOLDERS.get(_template_role(key))
+        if allowed is None:
+            errors.append(f"{key}: unknown notification template.")
+        elif used - allowed:
+            unknown = ", ".join("{%s}" % name for name in sorted(used - allowed))
+            errors.append(f"{key}: unknown placeholders {unknown}.")
+    if errors:
+        raise ValidationError({"notification_templates": errors})
+
+
+# school id -> (notification_templates it was compiled from, merged templates)
+_notification_template_registry = {}
+# school id -> PriceTable, recompiled when pricing_version changes
+_price_table_registry = {}
+# (school id, user id) -> (the user's payment_types it was compiled from, PayRules)
+_pay_rules_registry = {}
+# School fields compiled into PriceTable / PayRules; saving a change to one of them bumps pricing_version
+PRICING_FIELDS = ("pack_prices", "services", "extra_prices", "payment_types")
+
+
 class Review(models.Model):
     user = models.ForeignKey(
         'users.UserAccount',
@@ -306,6 +444,7 @@ class School(models.Model):
     )
     alerts = models.JSONField(blank=True, default=default_alerts)
     locations = models.ManyToManyField('locations.Location', related_name='schools', blank=True)
+    pricing_version = models.UUIDField(default=uuid.uuid4, editable=False)  # changes with every price edit
 
     def __str__(self):
         return self.name
@@ -737,137 +876,114 @@ class School(models.Model):
         self.pack_prices = pack_prices
         self.save()
         return True
+
+    def bump_pricing_version(self):
+        """
+        Marks the school's prices as changed, so every process recompiles
+        them. save() does it whenever a PRICING_FIELDS value changes; this is
+        for writes that skip save(), such as queryset updates.
+        """
+        self.pricing_version = uuid.uuid4()
+        School.objects.filter(pk=self.pk).update(pricing_version=self.pricing_version)
+
+    def get_price_table(self):
+        """
+        Returns the school's pack and extra prices compiled into a PriceTable,
+        once per pricing_version and kept in a process-wide registry.
+        """
+        table = _price_table_registry.get(self.pk)
+        if table is None or table.version != self.pricing_version:
+            table = PriceTable(self)
+            if self.pk:
+                _price_table_registry[self.pk] = table
+        return table
+
+    def get_pay_rules(self, user):
+        """
+        Returns the user's pay rules at this school (their copy of the
+        school's payment_types) compiled into PayRules, recompiled whenever
+        that copy differs from the one they were compiled from, however it
+        was edited.
+        """
+        key = (self.pk, user.pk)
+        payment_types = (user.payment_types or {}).get(self.name)
+        entry = _pay_rules_registry.get(key)
+        if entry is None or entry[0] != payment_types:
+            entry = (copy.deepcopy(payment_types), PayRules(payment_types))
+            if self.pk and user.pk:
+                _pay_rules_registry[key] = entry
+        return entry[1]
     
+    def get_notification_templates(self):
+        """
+        Returns the defaults merged with the school's notification_templates.
+        The merge is done once per school and kept in a process-wide registry
+        (recompiled if the stored templates changed, dropped on save), and the
+        instance keeps a reference, so a lookup is a dict access.
+        """
+        templates = getattr(self, "_compiled_notification_templates", None)
+        if templates is None:
+            overrides = self.notification_templates or {}
+            entry = _notification_template_registry.get(self.pk)
+            if entry is None or entry[0] != overrides:
+                entry = (copy.deepcopy(overrides), {**DEFAULT_NOTIFICATION_TEMPLATES, **overrides})
+                if self.pk:
+                    _notification_template_registry[self.pk] = entry
+            templates = self._compiled_notification_templates = entry[1]
+        return templates
+
     def get_notification_template(self, key):
         """
         Retrieves a notification template by key. Returns a default if not found.
         """
-        templates = self.notification_templates or {}
-        default_templates = {
-            "private_pack_purchased_subject_parent": "Private Pack Purchased for {students}",
-            "private_pack_purchased_message_parent": (
-                "Dear {parent_name},\n\n"
-                "A new private pack has been purchased for {students}.\n\n"
-                "Pack Details:\n"
-                "- Number of Classes: {number_of_classes}\n"
-                "- Duration per Class: {duration_minutes} minutes\n"
-                "- Instructor: {instructor_name}\n"
-                "- Start Date: {start_date}\n\n"
-                "- Total Price: {total_price}{currency}\n\n"
-                "Thank you for choosing {school_name}."
-            ),
-            "private_pack_purchased_subject_instructor": "New Private Pack Assigned",
-            "private_pack_purchased_message_instructor": (
-                "Dear {instructor_name},\n\n"
-                "You have been assigned to a new private pack for {students}.\n\n"
-                "Pack Details:\n"
-                "- Number of Classes: {number_of_classes}\n"
-                "- Duration per Class: {duration_minutes} minutes\n"
-                "- Instructor: {instructor_name}\n"
-                "- Start Date: {start_date}\n\n"
-                "Please check your schedule for more details."
-            ),
-            "private_pack_purchased_subject_admin": "New Private Pack Booked",
-            "private_pack_purchased_message_admin": (
-                "Dear Admin,\n\n"
-                "A new private pack has been booked for {students}.\n\n"
-                "Pack Details:\n"
-                "- Number of Classes: {number_of_classes}\n"
-                "- Duration per Class: {duration_minutes} minutes\n"
-                "- Instructor: {instructor_name}\n"
-                "- Start Date: {start_date}\n\n"
-                "- Total Price: {total_price}{currency}\n\n"
-                "Please review the booking details."
-            ),
-            "private_class_scheduled_subject_parent": "Private Class Scheduled for {students}",
-            "private_class_scheduled_message_parent": (
-                "Dear {parent_name},\n\n"
-                "The private class number {class_number} of {number_of_classes} has been scheduled for {students}.\n\n"
-                "Class Details:\n"
-                "- Date: {date}\n"
-                "- Start Time: {start_time}\n"
-                "- Duration: {duration_in_minutes} minutes\n"
-                "- Instructor: {instructor_name}"
-            ),
-            "private_class_scheduled_subject_instructor": "Private Class Scheduled for {students}",
-            "private_class_scheduled_message_instructor": (
-                "Dear {instructor_name},\n\n"
-                "The private class number {class_number} of {number_of_classes} has been scheduled for {students}.\n\n"
-                "Class Details:\n"
-                "- Date: {date}\n"
-                "- Start Time: {start_time}\n"
-                "- Duration: {duration_in_minutes} minutes"
-            ),
-            "private_class_scheduled_subject_admin": "Private Class Scheduled for {students}",
-            "private_class_scheduled_message_admin": (
-                "Dear Admin,\n\n"
-                "The private class number {class_number} of {number_of_classes} has been scheduled for {students}.\n\n"
-                "Class Details:\n"
-                "- Date: {date}\n"
-                "- Start Time: {start_time}\n"
-                "- Duration: {duration_in_minutes} minutes"
-            ),
-            
-            # TODO add multiple classes logic on schedule multiple lessons
-            
-            "private_class_multiple_scheduled_subject_parent":
-            "Your {number_of_classes} Private Classes Scheduled for {students}",
+        return self.get_notification_templates().get(key)
 
-            "private_class_multiple_scheduled_subject_instructor":
-            "Your {lesson_count} Private Classes Scheduled for {students}",
+    def update_notification_templates(self, templates):
+        """
+        Validates and stores custom templates, keeping the other ones.
+        Raises ValidationError if a template is invalid.
+        """
+        validate_notification_templates(templates)
+        self.notification_templates = {**(self.notification_templates or {}), **templates}
+        self.save(update_fields=["notification_templates"])
 
-            "private_class_multiple_scheduled_subject_admin":
-            "{number_of_classes} Private Classes Scheduled for {students}",
+    def clean(self):
+        super().clean()
+        validate_notification_templates(self.notification_templates)
 
-            "private_class_multiple_scheduled_message_parent": (
-            "Dear {parent_name},\n\n"
-            "Your {number_of_classes} private classes for {students} have been scheduled:\n\n"
-            "{lessons_details}"
-            ),
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        school = super().from_db(db, field_names, values)
+        school._loaded_prices = school._pricing_fields()
+        return school
 
-            "private_class_multiple_scheduled_message_instructor": (
-            "Dear {instructor_name},\n\n"
-            "You’ve been booked for {lesson_count} private classes with {students}:\n\n"
-            "{lessons_details}"
-            ),
+    def _pricing_fields(self):
+        # copies, since the price helpers edit the JSON in place; deferred
+        # fields are left out rather than loaded
+        return {name: copy.deepcopy(self.__dict__[name]) for name in PRICING_FIELDS if name in self.__dict__}
 
-            "private_class_multiple_scheduled_message_admin": (
-            "Dear Admin,\n\n"
-            "{number_of_classes} private classes have been scheduled for {students}:\n\n"
-            "{lessons_details}"
-            ),
-            "conflict_notification_subject": "Scheduling Conflict Detected: {conflict_type}",
-            "conflict_notification_message_instructor": (
-                "Dear {instructor_name},\n\n"
-                "A scheduling conflict was detected for the following:\n\n"
-                "Conflict Details:\n"
-                "- Type: {conflict_type}\n"
-                "- Date: {date}\n"
-                "- Start Time: {start_time}\n"
-                "- End Time: {end_time}\n\n"
-                "Please address this issue promptly.\n\n"
-                "Thank you,\n{school_name}"
-            ),
-            "conflict_notification_message_parent": (
-                "Dear {parent_name},\n\n"
-                "A scheduling conflict was detected for your child's class/activity.\n\n"
-                "Conflict Details:\n"
-                "- Type: {conflict_type}\n"
-                "- Date: {date}\n"
-                "- Start Time: {start_time}\n"
-                "- End Time: {end_time}\n\n"
-                "Please contact us for more details.\n\n"
-                "Thank you,\n{school_name}"
-            ),
-            "expiration_alert_subject_parent" : "Theres a pack expiring in {days_until_expiration}",
-            "expiration_alert_message_parent" : (
-                "Dear {parent_name},\n\n"
-                "{students}'s {type} pack is expiring in {days_until_expiration}.\n\n"
-                "Please contact us for more details.\n\n"
-                "Thank you,\n{school_name}"
-            ),
+    def save(self, *args, **kwargs):
+        """
+        Saves the school and, when one of its PRICING_FIELDS changed since it
+        was loaded (from the admin, the shell or the price helpers alike),
+        gives it a new pricing_version so the compiled tables are rebuilt.
+        """
+        update_fields = kwargs.get("update_fields")
+        prices = {
+            name: value for name, value in self._pricing_fields().items()
+            if update_fields is None or name in update_fields
         }
-        return templates.get(key, default_templates.get(key))
+        loaded = getattr(self, "_loaded_prices", None)
+        changed = [name for name in prices if loaded is None or name not in loaded or loaded[name] != prices[name]]
+        if changed and not self._state.adding:
+            self.pricing_version = uuid.uuid4()
+            if update_fields is not None:
+                kwargs["update_fields"] = [*update_fields, "pricing_version"]
+        super().save(*args, **kwargs)
+        self._loaded_prices = {**(loaded or {}), **prices}
+        self._compiled_notification_templates = None
+        _notification_template_registry.pop(self.pk, None)
+
     
     def add_payment_types_to_user(self, user):
         # Ensure the instructor has a dictionary for payment_types.
@@ -921,3 +1037,153 @@ class School(models.Model):
         del self.extra_prices[item_name]
         self.save()
         return True
+
+
+IMPORT_JOB_LEASE = timedelta(minutes=10)  # a running job is picked up again after this if its worker died
+IMPORT_JOB_MAX_ERRORS = 1000  # row errors kept per sheet; the rest are only counted
+
+
+class ImportJob(models.Model):
+    """
+    A bulk Excel import run by the process_import_jobs worker instead of
+    inside the upload request. Sheets are imported in chunks of rows, and
+    each chunk commits together with the job's progress. A failed job can be
+    resumed and continues after the last committed chunk.
+    """
+    PENDING = "pending"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+    STATUS_CHOICES = [
+        (PENDING, "Pending"),
+        (RUNNING, "Running"),
+        (DONE, "Done"),
+        (FAILED, "Failed"),
+    ]
+
+    school = models.ForeignKey('School', on_delete=models.CASCADE, related_name='import_jobs')
+    created_by = models.ForeignKey('users.UserAccount', on_delete=models.SET_NULL, null=True, blank=True, related_name='import_jobs')
+    file = models.FileField(upload_to='imports/')
+    target = models.CharField(max_length=20, blank=True, default='')  # sheet a .csv upload is imported as
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=PENDING)
+    # {sheet name: {"rows": n, "rows_done": n, "imported": n, "error_count": n, "errors": [...], "done": bool}}
+    progress = models.JSONField(default=dict, blank=True)
+    rows_done = models.PositiveIntegerField(default=0)
+    error = models.TextField(blank=True, null=True)
+    locked_until = models.DateTimeField(blank=True, null=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(blank=True, null=True)
+    finished_at = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'created_at']),
+        ]
+
+    def __str__(self):
+        return f"Import {self.pk} for {self.school} ({self.status})"
+
+    @classmethod
+    def claim_next(cls):
+        """Marks the oldest waiting job (or one whose worker died) as running and returns it."""
+        current_time = now()
+        with transaction.atomic():
+            job = (
+                cls.objects.select_for_update(skip_locked=True)
+                .filter(models.Q(status=cls.PENDING) | models.Q(status=cls.RUNNING, locked_until__lt=current_time))
+                .order_by('created_at')
+                .first()
+            )
+            if job is None:
+                return None
+            job.status = cls.RUNNING
+            job.locked_until = current_time + IMPORT_JOB_LEASE
+            job.started_at = job.started_at or current_time
+            job.error = None
+            job.save(update_fields=['status', 'locked_until', 'started_at', 'error'])
+        return job
+
+    def resume(self):
+        """Queues a failed job again; it continues after its last committed chunk."""
+        if self.status != self.FAILED:
+            return False
+        self.status = self.PENDING
+        self.save(update_fields=['status'])
+        return True
+
+    def process(self, chunk_size=None):
+        """
+        Streams the upload chunk by chunk, skipping what earlier runs
+        committed. A failing chunk is rolled back and fails the job.
+        """
+        from schools.utils import FIRST_DATA_ROW, IMPORT_CHUNK_SIZE, IMPORT_LATE_REFERENCES, BulkImporter, ImportFileReader
+
+        importer = BulkImporter(self.school)
+        try:
+            with self.file.open('rb') as file, ImportFileReader(
+                file, name=self.file.name, target=self.target, chunk_size=chunk_size or IMPORT_CHUNK_SIZE,
+            ) as reader:
+                sheets = reader.sheets()
+                for name, key, rows in sheets:
+                    if key is None:
+                        self.progress[name] = {'error': 'No importer for this sheet.', 'done': True}
+                    else:
+                        self.progress.setdefault(name, {
+                            'rows': rows, 'rows_done': 0, 'imported': 0, 'error_count': 0, 'errors': [], 'done': False,
+                        })
+                self.save(update_fields=['progress'])
+
+                for name, key, _rows in sheets:
+                    state = self.progress[name]
+                    if state['done']:
+                        continue
+                    for start, chunk in reader.chunks(name, start=state['rows_done']):
+                        with transaction.atomic():
+                            result = importer.import_chunk(key, chunk, first_row=FIRST_DATA_ROW + start)
+                            self._record_chunk(state, len(chunk), result)
+                    state['done'] = True
+                    self.save(update_fields=['progress'])
+
+                # references to sheets imported later; linking again after a resume is harmless
+                for name, key, _rows in sheets:
+                    if key in IMPORT_LATE_REFERENCES:
+                        for _start, chunk in reader.chunks(name):
+                            with transaction.atomic():
+                                importer.link_chunk(key, chunk)
+        except Exception as e:
+            logger.exception("Import job %s failed", self.pk)
+            # drop the progress of the chunk that was rolled back
+            self.refresh_from_db(fields=['progress', 'rows_done'])
+            self.status = self.FAILED
+            self.error = str(e)
+            self.locked_until = None
+            self.save(update_fields=['status', 'error', 'locked_until'])
+            return False
+
+        self.status = self.DONE
+        self.finished_at = now()
+        self.locked_until = None
+        self.save(update_fields=['status', 'finished_at', 'locked_until'])
+        return True
+
+    def _record_chunk(self, state, rows, result):
+        state['rows_done'] += rows
+        state['imported'] += result['imported']
+        state['error_count'] += len(result['errors'])
+        state['errors'].extend(result['errors'][:max(IMPORT_JOB_MAX_ERRORS - len(state['errors']), 0)])
+        self.rows_done += rows
+        self.locked_until = now() + IMPORT_JOB_LEASE
+        self.save(update_fields=['progress', 'rows_done', 'locked_until'])
+
+    def as_dict(self):
+        return {
+            'id': self.pk,
+            'status': self.status,
+            'rows_done': self.rows_done,
+            'rows': sum(sheet.get('rows') or 0 for sheet in self.progress.values()),
+            'sheets': self.progress,
+            'error': self.error,
+            'created_at': self.created_at,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at,
+        }
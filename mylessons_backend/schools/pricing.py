@@ -0,0 +1,217 @@
+"""
+A school's prices compiled into dict lookups.
+
+School.pack_prices, the pack services' pricing_options, extra_prices and the
+fixed pay rules of payment_types are nested JSON that used to be walked or
+scanned on every quote. They are compiled into tables keyed by (type,
+duration, people, classes) and (type, duration, students), so a quote is a
+dict access: a school's prices once per School.pricing_version (see
+School.get_price_table) and a staff member's pay rules once per version of
+their payment_types (see School.get_pay_rules).
+"""
+import re
+from decimal import Decimal, InvalidOperation
+
+from django.db.models import prefetch_related_objects
+
+PAY_RULE_MAX_STUDENTS = 100  # fixed pay ranges are indexed up to this many students
+DEFAULT_EXTRA_STUDENT_PRICE = 10
+
+
+def _number(value):
+    """60, "60" or "60m" -> 60; None if there is no number."""
+    if isinstance(value, int):
+        return value
+    match = re.match(r"\s*(\d+)", str(value)) if value is not None else None
+    return int(match.group(1)) if match else None
+
+
+def _price(value):
+    """A price as stored in the JSON (a number or {"price": ...}) as a Decimal."""
+    if isinstance(value, dict):
+        value = value.get("price")
+    if value is None or isinstance(value, bool):
+        return None
+    try:
+        return Decimal(str(value))
+    except InvalidOperation:
+        return None
+
+
+def _lesson_type(value):
+    """ "private lesson", "private_pack" or {"pack": "private"} -> "private"."""
+    if isinstance(value, dict):
+        value = value.get("pack")
+    value = str(value or "")
+    for suffix in (" lesson", "_pack"):
+        if value.endswith(suffix):
+            return value[:-len(suffix)]
+    return value
+
+
+class PriceTable:
+    """
+    The pack and extra prices of a school at one pricing_version.
+
+    packs maps (type, duration, people, classes) to a price; people is None
+    for group pack_prices, which don't depend on it. The pack services'
+    pricing_options, which the app books from, take precedence over
+    pack_prices.
+    """
+
+    def __init__(self, school):
+        self.version = school.pricing_version
+        self.currency = school.currency
+        self.packs = {}
+        self._add_pack_prices(school.pack_prices or {})
+        self._add_services(school.services or [])
+        self.extras = dict(school.extra_prices or {})
+
+    def _add_pack_prices(self, pack_prices):
+        for pack_type, durations in pack_prices.items():
+            for duration, options in (durations or {}).items():
+                for key, value in (options or {}).items():
+                    if pack_type == "group":
+                        # group: duration -> classes -> price
+                        self._set(pack_type, duration, None, key, value)
+                    else:
+                        # private: duration -> people -> classes -> price
+                        for classes, price in (value or {}).items():
+                            self._set(pack_type, duration, key, classes, price)
+
+    def _add_services(self, services):
+        for service in services:
+            pack_type = (service.get("type") or {}).get("pack")
+            if not pack_type:
+                continue
+            for option in (service.get("details") or {}).get("pricing_options", []):
+                self._set(pack_type, option.get("duration"), option.get("people"), option.get("classes"), option.get("price"))
+
+    def _set(self, pack_type, duration, people, classes, price):
+        key = (pack_type, _number(duration), _number(people), _number(classes))
+        price = _price(price)
+        if None not in (key[1], key[3], price):
+            self.packs[key] = price
+
+    def pack_price(self, pack_type, duration, people, classes):
+        """The price of a pack, or None if the school has no price for it."""
+        pack_type, duration, classes = _lesson_type(pack_type), _number(duration), _number(classes)
+        price = self.packs.get((pack_type, duration, _number(people), classes))
+        if price is None:
+            price = self.packs.get((pack_type, duration, None, classes))
+        return price
+
+    def extra_costs(self, extras):
+        """Lesson.get_extra_costs for a lesson's extras JSON."""
+        result = {"students": {}, "grand_total": 0}
+        for student_id, extras_info in extras.items():
+            student_detail = {}
+            total_for_student = 0
+
+            extra_count = extras_info.get("extra_student_count", 0)
+            if extra_count:
+                price_per_student = self.extras.get("extra_students", DEFAULT_EXTRA_STUDENT_PRICE)
+                student_detail["extra_students"] = f"{extra_count}x{price_per_student}"
+                total_for_student += extra_count * price_per_student
+
+            equip_details = {}
+            for equip_data in extras_info.get("equipments", {}).values():
+                equip_name = equip_data.get("name")
+                if not equip_name:
+                    continue
+                unit_price = self.extras.get(equip_name, 0)
+                # one unit per equipment entry
+                equip_details[equip_name] = f"1x{unit_price}"
+                total_for_student += unit_price
+            if equip_details:
+                student_detail["equipments"] = equip_details
+
+            student_detail["total"] = total_for_student
+            result["students"][student_id] = student_detail
+            result["grand_total"] += total_for_student
+        return result
+
+
+class PayRules:
+    """
+    A staff member's pay per lesson at one school, from their copy of the
+    school's payment_types: the fixed prices indexed by (type, duration,
+    students) and the commission percentage per type.
+
+    Rules are keyed by lesson type, so "private lesson" rules also pay
+    "private" lessons; an exact "private" entry wins. Overlapping ranges
+    resolve to the first rule listed, as check_payment_types_conflicts
+    reports them.
+    """
+
+    def __init__(self, payment_types, role="instructor"):
+        self.fixed = {}
+        self.commission = {}
+        role_types = (payment_types or {}).get(role) or {}
+        for key in sorted(role_types, key=lambda key: key != _lesson_type(key)):
+            details = role_types[key]
+            if not isinstance(details, dict):
+                continue  # e.g. "fixed monthly rate"
+            lesson_type = _lesson_type(key)
+            self.commission.setdefault(lesson_type, details.get("commission") or 0)
+            rules = details.get("fixed") or []
+            # update_payment_type_value stores a first rule as a plain dict
+            for rule in [rules] if isinstance(rules, dict) else rules:
+                try:
+                    low, high = int(rule["min_students"]), int(rule["max_students"])
+                    duration = int(rule["duration"])
+                except (KeyError, TypeError, ValueError):
+                    continue
+                for students in range(low, min(high, PAY_RULE_MAX_STUDENTS) + 1):
+                    self.fixed.setdefault((lesson_type, duration, students), rule.get("price"))
+
+    def fixed_price(self, lesson_type, duration, students):
+        """The fixed pay as configured (a number), or None if no rule matches."""
+        return self.fixed.get((_lesson_type(lesson_type), duration, students))
+
+    def pay(self, lesson_type, duration, students, price):
+        """Fixed pay plus the commission on the lesson price, as a Decimal."""
+        fixed = _price(self.fixed_price(lesson_type, duration, students)) or Decimal(0)
+        commission = _price(self.commission.get(_lesson_type(lesson_type))) or Decimal(0)
+        if commission and price:
+            fixed += Decimal(str(price)) * commission / Decimal(100)
+        return fixed
+
+
+def quote_cart(items):
+    """
+    Prices a cart in one pass. Each item is a dict with the School ("school"),
+    "type", "duration_in_minutes", "number_of_students" and
+    "number_of_classes"; every school's table is compiled at most once.
+
+    Returns (prices, total): the price of each item, or None where its
+    school has no price for it, and the sum of the prices found.
+    """
+    prices = []
+    for item in items:
+        school = item.get("school")
+        price = school.get_price_table().pack_price(
+            item.get("type"), item.get("duration_in_minutes"),
+            item.get("number_of_students"), item.get("number_of_classes"),
+        ) if school else None
+        prices.append(price)
+    return prices, sum((price for price in prices if price is not None), Decimal("0.00"))
+
+
+def quote_lessons(lessons):
+    """
+    The pay of every instructor of every lesson, from a fixed number of
+    queries whatever the number of lessons.
+
+    Returns {(lesson pk, instructor pk): Decimal}.
+    """
+    prefetch_related_objects(lessons, "school", "students", "instructors__user")
+    pay = {}
+    for lesson in lessons:
+        if not lesson.school:
+            continue
+        students = len(lesson.students.all())
+        for instructor in lesson.instructors.all():
+            rules = lesson.school.get_pay_rules(instructor.user)
+            pay[(lesson.pk, instructor.pk)] = rules.pay(lesson.type, lesson.duration_in_minutes, students, lesson.price)
+    return pay
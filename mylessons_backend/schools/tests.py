@@ -1,5 +1,25 @@
-from django.test import TestCase
-from schools.models import School
+import datetime as dt
+import io
+import tempfile
+from unittest import mock
+from decimal import Decimal
+
+import pandas as pd
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.exceptions import ValidationError
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from openpyxl import Workbook
+from openpyxl.styles import Font
+from rest_framework.test import APIClient
+from lessons.models import Lesson, Pack
+from payments.models import Payment
+from schools.utils import BulkImporter, ImportFileReader
+from users.models import Instructor, Student, UserAccount
+from schools.models import ImportJob, School, DEFAULT_NOTIFICATION_TEMPLATES, default_pack_prices, validate_notification_templates
+from schools.pricing import quote_cart, quote_lessons
 
 class PackPriceTests(TestCase):
 
@@ -111,3 +131,425 @@ class PackPriceTests(TestCase):
         # Assert "60m" is removed entirely if it's empty
         if not self.school.group_lessons_pack_prices["60m"]:
             self.assertNotIn("60m", self.school.group_lessons_pack_prices)
+
+
+class NotificationTemplateRegistryTests(TestCase):
+
+    def setUp(self):
+        self.school = School.objects.create(name="Test School", notification_templates={})
+
+    def test_defaults_merged_with_school_templates(self):
+        self.school.update_notification_templates({"private_pack_purchased_subject_admin": "Pack sold to {students}"})
+        school = School.objects.get(pk=self.school.pk)
+        self.assertEqual(school.get_notification_template("private_pack_purchased_subject_admin"), "Pack sold to {students}")
+        self.assertEqual(school.get_notification_template("group_pack_purchased_subject_parent"),
+                         DEFAULT_NOTIFICATION_TEMPLATES["group_pack_purchased_subject_parent"])
+        self.assertEqual(school.get_notification_template("private_class_multiple_scheduled_subject_admin"),
+                         DEFAULT_NOTIFICATION_TEMPLATES["private_class_multiple_scheduled_subject_admin"])
+
+    def test_templates_compiled_once_and_refreshed_on_save(self):
+        templates = self.school.get_notification_templates()
+        self.assertIs(School.objects.get(pk=self.school.pk).get_notification_templates(), templates)
+
+        self.school.notification_templates = {"expiration_alert_subject_parent": "Expiring: {type}"}
+        self.school.save()
+        self.assertEqual(self.school.get_notification_template("expiration_alert_subject_parent"), "Expiring: {type}")
+
+    def test_invalid_placeholders_rejected_on_edit(self):
+        with self.assertRaises(ValidationError):
+            self.school.update_notification_templates({"private_pack_purchased_message_parent": "Hi {parentname}"})
+        with self.assertRaises(ValidationError):
+            validate_notification_templates({"conflict_notification_subject": "Conflict {conflict_type"})
+        self.school.refresh_from_db()
+        self.assertEqual(self.school.notification_templates, {})
+
+    def test_placeholders_checked_against_the_role_context(self):
+        # parent_name is only passed to parents
+        with self.assertRaises(ValidationError):
+            validate_notification_templates({"private_pack_purchased_message_instructor": "Hi {parent_name}"})
+        with self.assertRaises(ValidationError):
+            validate_notification_templates({"conflict_notification_subject": "Conflict for {parent_name}"})
+        validate_notification_templates({
+            "private_pack_purchased_message_parent": "Hi {parent_name}",
+            "private_class_scheduled_message_admin": "{students}: {price} {currency}",
+        })
+
+
+class PricingEngineTests(TestCase):
+
+    def setUp(self):
+        self.school = School.objects.create(
+            name="Test School", pack_prices=default_pack_prices(), extra_prices={"extra_students": 12, "helmets": 2},
+            services=[{
+                "id": "surf", "name": "Surf", "type": {"pack": "private"},
+                "details": {"pricing_options": [{"duration": 60, "people": 1, "classes": 4, "time_limit": 30, "price": 99}]},
+            }],
+            payment_types={"instructor": {
+                "fixed monthly rate": None,
+                "private lesson": {"commission": 10, "fixed": [
+                    {"duration": 60, "min_students": 1, "max_students": 2, "price": 15},
+                    {"duration": 60, "min_students": 3, "max_students": 4, "price": 20},
+                ]},
+            }},
+        )
+
+    def test_cart_is_quoted_from_the_compiled_tables(self):
+        school = School.objects.get(pk=self.school.pk)
+        item = {"school": school, "type": "private_pack", "duration_in_minutes": 60, "number_of_classes": 4}
+        cart = [
+            {**item, "number_of_students": 1},  # service price over pack_prices
+            {**item, "number_of_students": 2},
+            {**item, "type": "group", "number_of_students": 5},
+            {**item, "number_of_students": 9},  # no price
+        ]
+        other_instance = School.objects.get(pk=self.school.pk)
+        with self.assertNumQueries(0):
+            prices, total = quote_cart(cart)
+            self.assertIs(other_instance.get_price_table(), school.get_price_table())
+
+        self.assertEqual(prices, [Decimal("99"), Decimal("130"), Decimal("70"), None])
+        self.assertEqual(total, Decimal("299"))
+        self.assertEqual(
+            school.get_price_table().extra_costs({"7": {"extra_student_count": 2, "equipments": {"a": {"name": "helmets"}}}}),
+            {"students": {"7": {"extra_students": "2x12", "equipments": {"helmets": "1x2"}, "total": 26}}, "grand_total": 26},
+        )
+
+        self.school.update_pack_price("private", "60m", "2p", "4c", 125)
+        reloaded = School.objects.get(pk=self.school.pk)
+        self.assertEqual(quote_cart([{**cart[1], "school": reloaded}])[0], [Decimal("125")])
+
+    def test_lesson_batch_pay_in_fixed_queries(self):
+        user = UserAccount.objects.create(username="instructor")
+        instructor = Instructor.objects.create(user=user)
+        self.school.add_instructor(instructor)
+        students = [Student.objects.create(first_name=f"S{i}", last_name="X") for i in range(3)]
+        lessons = []
+        for count in (1, 3):
+            lesson = Lesson.objects.create(duration_in_minutes=60, price=Decimal("50.00"), school=self.school, type="private")
+            lesson.students.add(*students[:count])
+            lesson.instructors.add(instructor)
+            lessons.append(lesson)
+
+        batch = list(Lesson.objects.filter(pk__in=[lesson.pk for lesson in lessons]).order_by("pk"))
+        with self.assertNumQueries(4):
+            pay = quote_lessons(batch)
+
+        self.assertEqual(pay, {(lessons[0].pk, instructor.pk): Decimal("20.00"), (lessons[1].pk, instructor.pk): Decimal("25.00")})
+        self.assertEqual(lessons[1].get_fixed_price(instructor), 20)
+
+    def test_direct_edits_recompile_the_tables(self):
+        school = School.objects.get(pk=self.school.pk)
+        version = school.pricing_version
+        school.get_price_table()
+        school.name = "Renamed School"
+        school.save(update_fields=["name"])
+        self.assertEqual(school.pricing_version, version)
+
+        # as the admin or the shell would: no price helper involved
+        school.extra_prices["helmets"] = 5
+        school.save()
+        reloaded = School.objects.get(pk=self.school.pk)
+        self.assertNotEqual(reloaded.pricing_version, version)
+        self.assertEqual(reloaded.get_price_table().extras["helmets"], 5)
+
+    def test_pay_rules_follow_the_users_payment_types(self):
+        user = UserAccount.objects.create(username="instructor")
+        self.school.add_payment_types_to_user(user)
+        self.assertEqual(self.school.get_pay_rules(user).fixed_price("private", 60, 1), 15)
+
+        user.payment_types[self.school.name]["instructor"]["private lesson"]["fixed"][0]["price"] = 18
+        user.save(update_fields=["payment_types"])
+        self.assertEqual(self.school.get_pay_rules(UserAccount.objects.get(pk=user.pk)).fixed_price("private", 60, 1), 18)
+
+
+class BulkImportTests(TestCase):
+
+    def setUp(self):
+        self.school = School.objects.create(name="Test School")
+        self.parent = UserAccount.objects.create(username="parent")
+        self.instructor_user = UserAccount.objects.create(username="instructor")
+
+    def frames(self, lessons=3):
+        return {
+            "Students": pd.DataFrame({
+                "id": [1.0, 2.0, None],
+                "first_name": ["Alice", "Bob", "Nobody"],
+                "last_name": ["Smith", "Jones", ""],
+                "birthday": ["2015-01-02", dt.datetime(2016, 3, 4), None],
+                "level": [1, "2", None],
+            }),
+            "Instructors": pd.DataFrame({"id": ["i1"], "user_id": [self.instructor_user.pk]}),
+            "Lessons": pd.DataFrame({
+                "id": [f"l{i}" for i in range(lessons)],
+                "date": ["2025-01-02"] * lessons,
+                "start_time": ["10:00:00"] * lessons,
+                "duration_in_minutes": [None] * lessons,
+                "price": ["12.5"] * lessons,
+                "is_done": ["TRUE"] + ["FALSE"] * (lessons - 1),
+                "student_ids": ["1, 2"] + ["2"] * (lessons - 1),
+                "instructor_ids": ["i1"] * lessons,
+            }),
+            "Packs": pd.DataFrame({
+                "id": ["p1"],
+                "date": [None],
+                "finished_date": ["2025-02-01"],
+                "number_of_classes": [4],
+                "price": [100],
+                "is_paid": ["yes"],
+                "student_ids": ["1"],
+                "parent_ids": [str(self.parent.pk)],
+                "lesson_ids": [",".join(f"l{i}" for i in range(lessons))],
+            }),
+            "Payments": pd.DataFrame({
+                "id": ["pay1", "pay2"],
+                "value": [50, 10],
+                "user_id": [self.parent.pk, 999999],
+                "pack_ids": ["p1", None],
+            }),
+            "Notes": pd.DataFrame({"x": [1]}),
+        }
+
+    def test_import_upserts_and_links_every_sheet(self):
+        results = BulkImporter(self.school).run(self.frames())
+
+        self.assertEqual(results["students"]["imported"], 2)
+        self.assertEqual(results["students"]["errors"], [{"row": 4, "old_id": "", "error": "Missing id."}])
+        self.assertEqual(results["payments"]["errors"][0]["error"], "User 999999 does not exist.")
+        self.assertEqual(results["notes"], {"error": "No importer for this sheet."})
+
+        alice = Student.objects.get(old_id_str="1")
+        self.assertEqual((alice.birthday, alice.level), (dt.date(2015, 1, 2), 1))
+        self.assertEqual(Student.objects.get(old_id_str="2").birthday, dt.date(2016, 3, 4))
+        self.assertEqual(set(self.school.students.values_list("old_id_str", flat=True)), {"1", "2"})
+        instructor = Instructor.objects.get(old_id_str="i1")
+        self.assertIn(instructor, self.school.instructors.all())
+
+        lesson = Lesson.objects.get(old_id_str="l0")
+        self.assertEqual((lesson.start_time, lesson.duration_in_minutes, lesson.price, lesson.school), (dt.time(10), 60, Decimal("12.50"), self.school))
+        self.assertEqual(set(lesson.students.values_list("old_id_str", flat=True)), {"1", "2"})
+        self.assertEqual(list(lesson.instructors.all()), [instructor])
+
+        pack = Pack.objects.get(old_id_str="p1")
+        self.assertEqual(pack.date, dt.date(2025, 2, 1))
+        self.assertTrue(pack.is_paid)
+        self.assertEqual(pack.lessons.count(), 3)
+        self.assertEqual(pack.number_of_classes_left, 3)
+        self.assertEqual(list(pack.parents.all()), [self.parent])
+        self.assertEqual(list(Payment.objects.get(old_id_str="pay1").packs.all()), [pack])
+
+    def test_reimport_updates_in_place_and_replaces_links(self):
+        BulkImporter(self.school).run(self.frames())
+        frames = self.frames()
+        frames["Lessons"].loc[0, "student_ids"] = "2"
+        frames["Students"].loc[0, "first_name"] = "Alicia"
+        BulkImporter(self.school).run(frames)
+
+        self.assertEqual(Student.objects.count(), 2)
+        self.assertEqual(Student.objects.get(old_id_str="1").first_name, "Alicia")
+        self.assertEqual(Lesson.objects.count(), 3)
+        self.assertEqual(list(Lesson.objects.get(old_id_str="l0").students.values_list("old_id_str", flat=True)), ["2"])
+
+    def test_lessons_link_to_packs_defined_later_in_the_file(self):
+        frames = self.frames()
+        frames["Lessons"]["pack_ids"] = ["p1", "p1", None]
+        buffer = io.BytesIO()
+        with pd.ExcelWriter(buffer) as writer:
+            for name in ("Students", "Lessons", "Packs"):
+                frames[name].to_excel(writer, sheet_name=name, index=False, startrow=1)
+        buffer.seek(0)
+
+        results = BulkImporter(self.school).run(frames)
+        self.assertEqual(results["lessons"]["errors"], [])
+        pack = Pack.objects.get(old_id_str="p1")
+        self.assertEqual(set(pack.lessons_many.values_list("old_id_str", flat=True)), {"l0", "l1"})
+
+        Lesson.objects.all().delete()
+        Pack.objects.all().delete()
+        with ImportFileReader(buffer, name="import.xlsx", chunk_size=1) as reader:
+            BulkImporter(self.school).run_file(reader)
+        pack = Pack.objects.get(old_id_str="p1")
+        self.assertEqual(set(pack.lessons_many.values_list("old_id_str", flat=True)), {"l0", "l1"})
+
+    def test_rows_are_written_in_bulk(self):
+        def queries(lessons):
+            Lesson.objects.all().delete()
+            with CaptureQueriesContext(connection) as context:
+                BulkImporter(self.school).run({"Lessons": self.frames(lessons)["Lessons"]})
+            return len(context)
+
+        # only SQLite's bound-parameter limit splits the bulk statements
+        self.assertEqual(queries(5), 8)
+        self.assertLess(queries(200), 15)
+
+    def test_view_imports_the_uploaded_workbook(self):
+        admin = UserAccount.objects.create(username="admin", current_role="Admin", current_school_id=self.school.pk)
+        buffer = io.BytesIO()
+        with pd.ExcelWriter(buffer) as writer:
+            self.frames()["Students"].to_excel(writer, sheet_name="Students", index=False, startrow=1)
+        buffer.seek(0)
+        buffer.name = "import.xlsx"
+        client = APIClient()
+        client.force_authenticate(admin)
+
+        response = client.post(reverse("bulk-import"), {"file": buffer, "target": "student"}, format="multipart")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["students"]["imported"], 2)
+        self.assertEqual(Student.objects.count(), 2)
+
+    def test_reader_streams_sheets_in_import_order_and_bounded_chunks(self):
+        workbook = Workbook()
+        lessons = workbook.active
+        lessons.title = "Lessons"
+        lessons.append(["Lessons"])
+        lessons.append(["id", "date"])
+        for row in (["l0", "2025-01-02"], ["l1", None], [None, None], ["l3", dt.datetime(2025, 1, 3)], ["l4", None]):
+            lessons.append(row)
+        lessons.cell(row=12, column=1).font = Font(bold=True)  # formatted but empty tail
+        workbook.create_sheet("Students").append(["Students"])
+        buffer = io.BytesIO()
+        workbook.save(buffer)
+        buffer.seek(0)
+
+        with ImportFileReader(buffer, name="import.xlsx", chunk_size=2) as reader:
+            self.assertEqual([sheet[:2] for sheet in reader.sheets()], [("students", "student"), ("lessons", "lesson")])
+            chunks = list(reader.chunks("lessons"))
+            resumed = list(reader.chunks("lessons", start=3))
+
+        self.assertEqual([(start, len(df)) for start, df in chunks], [(0, 2), (2, 2), (4, 1)])
+        self.assertEqual(list(chunks[0][1].columns), ["id", "date"])
+        self.assertIsNone(chunks[1][1].iloc[0]["id"])
+        self.assertEqual(chunks[1][1].iloc[1]["date"], dt.datetime(2025, 1, 3))
+        self.assertEqual([(start, df["id"].tolist()) for start, df in resumed], [(3, ["l3", "l4"])])
+
+    def test_view_imports_a_csv_as_the_target_sheet(self):
+        admin = UserAccount.objects.create(username="admin", current_role="Admin", current_school_id=self.school.pk)
+        upload = SimpleUploadedFile("students.csv", b"id,first_name,level\n1,Alice,2\n,Nobody,\n2,Bob,\n")
+        client = APIClient()
+        client.force_authenticate(admin)
+
+        response = client.post(reverse("bulk-import"), {"file": upload, "target": "student"}, format="multipart")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["student"]["imported"], 2)
+        self.assertEqual(response.json()["student"]["errors"][0]["row"], 3)
+        self.assertEqual(Student.objects.get(old_id_str="1").level, 2)
+
+    def test_dry_run_reports_bad_rows_without_writing(self):
+        Student.objects.create(first_name="Existing", old_id_str="9")
+        admin = UserAccount.objects.create(username="admin", current_role="Admin", current_school_id=self.school.pk)
+        frames = self.frames()
+        frames["Students"] = pd.concat([frames["Students"], pd.DataFrame({"id": [1.0], "first_name": ["Again"]})])
+        frames["Lessons"].loc[1, ["date", "student_ids", "pack_ids"]] = ["someday", "2, 9, 42", "p1"]
+        buffer = io.BytesIO()
+        with pd.ExcelWriter(buffer) as writer:
+            for name, df in frames.items():
+                df.to_excel(writer, sheet_name=name, index=False, startrow=1)
+        buffer.seek(0)
+        buffer.name = "import.xlsx"
+        client = APIClient()
+        client.force_authenticate(admin)
+
+        with CaptureQueriesContext(connection) as context:
+            response = client.post(reverse("bulk-import"), {"file": buffer, "target": "student", "dry_run": "true"}, format="multipart")
+
+        report = response.json()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(report["students"]["errors"], [
+            {"row": 4, "old_id": "", "error": "Missing id."},
+            {"row": 5, "old_id": "1", "error": "Duplicate id, first used on row 2."},
+        ])
+        self.assertEqual((report["students"]["rows"], report["students"]["valid"]), (4, 2))
+        self.assertEqual(report["lessons"]["errors"], [
+            {"row": 3, "old_id": "l1", "error": "Invalid date in date: someday"},
+            {"row": 3, "old_id": "l1", "error": "Unknown student id 42 in student_ids."},
+        ])
+        self.assertEqual(report["packs"]["errors"], [])
+        self.assertEqual(report["payments"]["errors"], [{"row": 3, "old_id": "pay2", "error": "User 999999 does not exist."}])
+        self.assertEqual(report["notes"], {"error": "No importer for this sheet."})
+        # one lookup per referenced model, whatever the number of rows
+        self.assertLessEqual(len([query for query in context.captured_queries if "SELECT" in query["sql"]]), 8)
+        self.assertEqual((Student.objects.count(), Lesson.objects.count(), Payment.objects.count()), (1, 0, 0))
+
+        # the import does what the dry run predicted: l1 is linked to p1, defined in a later sheet
+        buffer.seek(0)
+        client.post(reverse("bulk-import"), {"file": buffer, "target": "student"}, format="multipart")
+        self.assertEqual(list(Lesson.objects.get(old_id_str="l1").packs.values_list("old_id_str", flat=True)), ["p1"])
+
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp())
+class ImportJobTests(TestCase):
+
+    def setUp(self):
+        self.school = School.objects.create(name="Test School")
+        self.admin = UserAccount.objects.create(username="admin", current_role="Admin", current_school_id=self.school.pk)
+        self.client = APIClient()
+        self.client.force_authenticate(self.admin)
+
+    def upload(self, lessons=5, pack_ids=None):
+        buffer = io.BytesIO()
+        with pd.ExcelWriter(buffer) as writer:
+            pd.DataFrame({"id": ["1", "2"], "first_name": ["Alice", "Bob"]}).to_excel(writer, sheet_name="Students", index=False, startrow=1)
+            pd.DataFrame({
+                "id": [f"l{i}" for i in range(lessons)],
+                "date": ["2025-01-02"] * lessons,
+                "student_ids": ["1"] * lessons,
+                **({"pack_ids": [pack_ids] * lessons} if pack_ids else {}),
+            }).to_excel(writer, sheet_name="Lessons", index=False, startrow=1)
+            if pack_ids:
+                pd.DataFrame({"id": [pack_ids], "number_of_classes": [lessons]}).to_excel(writer, sheet_name="Packs", index=False, startrow=1)
+        buffer.seek(0)
+        buffer.name = "import.xlsx"
+        response = self.client.post(reverse("bulk-import"), {"file": buffer, "target": "lesson", "background": "true"}, format="multipart")
+        self.assertEqual(response.status_code, 202)
+        return ImportJob.objects.get(pk=response.json()["id"])
+
+    def test_upload_is_queued_and_processed_in_chunks(self):
+        job = self.upload()
+        self.assertEqual((job.status, Lesson.objects.count()), (ImportJob.PENDING, 0))
+
+        self.assertEqual(ImportJob.claim_next(), job)
+        self.assertTrue(job.process(chunk_size=2))
+
+        response = self.client.get(reverse("import-job-status", args=[job.pk]))
+        self.assertEqual(response.json()["status"], ImportJob.DONE)
+        self.assertEqual(response.json()["rows_done"], 7)
+        self.assertEqual(response.json()["sheets"]["lessons"]["imported"], 5)
+        self.assertEqual(Lesson.objects.filter(students__old_id_str="1").count(), 5)
+        self.assertIsNone(ImportJob.claim_next())
+
+    def test_job_links_lessons_to_packs_of_the_same_file(self):
+        job = self.upload(pack_ids="p1")
+        self.assertTrue(ImportJob.claim_next().process(chunk_size=2))
+
+        self.assertEqual(Pack.objects.get(old_id_str="p1").lessons_many.count(), 5)
+
+    def test_failed_job_resumes_after_the_last_committed_chunk(self):
+        job = self.upload()
+        import_lesson = BulkImporter._import_lesson
+        calls = []
+
+        def fail_second_chunk(importer, df, first_row):
+            calls.append(first_row)
+            if len(calls) == 2:
+                raise ValueError("Database went away")
+            return import_lesson(importer, df, first_row)
+
+        with mock.patch.object(BulkImporter, "_import_lesson", fail_second_chunk):
+            self.assertFalse(ImportJob.claim_next().process(chunk_size=2))
+
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.error), (ImportJob.FAILED, "Database went away"))
+        self.assertEqual(job.progress["lessons"]["rows_done"], 2)
+        self.assertEqual(Lesson.objects.count(), 2)
+
+        response = self.client.post(reverse("import-job-resume", args=[job.pk]))
+        self.assertEqual(response.status_code, 202)
+        with mock.patch.object(BulkImporter, "_import_lesson", fail_second_chunk):
+            self.assertTrue(ImportJob.claim_next().process(chunk_size=2))
+
+        # the committed chunk is not imported again
+        self.assertEqual(calls, [2, 4, 4, 6])
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.progress["lessons"]["imported"]), (ImportJob.DONE, 5))
+        self.assertEqual(Lesson.objects.count(), 5)
@@ -1,7 +1,7 @@
 from django.urls import path
 
 from equipment.views import CreateEquipmentView
-from .views import UpdateContactsView, add_instructor, add_staff_view, check_user_view, create_location, create_review, create_subject, get_all_locations, get_all_subjects, get_equipments, get_school_time_limit, remove_instructor,delete_payment_type_entry_view ,number_of_bookings_in_timeframe, school_revenue_in_timeframe, number_of_students_in_timeframe, number_of_instructors_in_timeframe, update_pack_price_view, school_details_view, update_payment_type_view, all_schools, get_services, add_edit_service, create_school, update_school_locations, update_school_subjects
+from .views import UpdateContactsView, add_instructor, add_staff_view, check_user_view, create_location, create_review, create_subject, get_all_locations, get_all_subjects, get_equipments, get_school_time_limit, remove_instructor,delete_payment_type_entry_view ,number_of_bookings_in_timeframe, school_revenue_forecast, school_revenue_in_timeframe, number_of_students_in_timeframe, number_of_instructors_in_timeframe, update_pack_price_view, school_details_view, update_payment_type_view, all_schools, get_services, add_edit_service, create_school, update_school_locations, update_school_subjects
 
 urlpatterns = [
     path('add_instructor/', add_instructor, name='add_instructor'),
@@ -10,6 +10,7 @@ urlpatterns = [
     path('number_of_students/<int:school_id>/<str:start_date>/<str:end_date>/', number_of_students_in_timeframe, name='number_of_students_in_timeframe'),
     path('number_of_instructors/<int:school_id>/<str:start_date>/<str:end_date>/', number_of_instructors_in_timeframe, name='number_of_instructors_in_timeframe'),
     path('school-revenue/<int:school_id>/<str:start_date>/<str:end_date>/', school_revenue_in_timeframe, name='school_revenue_in_timeframe'),
+    path('school-revenue-forecast/<int:school_id>/', school_revenue_forecast, name='school_revenue_forecast'),
     path('update_pack_price/', update_pack_price_view, name='update_pack_price'),
     path('update_payment_type/', update_payment_type_view, name='update_payment_type'),
     path('delete_payment_type_entry/', delete_payment_type_entry_view, name='delete_payment_type_entry'),
@@ -0,0 +1,720 @@
+import datetime as dt
+import os
+from decimal import Decimal
+from itertools import islice
+
+import numpy as np
+import pandas as pd
+from openpyxl import load_workbook
+from django.db import transaction
+from django.db.models import Count
+
+from lessons.models import Lesson, Pack
+from payments.models import Payment
+from payments.utils import invalidate_revenue_forecast
+from sports.models import Sport
+from users.models import Instructor, Student, UserAccount
+
+# Sheets are imported in this order so references to earlier sheets resolve;
+# the few that point the other way are listed in IMPORT_LATE_REFERENCES
+IMPORT_ORDER = ('student', 'instructor', 'lesson', 'pack', 'payment')
+IMPORT_BATCH_SIZE = 1000
+FIRST_DATA_ROW = 2  # row number reported for a sheet's first data row
+IMPORT_CHUNK_SIZE = 1000  # rows read and upserted at a time
+XLSX_HEADER_ROW = 2  # the template has a title row above the headers
+TRUE_VALUES = ['true', '1', '1.0', 'yes', 'y']
+BLANK_VALUES = ['', 'nan', 'none', 'nat']
+
+# Typed columns of every sheet, checked by the dry run
+IMPORT_COLUMN_TYPES = {
+    'student': {'birthday': 'date', 'level': 'int'},
+    'instructor': {},
+    'lesson': {
+        'date': 'date', 'start_time': 'time', 'end_time': 'time', 'duration_in_minutes': 'int',
+        'class_number': 'int', 'price': 'decimal',
+    },
+    'pack': {
+        'date': 'date', 'finished_date': 'date', 'expiration_date': 'date', 'number_of_classes': 'int',
+        'duration_in_minutes': 'int', 'price': 'decimal', 'debt': 'decimal', 'sport_id': 'int',
+    },
+    'payment': {'value': 'decimal'},
+}
+# Columns holding ids of other sheets' rows, or of users ('user' are UserAccount pks)
+IMPORT_REFERENCES = {
+    'student': {},
+    'instructor': {'user_id': 'user'},
+    'lesson': {'student_ids': 'student', 'instructor_ids': 'instructor', 'pack_ids': 'pack'},
+    'pack': {'student_ids': 'student', 'instructor_ids': 'instructor', 'lesson_ids': 'lesson', 'parent_ids': 'user'},
+    'payment': {'user_id': 'user', 'pack_ids': 'pack', 'lesson_ids': 'lesson'},
+}
+IMPORT_MODELS = {'student': Student, 'instructor': Instructor, 'lesson': Lesson, 'pack': Pack, 'payment': Payment}
+# Many-to-many columns that reference a sheet imported later: (column, field, model), linked once every sheet is in
+IMPORT_LATE_REFERENCES = {'lesson': [('pack_ids', 'packs', Pack)]}
+
+
+def import_sheet_key(name):
+    """Importer key of a sheet name ('Students', 'lesson', ...), or None if there is no importer for it."""
+    key = str(name).strip().lower()
+    if key.endswith('s'):
+        key = key[:-1]
+    return key if key in IMPORT_ORDER else None
+
+
+def normalize_import_frame(df):
+    """Lower-cases the headers, renames 'id' to 'old_id_str' and numbers the rows from 0."""
+    df = df.reset_index(drop=True)
+    df.columns = [str(col).strip().lower() for col in df.columns]
+    if 'id' in df.columns and 'old_id_str' not in df.columns:
+        df = df.rename(columns={'id': 'old_id_str'})
+    return df
+
+
+# Column parsers: each takes a whole column and returns a list of python values, one per row.
+
+def _column(df, name):
+    if name in df.columns:
+        return df[name]
+    return pd.Series(None, index=df.index, dtype=object)
+
+
+def _blank(text):
+    return text.isna() | text.str.lower().isin(BLANK_VALUES)
+
+
+def parse_text_column(series, default=None):
+    text = series.astype('string').str.strip()
+    text = text.mask(_blank(text))
+    return [default if value is pd.NA else value for value in text.tolist()]
+
+
+def parse_id_column(series):
+    """Ids as text; Excel returns numeric ids as floats, so '12.0' becomes '12'."""
+    text = series.astype('string').str.strip().str.replace(r'\.0+$', '', regex=True)
+    text = text.mask(_blank(text))
+    return [None if value is pd.NA else value for value in text.tolist()]
+
+
+def parse_int_column(series, default=None):
+    numbers = np.trunc(pd.to_numeric(series, errors='coerce'))
+    if default is not None:
+        numbers = numbers.fillna(default)
+    return [None if np.isnan(number) else int(number) for number in numbers.to_numpy(dtype=float)]
+
+
+def parse_decimal_column(series):
+    numbers = pd.to_numeric(series, errors='coerce').fillna(0).round(2)
+    return [Decimal(f'{number:.2f}') for number in numbers.to_numpy(dtype=float)]
+
+
+def parse_bool_column(series):
+    return series.astype('string').str.strip().str.lower().isin(TRUE_VALUES).fillna(False).tolist()
+
+
+def parse_datetime_column(series):
+    """Column as datetime64, with unparseable cells as NaT."""
+    return pd.to_datetime(series.astype('string'), errors='coerce', format='mixed')
+
+
+def datetime_column_values(parsed, part):
+    values = getattr(parsed.dt, part)
+    return values.astype(object).where(parsed.notna(), None).tolist()
+
+
+def parse_date_column(series):
+    return datetime_column_values(parse_datetime_column(series), 'date')
+
+
+def parse_time_column(series):
+    return datetime_column_values(parse_datetime_column(series), 'time')
+
+
+def parse_id_list_column(series):
+    """
+    Explodes a column of comma separated ids into one (row, id) entry per
+    reference: a Series of ids indexed by row.
+    """
+    refs = series.dropna().astype('string').str.split(',').explode().str.strip()
+    refs = refs.str.replace(r'\.0+$', '', regex=True)
+    return refs[~_blank(refs)]
+
+
+class ImportFileReader:
+    """
+    Streams the sheets of an uploaded .xlsx or .csv in DataFrames of at most
+    chunk_size rows, so memory does not grow with the file. Workbooks are
+    opened with openpyxl in read-only mode and their headers are on
+    XLSX_HEADER_ROW; a CSV is a single sheet with its headers on the first
+    line, named after the import target or else the file name.
+    """
+
+    def __init__(self, file, name=None, target=None, chunk_size=IMPORT_CHUNK_SIZE):
+        self.file = file
+        self.name = name or getattr(file, 'name', '') or ''
+        self.chunk_size = chunk_size
+        self.is_csv = self.name.lower().endswith('.csv')
+        if self.is_csv:
+            self.workbook = None
+            self.csv_sheet = target or os.path.splitext(os.path.basename(self.name))[0]
+        else:
+            self.workbook = load_workbook(file, read_only=True, data_only=True)
+
+    def close(self):
+        if self.workbook is not None:
+            self.workbook.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def sheets(self):
+        """
+        [(lower-cased name, importer key or None, rows or None)] in import
+        order, followed by the sheets there is no importer for.
+        """
+        if self.is_csv:
+            sheets = [(str(self.csv_sheet).lower(), import_sheet_key(self.csv_sheet), None)]
+        else:
+            sheets = []
+            for name in self.workbook.sheetnames:
+                max_row = self.workbook[name].max_row
+                rows = max(max_row - XLSX_HEADER_ROW, 0) if max_row else None
+                sheets.append((name.lower(), import_sheet_key(name), rows))
+        return sorted(sheets, key=lambda sheet: IMPORT_ORDER.index(sheet[1]) if sheet[1] else len(IMPORT_ORDER))
+
+    def chunks(self, name, start=0):
+        """Yields (offset of the first row, DataFrame) of a sheet, skipping its first start rows."""
+        if self.is_csv:
+            yield from self._csv_chunks(start)
+        else:
+            yield from self._xlsx_chunks(name, start)
+
+    def _csv_chunks(self, start):
+        self.file.seek(0)
+        reader = pd.read_csv(
+            self.file, dtype=str, chunksize=self.chunk_size,
+            skiprows=range(1, start + 1), skip_blank_lines=False,
+        )
+        for df in reader:
+            yield start, df
+            start += len(df)
+
+    def _xlsx_chunks(self, name, start):
+        worksheet = next(
+            self.workbook[sheet] for sheet in self.workbook.sheetnames if sheet.lower() == name
+        )
+        header = next(worksheet.iter_rows(min_row=XLSX_HEADER_ROW, max_row=XLSX_HEADER_ROW, values_only=True), ())
+        rows = self._data_rows(worksheet.iter_rows(min_row=XLSX_HEADER_ROW + 1 + start, values_only=True))
+        while True:
+            chunk = list(islice(rows, self.chunk_size))
+            if not chunk:
+                return
+            yield start, pd.DataFrame.from_records([row[:len(header)] for row in chunk], columns=header)
+            start += len(chunk)
+
+    @staticmethod
+    def _data_rows(rows):
+        """
+        Passes the rows through, holding back empty ones until a filled row
+        follows: empty rows inside the sheet keep the row numbers aligned,
+        while the formatted-but-empty tail of a sheet is dropped.
+        """
+        blanks = []
+        for row in rows:
+            if all(cell is None or cell == '' for cell in row):
+                blanks.append(row)
+                continue
+            yield from blanks
+            blanks.clear()
+            yield row
+
+
+class BulkImporter:
+    """
+    Set-based importer for the bulk Excel import. Every sheet is upserted on
+    old_id_str with bulk_create(update_conflicts=True), references are
+    resolved through old_id_str -> pk maps loaded once per entity, and
+    many-to-many columns replace the existing links with one delete and one
+    bulk insert into the through table. Each sheet runs in its own
+    transaction, so the number of queries does not grow with the rows.
+    """
+
+    def __init__(self, school):
+        self.school = school
+        self.id_maps = {}  # model -> {old_id_str: pk}
+
+    def run(self, frames):
+        """Imports {sheet name: DataFrame}. Returns a report per sheet."""
+        results = {}
+        keyed = {}
+        for name, df in frames.items():
+            key = import_sheet_key(name)
+            if key is None:
+                results[str(name).lower()] = {'error': 'No importer for this sheet.'}
+            else:
+                keyed[key] = (str(name).lower(), df)
+        for key in IMPORT_ORDER:
+            if key in keyed:
+                name, df = keyed[key]
+                results[name] = self.import_sheet(key, df)
+        for key, (name, df) in keyed.items():
+            columns = normalize_import_frame(df).columns
+            if any(column in columns for column, _, _ in IMPORT_LATE_REFERENCES.get(key, [])):
+                results[name]['errors'].extend(self.link_chunks(key, [df]))
+        return results
+
+    def run_file(self, reader):
+        """Imports every sheet of an ImportFileReader chunk by chunk. Returns a report per sheet."""
+        results = {}
+        for name, key, _rows in reader.sheets():
+            if key is None:
+                results[name] = {'error': 'No importer for this sheet.'}
+            else:
+                results[name] = self.import_chunks(
+                    key, ((FIRST_DATA_ROW + start, df) for start, df in reader.chunks(name))
+                )
+        for name, key, _rows in reader.sheets():
+            if key in IMPORT_LATE_REFERENCES:
+                results[name]['errors'].extend(self.link_chunks(key, (df for _start, df in reader.chunks(name))))
+        return results
+
+    def import_sheet(self, key, df, first_row=FIRST_DATA_ROW):
+        """Imports one sheet in a transaction. Returns {'imported': n, 'errors': [...]}."""
+        return self.import_chunks(key, [(first_row, df)])
+
+    def import_chunks(self, key, chunks):
+        """Imports the (first row, DataFrame) chunks of one sheet in a single transaction."""
+        result = {'imported': 0, 'errors': []}
+        try:
+            with transaction.atomic():
+                for first_row, df in chunks:
+                    chunk_result = self.import_chunk(key, df, first_row)
+                    result['imported'] += chunk_result['imported']
+                    result['errors'].extend(chunk_result['errors'])
+                return result
+        except Exception as e:
+            # the sheet was rolled back; forget pks that may not exist anymore
+            self.id_maps.clear()
+            return {'imported': 0, 'errors': [{'row': None, 'error': str(e)}]}
+
+    def import_chunk(self, key, df, first_row=FIRST_DATA_ROW):
+        """
+        Imports rows of a sheet in the caller's transaction; first_row is the
+        row number reported for the first of them.
+        """
+        result = getattr(self, f'_import_{key}')(normalize_import_frame(df), first_row)
+        if key in ('lesson', 'pack', 'payment'):
+            # the bulk writes send no signals
+            invalidate_revenue_forecast(self.school.pk)
+        return result
+
+    def link_chunks(self, key, chunks):
+        """
+        Links the rows of a sheet to a sheet imported after it (a lesson's
+        pack_ids), in one transaction once every sheet has been upserted.
+        Returns the errors, like import_chunks.
+        """
+        try:
+            with transaction.atomic():
+                for df in chunks:
+                    self.link_chunk(key, df)
+        except Exception as e:
+            self.id_maps.clear()
+            return [{'row': None, 'error': str(e)}]
+        return []
+
+    def link_chunk(self, key, df):
+        """Sets the IMPORT_LATE_REFERENCES columns of rows of a sheet, in the caller's transaction."""
+        df = normalize_import_frame(df)
+        model = IMPORT_MODELS[key]
+        for column, name, target in IMPORT_LATE_REFERENCES.get(key, []):
+            refs = parse_id_list_column(_column(df, column))
+            if not len(refs):
+                continue
+            # with duplicate ids the last row wins, as in _rows
+            last_row = {old_id: row for row, old_id in enumerate(parse_id_column(_column(df, 'old_id_str'))) if old_id}
+            owners = self.id_map(model, last_row.keys())
+            owner_by_row = {row: owners[old_id] for old_id, row in last_row.items() if old_id in owners}
+            self._replace_m2m(model, name, owner_by_row, refs, self.id_map(target, set(refs)))
+
+    # -- id maps ---------------------------------------------------------------
+
+    def id_map(self, model, old_ids):
+        """{old_id_str: pk} of the given ids, loading the ones not seen yet in one query."""
+        known = self.id_maps.setdefault(model, {})
+        missing = {old_id for old_id in old_ids if old_id not in known}
+        if missing:
+            known.update(model.objects.filter(old_id_str__in=missing).values_list('old_id_str', 'pk'))
+        return known
+
+    def _upsert(self, model, old_ids, values, update_fields):
+        """
+        Inserts or updates one object per old id with its field values, and
+        returns the old_id_str -> pk map of the rows. pks are read back
+        instead of taken from bulk_create, which does not return them on MySQL.
+        """
+        objects = [model(old_id_str=old_id, **fields) for old_id, fields in zip(old_ids, values)]
+        model.objects.bulk_create(
+            objects, batch_size=IMPORT_BATCH_SIZE,
+            update_conflicts=True, unique_fields=['old_id_str'], update_fields=update_fields,
+        )
+        known = self.id_maps.setdefault(model, {})
+        for old_id in old_ids:
+            known.pop(old_id, None)
+        return self.id_map(model, old_ids)
+
+    # -- relations -------------------------------------------------------------
+
+    def _replace_m2m(self, model, name, owner_by_row, refs, target_by_ref):
+        """
+        Sets model.<name> of every row that lists references, like
+        related_manager.set() did per row. Unknown references are skipped.
+        """
+        field = model._meta.get_field(name)
+        through = field.remote_field.through
+        source, target = field.m2m_column_name(), field.m2m_reverse_name()
+        owners, links = set(), set()
+        for row, ref in refs.items():
+            owner = owner_by_row.get(row)
+            if owner is None:
+                continue
+            owners.add(owner)
+            if target_by_ref.get(ref) is not None:
+                links.add((owner, target_by_ref[ref]))
+        if not owners:
+            return
+        through.objects.filter(**{f'{source}__in': owners}).delete()
+        through.objects.bulk_create(
+            [through(**{source: owner, target: target_pk}) for owner, target_pk in links],
+            batch_size=IMPORT_BATCH_SIZE,
+        )
+
+    def _add_to_school(self, name, pks):
+        """Adds the pks to school.<name> (students, instructors) in one insert."""
+        field = self.school._meta.get_field(name)
+        through = field.remote_field.through
+        source, target = field.m2m_column_name(), field.m2m_reverse_name()
+        through.objects.bulk_create(
+            [through(**{source: self.school.pk, target: pk}) for pk in pks],
+            batch_size=IMPORT_BATCH_SIZE, ignore_conflicts=True,
+        )
+
+    def _user_map(self, refs):
+        """{ref: pk} of the existing users among user ids given as text."""
+        ids = {int(ref) for ref in refs if str(ref).isdigit()}
+        return {str(pk): pk for pk in UserAccount.objects.filter(pk__in=ids).values_list('pk', flat=True)}
+
+    # -- rows ------------------------------------------------------------------
+
+    def _rows(self, df, first_row, extra_errors=None):
+        """
+        The rows to import: (positions, old ids, errors, imported count).
+        Rows without an id can't be upserted and rows in extra_errors
+        ({position: message}) are rejected; both are reported. With duplicate
+        ids the last row wins, as with the row by row import.
+        """
+        old_ids = parse_id_column(_column(df, 'old_id_str'))
+        errors = []
+        keep = []
+        seen = {}
+        for position, old_id in enumerate(old_ids):
+            if old_id is None:
+                errors.append({'row': position + first_row, 'old_id': '', 'error': 'Missing id.'})
+                continue
+            if extra_errors and position in extra_errors:
+                errors.append({'row': position + first_row, 'old_id': old_id, 'error': extra_errors[position]})
+                continue
+            seen[old_id] = position
+            keep.append(position)
+        last = set(seen.values())
+        positions = [position for position in keep if position in last]
+        return positions, [old_ids[position] for position in positions], errors, len(keep)
+
+    def _import_student(self, df, first_row):
+        positions, old_ids, errors, imported = self._rows(df, first_row)
+        first_names = parse_text_column(_column(df, 'first_name'), default='')
+        last_names = parse_text_column(_column(df, 'last_name'), default='')
+        birthdays = parse_date_column(_column(df, 'birthday'))
+        levels = parse_int_column(_column(df, 'level'))
+
+        values = [
+            {'first_name': first_names[p], 'last_name': last_names[p], 'birthday': birthdays[p], 'level': levels[p]}
+            for p in positions
+        ]
+        pks = self._upsert(Student, old_ids, values, ['first_name', 'last_name', 'birthday', 'level'])
+        self._add_to_school('students', [pks[old_id] for old_id in old_ids])
+        return {'imported': imported, 'errors': errors}
+
+    def _import_instructor(self, df, first_row):
+        # Instructors belong to a user account; new ones need a user_id column
+        user_refs = parse_id_column(_column(df, 'user_id'))
+        users = self._user_map([ref for ref in user_refs if ref])
+        sheet_ids = parse_id_column(_column(df, 'old_id_str'))
+        existing = self.id_map(Instructor, [old_id for old_id in sheet_ids if old_id])
+        row_errors = {}
+        for position, (old_id, ref) in enumerate(zip(sheet_ids, user_refs)):
+            if ref and ref not in users:
+                row_errors[position] = f'User {ref} does not exist.'
+            elif not ref and old_id not in existing:
+                row_errors[position] = 'New instructors need a user_id.'
+        positions, old_ids, errors, imported = self._rows(df, first_row, row_errors)
+
+        with_user = [(old_id, users[user_refs[p]]) for p, old_id in zip(positions, old_ids) if user_refs[p]]
+        if with_user:
+            self._upsert(Instructor, [old_id for old_id, _ in with_user], [{'user_id': user} for _, user in with_user], ['user'])
+        pks = self.id_map(Instructor, old_ids)
+        self._add_to_school('instructors', [pks[old_id] for old_id in old_ids])
+        return {'imported': imported, 'errors': errors}
+
+    def _import_lesson(self, df, first_row):
+        positions, old_ids, errors, imported = self._rows(df, first_row)
+        types = parse_text_column(_column(df, 'type'), default='private')
+        durations = parse_int_column(_column(df, 'duration_in_minutes'))
+        dates = parse_date_column(_column(df, 'date'))
+        start_times = parse_time_column(_column(df, 'start_time'))
+        end_times = parse_time_column(_column(df, 'end_time'))
+        class_numbers = parse_int_column(_column(df, 'class_number'))
+        prices = parse_decimal_column(_column(df, 'price'))
+        done = parse_bool_column(_column(df, 'is_done'))
+
+        values = [{
+            'date': dates[p],
+            'start_time': start_times[p],
+            'end_time': end_times[p],
+            'duration_in_minutes': durations[p] or 60,
+            'class_number': class_numbers[p],
+            'price': prices[p],
+            'type': types[p],
+            'is_done': done[p],
+            'school_id': self.school.pk,
+        } for p in positions]
+        pks = self._upsert(Lesson, old_ids, values, [
+            'date', 'start_time', 'end_time', 'duration_in_minutes', 'class_number', 'price', 'type', 'is_done', 'school',
+        ])
+
+        owner_by_row = {p: pks[old_id] for p, old_id in zip(positions, old_ids)}
+        # pack_ids are linked by link_chunk once the Packs sheet is in
+        for column, name, model in (('student_ids', 'students', Student), ('instructor_ids', 'instructors', Instructor)):
+            refs = parse_id_list_column(_column(df, column))
+            if len(refs):
+                self._replace_m2m(Lesson, name, owner_by_row, refs, self.id_map(model, set(refs)))
+        return {'imported': imported, 'errors': errors}
+
+    def _import_pack(self, df, first_row):
+        positions, old_ids, errors, imported = self._rows(df, first_row)
+        dates = parse_datetime_column(_column(df, 'date'))
+        finished = parse_datetime_column(_column(df, 'finished_date'))
+        pack_dates = datetime_column_values(dates.fillna(finished).fillna(pd.Timestamp(dt.date.today())), 'date')
+        finished_dates = datetime_column_values(finished, 'date')
+        expiration_dates = parse_date_column(_column(df, 'expiration_date'))
+        types = parse_text_column(_column(df, 'type'), default='private')
+        classes = parse_int_column(_column(df, 'number_of_classes'), default=0)
+        durations = parse_int_column(_column(df, 'duration_in_minutes'), default=0)
+        prices = parse_decimal_column(_column(df, 'price'))
+        debts = parse_decimal_column(_column(df, 'debt'))
+        done = parse_bool_column(_column(df, 'is_done'))
+        paid = parse_bool_column(_column(df, 'is_paid'))
+        suspended = parse_bool_column(_column(df, 'is_suspended'))
+
+        values = [{
+            'date': pack_dates[p],
+            'type': types[p],
+            'number_of_classes': classes[p],
+            'number_of_classes_left': classes[p],  # recounted below from the done lessons
+            'duration_in_minutes': durations[p],
+            'price': prices[p],
+            'is_done': done[p],
+            'is_paid': paid[p],
+            'is_suspended': suspended[p],
+            'debt': debts[p],
+            'finished_date': finished_dates[p],
+            'expiration_date': expiration_dates[p],
+            'school_id': self.school.pk,
+        } for p in positions]
+        pks = self._upsert(Pack, old_ids, values, [
+            'date', 'type', 'number_of_classes', 'duration_in_minutes', 'price', 'is_done', 'is_paid',
+            'is_suspended', 'debt', 'finished_date', 'expiration_date', 'school',
+        ])
+        owner_by_row = {p: pks[old_id] for p, old_id in zip(positions, old_ids)}
+
+        for column, name, model in (('student_ids', 'students', Student), ('instructor_ids', 'instructors', Instructor)):
+            refs = parse_id_list_column(_column(df, column))
+            if len(refs):
+                self._replace_m2m(Pack, name, owner_by_row, refs, self.id_map(model, set(refs)))
+        refs = parse_id_list_column(_column(df, 'parent_ids'))
+        if len(refs):
+            self._replace_m2m(Pack, 'parents', owner_by_row, refs, self._user_map(set(refs)))
+
+        # sport is only changed where the sheet names one that exists
+        sport_ids = parse_int_column(_column(df, 'sport_id'))
+        sports = set(Sport.objects.filter(pk__in={sport_ids[p] for p in positions if sport_ids[p]}).values_list('pk', flat=True))
+        with_sport = [Pack(pk=owner_by_row[p], sport_id=sport_ids[p]) for p in positions if sport_ids[p] in sports]
+        Pack.objects.bulk_update(with_sport, ['sport'], batch_size=IMPORT_BATCH_SIZE)
+
+        # lesson_ids point lessons at the pack (Lesson.pack), replacing its previous lessons
+        refs = parse_id_list_column(_column(df, 'lesson_ids'))
+        if len(refs):
+            lessons = self.id_map(Lesson, set(refs))
+            owners = {owner_by_row[row] for row in refs.index if row in owner_by_row}
+            Lesson.objects.filter(pack_id__in=owners).update(pack=None)
+            linked = {lessons[ref]: owner_by_row[row] for row, ref in refs.items() if row in owner_by_row and ref in lessons}
+            Lesson.objects.bulk_update(
+                [Lesson(pk=lesson_pk, pack_id=pack_pk) for lesson_pk, pack_pk in linked.items()], ['pack'],
+                batch_size=IMPORT_BATCH_SIZE,
+            )
+
+        done_lessons = dict(
+            Lesson.objects.filter(pack_id__in=pks.values(), is_done=True)
+            .values('pack_id').annotate(count=Count('id')).values_list('pack_id', 'count')
+        )
+        Pack.objects.bulk_update(
+            [Pack(pk=owner_by_row[p], number_of_classes_left=max(classes[p] - done_lessons.get(owner_by_row[p], 0), 0)) for p in positions],
+            ['number_of_classes_left'], batch_size=IMPORT_BATCH_SIZE,
+        )
+        return {'imported': imported, 'errors': errors}
+
+    def _import_payment(self, df, first_row):
+        user_refs = parse_id_column(_column(df, 'user_id'))
+        users = self._user_map([ref for ref in user_refs if ref])
+        row_errors = {
+            position: f'User {ref} does not exist.' if ref else 'Missing user_id.'
+            for position, ref in enumerate(user_refs) if ref not in users
+        }
+        positions, old_ids, errors, imported = self._rows(df, first_row, row_errors)
+        values_ = parse_decimal_column(_column(df, 'value'))
+        descriptions = parse_text_column(_column(df, 'description'), default={})
+
+        values = [{
+            'value': values_[p],
+            'user_id': users[user_refs[p]],
+            'description': descriptions[p],
+            'school_id': self.school.pk,
+        } for p in positions]
+        pks = self._upsert(Payment, old_ids, values, ['value', 'user', 'description', 'school'])
+
+        owner_by_row = {p: pks[old_id] for p, old_id in zip(positions, old_ids)}
+        for column, name, model in (('pack_ids', 'packs', Pack), ('lesson_ids', 'lessons', Lesson)):
+            refs = parse_id_list_column(_column(df, column))
+            if len(refs):
+                self._replace_m2m(Payment, name, owner_by_row, refs, self.id_map(model, set(refs)))
+        return {'imported': imported, 'errors': errors}
+
+
+class ImportValidator:
+    """
+    Checks an upload without writing anything, for the dry run of the bulk
+    import. Each chunk is checked with column operations: ids are required
+    and unique within a sheet, typed cells must parse, and references must
+    name a row of the file or an existing record; a row of a sheet imported
+    later counts too, as BulkImporter links IMPORT_LATE_REFERENCES once
+    every sheet is in. References are collected
+    while streaming and resolved at the end with set differences and one
+    query per referenced model.
+    """
+
+    def __init__(self):
+        self.sheet_ids = {}  # sheet key -> {old_id: row}
+        self.references = []  # (sheet name, column, target key, refs by row, old ids by row)
+
+    def run_file(self, reader):
+        """Validates every sheet of an ImportFileReader. Returns a report per sheet."""
+        results = {}
+        for name, key, _rows in reader.sheets():
+            if key is None:
+                results[name] = {'error': 'No importer for this sheet.'}
+                continue
+            result = results[name] = {'rows': 0, 'errors': []}
+            for start, df in reader.chunks(name):
+                result['rows'] += len(df)
+                result['errors'].extend(self.check_chunk(key, name, df, FIRST_DATA_ROW + start))
+        for name, errors in self.check_references().items():
+            results[name]['errors'].extend(errors)
+        for result in results.values():
+            if 'errors' in result:
+                result['errors'].sort(key=lambda error: error['row'])
+                result['valid'] = result['rows'] - len({error['row'] for error in result['errors']})
+        return results
+
+    def check_chunk(self, key, name, df, first_row):
+        """Row errors of one chunk of a sheet; its references are kept for check_references."""
+        df = normalize_import_frame(df).set_axis(range(first_row, first_row + len(df)))
+        old_ids = pd.Series(parse_id_column(_column(df, 'old_id_str')), index=df.index, dtype=object)
+        errors = [{'row': row, 'old_id': '', 'error': 'Missing id.'} for row in old_ids[old_ids.isna()].index]
+
+        seen = self.sheet_ids.setdefault(key, {})
+        present = old_ids.dropna()
+        repeated = present.duplicated() | present.isin(seen.keys())
+        seen.update((old_id, row) for row, old_id in present[~repeated].items())
+        errors.extend(
+            {'row': row, 'old_id': old_id, 'error': f'Duplicate id, first used on row {seen[old_id]}.'}
+            for row, old_id in present[repeated].items()
+        )
+
+        def row_errors(mask, message):
+            return [{'row': row, 'old_id': old_ids[row] or '', 'error': message(row)} for row in mask[mask].index]
+
+        for column, kind in IMPORT_COLUMN_TYPES[key].items():
+            if column not in df.columns:
+                continue
+            text = df[column].astype('string').str.strip()
+            parsed = parse_datetime_column(df[column]) if kind in ('date', 'time') else pd.to_numeric(df[column], errors='coerce')
+            errors.extend(row_errors(parsed.isna() & ~_blank(text), lambda row: f'Invalid {kind} in {column}: {text[row]}'))
+
+        if key in ('instructor', 'payment'):
+            no_user = _blank(_column(df, 'user_id').astype('string').str.strip())
+            if key == 'payment':
+                errors.extend(row_errors(no_user, lambda row: 'Missing user_id.'))
+            else:
+                # instructors that don't exist yet are created for a user
+                new = ~old_ids.isin(self._existing_ids(Instructor, set(old_ids[no_user].dropna())))
+                errors.extend(row_errors(no_user & new & old_ids.notna(), lambda row: 'New instructors need a user_id.'))
+
+        for column, target in IMPORT_REFERENCES[key].items():
+            refs = parse_id_list_column(_column(df, column))
+            if len(refs):
+                self.references.append((name, column, target, refs, old_ids))
+        return errors
+
+    def check_references(self):
+        """{sheet name: errors} of references that neither the file nor the database has."""
+        wanted = {}
+        for _name, _column, target, refs, _old_ids in self.references:
+            wanted.setdefault(target, set()).update(refs.tolist())
+        known = {}
+        for target, refs in wanted.items():
+            if target == 'user':
+                known[target] = self._existing_users(refs)
+            else:
+                in_file = self.sheet_ids.get(target, {}).keys()
+                known[target] = in_file | self._existing_ids(IMPORT_MODELS[target], refs - in_file)
+
+        errors = {}
+        for name, column, target, refs, old_ids in self.references:
+            unknown = refs[~refs.isin(known[target])]
+            errors.setdefault(name, []).extend({
+                'row': row,
+                'old_id': old_ids[row] or '',
+                'error': f'User {ref} does not exist.' if target == 'user' else f'Unknown {target} id {ref} in {column}.',
+            } for row, ref in unknown.items())
+        return errors
+
+    @staticmethod
+    def _existing_ids(model, old_ids):
+        old_ids = list(old_ids)
+        existing = set()
+        for start in range(0, len(old_ids), IMPORT_BATCH_SIZE):
+            existing.update(
+                model.objects.filter(old_id_str__in=old_ids[start:start + IMPORT_BATCH_SIZE]).values_list('old_id_str', flat=True)
+            )
+        return existing
+
+    @staticmethod
+    def _existing_users(refs):
+        ids = sorted({int(ref) for ref in refs if str(ref).isdigit()})
+        existing = set()
+        for start in range(0, len(ids), IMPORT_BATCH_SIZE):
+            existing.update(
+                str(pk) for pk in UserAccount.objects.filter(pk__in=ids[start:start + IMPORT_BATCH_SIZE]).values_list('pk', flat=True)
+            )
+        return existing
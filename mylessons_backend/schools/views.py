@@ -1,7 +1,4 @@
 import json
-import datetime as dt
-import math
-from decimal import Decimal, InvalidOperation
 
 from openpyxl.styles import Font, PatternFill
 from openpyxl.worksheet.datavalidation import DataValidation
@@ -11,8 +8,10 @@ from equipment.serializers import EquipmentSerializer
 from schools.serializers import CSVUploadSerializer, UpdateContactsSerializer, ContactsSerializer
 from sports.models import Sport
 from payments.models import Payment
-from users.models import Instructor, Monitor, Student, UserAccount
-from .models import Review, School
+from payments.utils import get_revenue_forecast
+from .utils import BulkImporter, ImportFileReader, ImportValidator
+from users.models import Instructor, Monitor, UserAccount
+from .models import ImportJob, Review, School
 from datetime import datetime, timedelta
 from django.contrib.auth import authenticate, get_user_model
 from rest_framework.decorators import api_view, permission_classes, parser_classes
@@ -29,12 +28,10 @@ from django.contrib.auth.hashers import make_password
 from notifications.models import Notification
 from lessons.models import Lesson, Pack
 from events.models import Activity
-from schools.models import School
 from django.db.models import Q, Sum
 from django.utils.timezone import now
 from django.http import JsonResponse
 from django.db import transaction
-import pandas as pd
 from django.http import HttpResponse
 import io
 from openpyxl import Workbook
@@ -639,6 +636,28 @@ def school_revenue_in_timeframe(request, school_id, start_date, end_date):
     data = {"total_revenue": str(total_revenue)}
     return Response(data)
 
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def school_revenue_forecast(request, school_id):
+    """
+    Returns the expected cash-in per week for the next `weeks` weeks
+    (query param, default 12, max 52), projected from outstanding pack debt,
+    scheduled lessons and pack expiration dates.
+    """
+    try:
+        weeks = int(request.query_params.get("weeks", 12))
+    except ValueError:
+        return Response({"error": "weeks must be an integer."}, status=400)
+    weeks = min(max(weeks, 1), 52)
+
+    user = request.user
+    current_role = getattr(user, 'current_role', None)
+
+    if current_role != "Admin" or school_id not in user.school_admins.values_list('id', flat=True):
+        return Response({"error": "Not allowed to view this school's revenue"}, status=403)
+
+    return Response(get_revenue_forecast(school_id, weeks=weeks))
+
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
 def number_of_bookings_in_timeframe(request, school_id, start_date, end_date):
@@ -1176,38 +1195,12 @@ def create_review(request):
     return JsonResponse({'error': 'Method not allowed.'}, status=status.HTTP_405_METHOD_NOT_ALLOWED)
 
 
-def parse_date(value):
-    # Handle None, NaN, and pandas NaT
-    if value is None or pd.isna(value):
-        return None
-    # pandas Timestamp or datetime
-    if isinstance(value, dt.datetime):
-        return value.date()
-    if isinstance(value, dt.date):
-        return value
-    try:
-        return dt.date.fromisoformat(str(value))
-    except Exception:
-        return None
-
-
-def parse_time(value):
-    # Handle None, NaN, and pandas NaT
-    if value is None or pd.isna(value):
-        return None
-    if isinstance(value, dt.datetime):
-        return value.time()
-    if isinstance(value, dt.time):
-        return value
-    try:
-        return dt.time.fromisoformat(str(value))
-    except Exception:
-        return None
-
 class BulkImportView(views.APIView):
     """
-    Endpoint to handle bulk Excel import for Students, Lessons, Packs, and Payments.
+    Endpoint to handle bulk Excel import for Students, Instructors, Lessons, Packs, and Payments.
     Only Admin users may import. Imported objects are linked to the user's current school.
+    The upload is streamed in chunks; a .csv is imported as the sheet given by "target".
+    With dry_run=true the file is only validated and a report of the bad rows is returned.
     """
     serializer_class = CSVUploadSerializer
 
@@ -1226,259 +1219,51 @@ class BulkImportView(views.APIView):
         serializer.is_valid(raise_exception=True)
         excel_file = serializer.validated_data['file']
 
-        # load & clean sheets
-        xl = pd.ExcelFile(excel_file)
-        raw = {}
-        for name in xl.sheet_names:
-            df = xl.parse(name, header=1).astype(object)
-            df = df.where(pd.notna(df), None)
-            df.columns = [col.lower() for col in df.columns]
-            if 'id' in df.columns and 'old_id_str' not in df.columns:
-                df.rename(columns={'id': 'old_id_str'}, inplace=True)
-            raw[name.lower()] = df
-
-        results = {}
-        for key in ('students','lessons','packs','payments'):
-            if key in raw:
-                fn = getattr(self, f'_import_{key}')
-                results[key] = fn(raw.pop(key), school)
-
-        for name, df in raw.items():
-            fn = getattr(self, f'_import_{name.rstrip("s")}', None)
-            results[name] = fn(df, school) if fn else {'error': 'No importer for this sheet.'}
+        if str(request.data.get('dry_run', '')).lower() in ('true', '1'):
+            # validates every sheet and reports the bad rows without writing anything
+            with ImportFileReader(excel_file, target=serializer.validated_data['target']) as reader:
+                return Response(ImportValidator().run_file(reader), status=status.HTTP_200_OK)
+
+        if str(request.data.get('background', '')).lower() in ('true', '1'):
+            # stored and imported by the process_import_jobs worker; poll import_job_status
+            job = ImportJob.objects.create(
+                school=school, created_by=request.user, file=excel_file,
+                target=serializer.validated_data['target'],
+            )
+            return Response(job.as_dict(), status=status.HTTP_202_ACCEPTED)
+
+        with ImportFileReader(excel_file, target=serializer.validated_data['target']) as reader:
+            results = BulkImporter(school).run_file(reader)
 
         return Response(results, status=status.HTTP_200_OK)
 
-    def _parse_decimal(self, value):
-        """Parse a value into a Decimal, defaulting to 0.00 on failure or empty, filtering out NaNs."""
-        if value is None:
-            return Decimal('0.00')
-        # handle float NaN
-        if isinstance(value, float) and math.isnan(value):
-            return Decimal('0.00')
-        # handle string representations
-        if isinstance(value, str):
-            if not value.strip() or value.strip().lower() == 'nan':
-                return Decimal('0.00')
-        try:
-            return Decimal(str(value))
-        except (InvalidOperation, ValueError):
-            return Decimal('0.00')
 
-    def _parse_int(self, value):
-        try:
-            return int(value)
-        except (TypeError, ValueError):
-            return None
-
-    def _parse_bool(self, value):
-        if isinstance(value, bool): return value
-        val = str(value).strip().lower()
-        return val in ('true', '1', 'yes', 'y')
-
-    def _import_student(self, df: pd.DataFrame, school: School):
-        successes, errors = [], []
-        for idx, row in df.iterrows():
-            old_id = str(row.get('old_id_str') or '')
-            try:
-                student, created = Student.objects.update_or_create(
-                    old_id_str=old_id,
-                    defaults={
-                        'first_name': row.get('first_name') or '',
-                        'last_name':  row.get('last_name') or '',
-                        'birthday':   parse_date(row.get('birthday')),
-                        'level':      self._parse_int(row.get('level')),
-                    }
-                )
-                school.students.add(student)
-                successes.append({'row': idx+2, 'old_id': old_id, 'new_id': student.id, 'created': created})
-            except Exception as e:
-                errors.append({'row': idx+2, 'old_id': old_id, 'error': str(e)})
-        return {'imported': len(successes), 'errors': errors}
-
-    def _import_instructor(self, df: pd.DataFrame, school: School):
-        successes, errors = [], []
-        for idx, row in df.iterrows():
-            old_id = str(row.get('old_id_str') or '')
-            try:
-                instructor, created = Instructor.objects.update_or_create(
-                    old_id_str=old_id,
-                    defaults={
-                        'first_name': row.get('first_name') or '',
-                        'last_name':  row.get('last_name') or '',
-
-                    }
-                )
-                school.instructors.add(instructor)
-                successes.append({'row': idx+2, 'old_id': old_id, 'new_id': instructor.id, 'created': created})
-            except Exception as e:
-                errors.append({'row': idx+2, 'old_id': old_id, 'error': str(e)})
-        return {'imported': len(successes), 'errors': errors}
-
-    def _import_lesson(self, df: pd.DataFrame, school: School):
-        successes, errors = [], []
-        for idx, row in df.iterrows():
-            old_id = str(row.get('old_id_str') or '')
-            try:
-                lesson, created = self._create_or_update_lesson(row, old_id)
-                school.lessons.add(lesson)
-                successes.append({'row': idx+2, 'lesson_id': lesson.id, 'created': created})
-            except Exception as e:
-                errors.append({'row': idx+2, 'error': str(e)})
-        return {'imported': len(successes), 'errors': errors}
-
-    def _create_or_update_lesson(self, row, old_id):
-        # Parse basic fields
-        lesson_date = parse_date(row.get('date'))
-        lesson_time = parse_time(row.get('start_time'))
-        lesson_end_time = parse_time(row.get('end_time'))
-        duration = self._parse_int(row.get('duration_in_minutes'))
-        if duration is None and row.get('type') == 'group':
-            duration = 60
-        duration = duration or 60
-        class_no = self._parse_int(row.get('class_number'))
-        price = self._parse_decimal(row.get('price'))
-
-        # Imported but previously missing fields
-        lesson_type = row.get('type') or 'private'
-        lesson_is_done = self._parse_bool(row.get('is_done'))
-
-        # Create or update
-        lesson, created = Lesson.objects.update_or_create(
-            old_id_str=old_id,
-            defaults={
-                'date':                lesson_date,
-                'start_time':          lesson_time,
-                'end_time':            lesson_end_time,
-                'duration_in_minutes': duration,
-                'class_number':        class_no,
-                'price':               price,
-                'type':                lesson_type,
-                'is_done':             lesson_is_done,
-            }
-        )
+def _admin_import_job(request, job_id):
+    if getattr(request.user, 'current_role', None) != 'Admin':
+        return None
+    return ImportJob.objects.filter(pk=job_id, school_id=request.user.current_school_id).first()
 
-        # M2M relationships
-        if row.get('student_ids'):
-            ids = [s.strip() for s in str(row['student_ids']).split(',') if s.strip()]
-            lesson.students.set(Student.objects.filter(old_id_str__in=ids))
-
-        raw = row.get('instructor_ids') or ''
-        ids = []
-        for part in str(raw).split(','):
-            part = part.strip()
-            # skip blank or literal "nan"
-            if not part or part.lower() == 'nan':
-                continue
-            try:
-                # convert to float→int→str; skip anything that fails
-                ids.append(str(int(float(part))))
-            except:
-                continue
-
-        if ids:
-            lesson.instructors.set(
-                Instructor.objects.filter(old_id_str__in=ids)
-            )
 
-        if row.get('pack_ids'):
-            ids = [s.strip() for s in str(row['pack_ids']).split(',') if s.strip()]
-            lesson.packs.set(Pack.objects.filter(old_id_str__in=ids))
-
-        return lesson, created
-
-    def _import_pack(self, df, school):
-        successes, errors = [], []
-        for idx, row in df.iterrows():
-            old_id = str(row.get('old_id_str') or '')
-            try:
-                raw_date = row.get('date')
-                raw_finished = row.get('finished_date')
-                if raw_date and str(raw_date).strip().lower() != 'nan':
-                    pack_date = parse_date(raw_date)
-                elif raw_finished and str(raw_finished).strip().lower() != 'nan':
-                    pack_date = parse_date(raw_finished)
-                else:
-                    pack_date = dt.date.today()
-                defaults = {
-                    'date':                pack_date,
-                    'type':                row.get('type') or 'private',
-                    'number_of_classes':   self._parse_int(row.get('number_of_classes')) or 0,
-                    'number_of_classes_left': self._parse_int(row.get('number_of_classes_left'))
-                                              or self._parse_int(row.get('number_of_classes')) or 0,
-                    'duration_in_minutes': self._parse_int(row.get('duration_in_minutes')) or 0,
-                    'price':               self._parse_decimal(row.get('price')),
-                    'is_done':             self._parse_bool(row.get('is_done')),
-                    'is_paid':             self._parse_bool(row.get('is_paid')),
-                    'is_suspended':        self._parse_bool(row.get('is_suspended')),
-                    'debt':                self._parse_decimal(row.get('debt')),
-                    'finished_date':       parse_date(row.get('finished_date'))
-                    if row.get('finished_date') else None,
-                    'expiration_date':     parse_date(row.get('expiration_date'))
-                    if row.get('expiration_date') else None,
-                }
-                pack, created = Pack.objects.update_or_create(
-                    old_id_str=old_id,
-                    defaults=defaults
-                )
-                school.packs.add(pack)
-                # M2M relationships
-                if row.get('student_ids'):
-                    sids = [s.strip() for s in str(row['student_ids']).split(',') if s.strip()]
-                    pack.students.set(Student.objects.filter(old_id_str__in=sids))
-                if row.get('lesson_ids'):
-                    sids = [s.strip() for s in str(row['lesson_ids']).split(',') if s.strip()]
-                    pack.lessons.set(Lesson.objects.filter(old_id_str__in=sids))
-                if row.get('instructor_ids'):
-                    iids = [s.strip() for s in str(row['instructor_ids']).split(',') if s.strip()]
-                    pack.instructors.set(Instructor.objects.filter(old_id_str__in=iids))
-                if row.get('parent_ids'):
-                    pids = [s.strip() for s in str(row['parent_ids']).split(',') if s.strip()]
-                    pack.parents.set(UserAccount.objects.filter(id__in=pids))
-                if row.get('sport_id'):
-                    try:
-                        sport = Sport.objects.get(pk=self._parse_int(row.get('sport_id')))
-                        pack.sport = sport
-                        pack.save()
-                    except Sport.DoesNotExist:
-                        pass
-
-                done_count = pack.lessons.filter(is_done=True).count()
-                pack.number_of_classes_left = pack.number_of_classes - done_count
-                pack.save(update_fields=['number_of_classes_left'])
-
-                successes.append({'row': idx+2, 'new_id': pack.id, 'created': created})
-            except Exception as e:
-                errors.append({'row': idx+2, 'old_id': old_id, 'error': str(e)})
-        return {'imported': len(successes), 'errors': errors}
-
-    def _import_payment(self, df, school):
-        successes, errors = [], []
-        for idx, row in df.iterrows():
-            old_id = str(row.get('old_id_str') or '')
-            try:
-                uid = self._parse_int(row.get('user_id'))
-                user = UserAccount.objects.filter(pk=uid).first() if uid else None
-                desc = row.get('description') if row.get('description') is not None else {}
-                payment, created = Payment.objects.update_or_create(
-                    old_id_str=old_id,
-                    defaults={
-                        'value': self._parse_decimal(row.get('value')),
-                        'user': user,
-                        'description': desc,
-                    }
-                )
-                school.payments.add(payment)
-                if row.get('pack_ids'):
-                    pids = [s.strip() for s in str(row['pack_ids']).split(',') if s.strip()]
-                    payment.packs.set(Pack.objects.filter(old_id_str__in=pids))
-                if row.get('lesson_ids'):
-                    lids = [s.strip() for s in str(row['lesson_ids']).split(',') if s.strip()]
-                    payment.lessons.set(Lesson.objects.filter(old_id_str__in=lids))
-                successes.append({'row': idx+2, 'payment_id': payment.id, 'created': created})
-            except Exception as e:
-                errors.append({'row': idx+2, 'error': str(e)})
-        return {'imported': len(successes), 'errors': errors}
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def import_job_status(request, job_id):
+    """Progress of a background import: rows done and the errors of every sheet."""
+    job = _admin_import_job(request, job_id)
+    if job is None:
+        return Response({'detail': 'Import job not found.'}, status=status.HTTP_404_NOT_FOUND)
+    return Response(job.as_dict())
+
+
+@api_view(['POST'])
+@permission_classes([IsAuthenticated])
+def resume_import_job(request, job_id):
+    """Queues a failed import again; it continues after the last committed chunk."""
+    job = _admin_import_job(request, job_id)
+    if job is None:
+        return Response({'detail': 'Import job not found.'}, status=status.HTTP_404_NOT_FOUND)
+    if not job.resume():
+        return Response({'detail': 'Only failed imports can be resumed.'}, status=status.HTTP_400_BAD_REQUEST)
+    return Response(job.as_dict(), status=status.HTTP_202_ACCEPTED)
 
 
 
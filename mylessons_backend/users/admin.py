@@ -1,6 +1,6 @@
 from django.contrib import admin
 from .models import (
-    GoogleCredentials, UserAccount, Student,
+    BalanceEntry, GoogleCredentials, UserAccount, Student,
     Instructor, Monitor, Unavailability,
     Discount, UserCredentials
 )
@@ -12,6 +12,13 @@ class UserAccountAdmin(admin.ModelAdmin):
     list_filter = ('is_active', 'is_staff', 'is_superuser')
     ordering = ('-date_joined',)
 
+@admin.register(BalanceEntry)
+class BalanceEntryAdmin(admin.ModelAdmin):
+    list_display = ('user', 'school', 'amount', 'balance_after', 'is_payout', 'created_at')
+    search_fields = ('user__username', 'user__first_name', 'user__last_name', 'message')
+    list_filter = ('is_payout', 'school', 'created_at')
+    ordering = ('-created_at',)
+
 @admin.register(Student)
 class StudentAdmin(admin.ModelAdmin):
     list_display = ('first_name', 'last_name', 'level', 'birthday')
@@ -0,0 +1,89 @@
+from datetime import datetime, timezone as dt_timezone
+from decimal import Decimal, InvalidOperation
+
+from django.db import migrations
+from django.db.models import Exists, F, OuterRef, Q
+
+
+def _aware(value):
+    if value.tzinfo is None:
+        return value.replace(tzinfo=dt_timezone.utc)
+    return value
+
+
+def migrate_balance_history(apps, schema_editor):
+    """
+    Copies every user's balance_history JSON into BalanceEntry rows and adds
+    payout markers for the payments the old get_balance_history_since_last_payout
+    treated as payouts. Entries get a school only when the user is staff of
+    exactly one school, since the JSON history never recorded it.
+    """
+    UserAccount = apps.get_model('users', 'UserAccount')
+    BalanceEntry = apps.get_model('users', 'BalanceEntry')
+    Payment = apps.get_model('payments', 'Payment')
+    School = apps.get_model('schools', 'School')
+
+    staff_schools = {}
+    for school_id, admin_id, instructor_user_id, monitor_user_id in School.objects.values_list(
+        'id', 'admins', 'instructors__user', 'monitors__user'
+    ):
+        for user_id in (admin_id, instructor_user_id, monitor_user_id):
+            if user_id:
+                staff_schools.setdefault(user_id, set()).add(school_id)
+
+    def school_for(user_id):
+        schools = staff_schools.get(user_id, ())
+        return next(iter(schools)) if len(schools) == 1 else None
+
+    entries = []
+    for user_id, history in UserAccount.objects.values_list('id', 'balance_history').iterator():
+        school_id = school_for(user_id)
+        for item in history or []:
+            try:
+                entries.append(BalanceEntry(
+                    user_id=user_id,
+                    school_id=school_id,
+                    amount=Decimal(item["amount"]),
+                    balance_after=Decimal(item.get("current_balance") or "0"),
+                    message=item.get("message") or "",
+                    created_at=_aware(datetime.fromisoformat(item["timestamp"])),
+                ))
+            except (KeyError, TypeError, ValueError, InvalidOperation):
+                continue
+
+    def no_rows(relation):
+        through = getattr(Payment, relation).through
+        return ~Exists(through.objects.filter(payment_id=OuterRef('pk')))
+
+    payouts = Payment.objects.filter(user_id__in=staff_schools.keys()).filter(
+        Q(instructor__user_id=F('user_id'))
+        | Q(monitor__user_id=F('user_id'))
+        | (no_rows('packs') & no_rows('lessons') & no_rows('activities')
+           & no_rows('camp_orders') & no_rows('birthday_parties') & no_rows('vouchers'))
+    )
+    for payment in payouts.iterator():
+        entries.append(BalanceEntry(
+            user_id=payment.user_id,
+            school_id=payment.school_id or school_for(payment.user_id),
+            amount=Decimal('0.00'),
+            balance_after=Decimal('0.00'),
+            message=f"Payout of {payment.value}",
+            is_payout=True,
+            payment_id=payment.id,
+            created_at=_aware(datetime.combine(payment.date, payment.time)),
+        ))
+
+    BalanceEntry.objects.bulk_create(entries, batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('events', '0003_remove_birthdayparty_student_birthdayparty_students_and_more'),
+        ('lessons', '0008_lesson_old_id_str_pack_old_id_str'),
+        ('users', '0013_balanceentry'),
+    ]
+
+    operations = [
+        migrations.RunPython(migrate_balance_history, migrations.RunPython.noop),
+    ]
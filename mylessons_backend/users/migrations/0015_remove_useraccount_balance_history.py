@@ -0,0 +1,17 @@
+# Generated by Django 5.1.5 on 2026-10-19 15:06
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0014_migrate_balance_history'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='useraccount',
+            name='balance_history',
+        ),
+    ]
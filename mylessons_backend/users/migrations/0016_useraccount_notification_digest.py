@@ -0,0 +1,18 @@
+# Generated by Django 5.1.5 on 2026-10-19 15:19
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0015_remove_useraccount_balance_history'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='useraccount',
+            name='notification_digest',
+            field=models.CharField(choices=[('immediate', 'Immediate'), ('hourly', 'Hourly digest'), ('daily', 'Daily digest')], default='immediate', max_length=10),
+        ),
+    ]
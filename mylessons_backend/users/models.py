@@ -4,7 +4,7 @@ from decimal import Decimal
 import json
 import logging
 from django.contrib.auth.models import AbstractUser,  Group, Permission
-from django.db import models
+from django.db import models, transaction
 import secrets
 from payments.models import Payment
 from .utils import get_phone
@@ -38,112 +38,127 @@ class UserAccount(AbstractUser):
     current_role = models.CharField(max_length=255, default="Parent")
     current_school_id = models.PositiveIntegerField(null=True, blank=True)
     balance = models.DecimalField(max_digits=10, decimal_places=2, default=0)
-    balance_history = models.JSONField(null=True, blank=True, default=list)
     payment_types = models.JSONField(blank=True, null=True, default=dict) 
     calendar_token = models.TextField(blank=True, null=True)
+
+    DIGEST_IMMEDIATE = "immediate"
+    DIGEST_HOURLY = "hourly"
+    DIGEST_DAILY = "daily"
+    DIGEST_CHOICES = [
+        (DIGEST_IMMEDIATE, "Immediate"),
+        (DIGEST_HOURLY, "Hourly digest"),
+        (DIGEST_DAILY, "Daily digest"),
+    ]
+    notification_digest = models.CharField(max_length=10, choices=DIGEST_CHOICES, default=DIGEST_IMMEDIATE)
     
     def __str__(self):
         return f"{self.first_name} {self.last_name}"
     
-    def get_balance_history_since_last_payout(self):
+    def get_balance_history_since_last_payout(self, school=None):
         """
-        Returns a filtered list of balance_history transactions that occurred
-        after the last payment that qualifies as a payout.
-        
-        A payment qualifies as a payout if:
-        - payment.instructor matches self.instructor_profile, or
-        - payment.monitor matches self.monitor_profile, or
-        - if neither instructor nor monitor is set, the payment belongs to the user
-            and has no associated packs, lessons, activities, camp_orders, birthday_parties, or vouchers.
-        
-        Returns a JSON-encoded string of the filtered balance_history.
+        Returns the balance ledger entries recorded after the user's last
+        payout (all of them if there was none), optionally scoped to a school.
+        Entries without a school (e.g. migrated from the old JSON history)
+        are always included.
+
+        Returns a JSON-encoded list of BalanceEntry.as_history_entry() dicts.
         """
-        # Get Payment objects for this user in reverse chronological order.
-        payments = Payment.objects.filter(user=self).order_by('-date', '-time')
-        last_payout_payment = None
-
-        for payment in payments:
-            if payment.instructor and getattr(self, 'instructor_profile', None):
-                if payment.instructor.id == self.instructor_profile.id:
-                    last_payout_payment = payment
-                    break
-            if payment.monitor and getattr(self, 'monitor_profile', None):
-                if payment.monitor.id == self.monitor_profile.id:
-                    last_payout_payment = payment
-                    break
-            # Check if the payment belongs to the user and has no related packs/lessons/etc.
-            if payment.user.id == self.id:
-                no_related = True
-                if hasattr(payment, 'packs') and payment.packs.exists():
-                    no_related = False
-                if hasattr(payment, 'lessons') and payment.lessons.exists():
-                    no_related = False
-                if hasattr(payment, 'activities') and payment.activities.exists():
-                    no_related = False
-                if hasattr(payment, 'camp_orders') and payment.camp_orders.exists():
-                    no_related = False
-                if hasattr(payment, 'birthday_parties') and payment.birthday_parties.exists():
-                    no_related = False
-                if hasattr(payment, 'vouchers') and payment.vouchers.exists():
-                    no_related = False
-                if no_related:
-                    last_payout_payment = payment
-                    break
+        entries = BalanceEntry.objects.filter(user=self)
+        if school is not None:
+            entries = entries.filter(models.Q(school=school) | models.Q(school__isnull=True))
 
-        # If no payout is found, return the entire balance_history.
-        if not last_payout_payment:
-            return json.dumps(self.balance_history)
-
-        last_payout_dt = datetime.combine(last_payout_payment.date, last_payout_payment.time)
-        filtered_history = []
-        for entry in self.balance_history:
-            try:
-                entry_dt = datetime.fromisoformat(entry["timestamp"])
-                if entry_dt > last_payout_dt:
-                    filtered_history.append(entry)
-            except Exception:
-                continue
+        payouts = entries.filter(is_payout=True)
+        last_payout_at = payouts.order_by('-created_at').values('created_at')[:1]
+        entries = entries.filter(is_payout=False).filter(
+            models.Q(created_at__gt=models.Subquery(last_payout_at)) | ~models.Exists(payouts)
+        ).order_by('created_at', 'id')
+
+        return json.dumps([entry.as_history_entry() for entry in entries])
 
-        return json.dumps(filtered_history)
+    def record_payout(self, payment):
+        """
+        Marks a payout to this user in the balance ledger. The marker does not
+        change the balance, it only closes the period reported by
+        get_balance_history_since_last_payout.
+        """
+        return BalanceEntry.objects.create(
+            user=self,
+            school=payment.school,
+            amount=Decimal('0.00'),
+            balance_after=self.balance,
+            message=f"Payout of {payment.value}",
+            is_payout=True,
+            payment=payment,
+        )
     
-    def update_balance(self, amount, message):
+    def update_balance(self, amount, message, school=None):
         """
-        Update the user's balance and record the transaction.
-
-        The balance_history JSON structure is now a list of transactions.
-        Each transaction is represented as:
-            {
-                "timestamp": "YYYY-MM-DDTHH:MM:SS",
-                "amount": "+50.00" or "-20.00",
-                "message": "Description of transaction"
-                "current_balance": "current balance at this time after the new transaction"
-            }
+        Update the user's balance and append the transaction to the balance
+        ledger (BalanceEntry).
+
+        The row is locked for the duration of the transaction and the balance
+        is incremented in the database, so concurrent updates (e.g. several
+        lessons marked as given at once) never overwrite each other.
         """
         # Ensure amount is a Decimal for arithmetic
         amount = Decimal(amount)
-        self.balance += amount
 
-        # Get the current timestamp
-        now = timezone.now()
+        with transaction.atomic():
+            UserAccount.objects.select_for_update().filter(pk=self.pk).update(
+                balance=models.F('balance') + amount
+            )
+            self.balance = UserAccount.objects.values_list('balance', flat=True).get(pk=self.pk)
+
+            return BalanceEntry.objects.create(
+                user=self,
+                school=school,
+                amount=amount,
+                balance_after=self.balance,
+                message=message,
+            )
 
-        # Create a new transaction entry
-        transaction_entry = {
-            "timestamp": now.isoformat(),  # e.g., "2025-02-18T14:00:00"
-            "amount": f"{amount:+.2f}",      # formats as '+50.00' or '-20.00'
-            "message": message,
-            "current_balance" : f"{self.balance:+.2f}"
-        }
+    def get_balance_entries(self, school=None):
+        """
+        Returns the user's balance ledger, newest first, optionally scoped to
+        a school. Entries without a school are always included.
+        """
+        entries = self.balance_entries.all()
+        if school is not None:
+            entries = entries.filter(models.Q(school=school) | models.Q(school__isnull=True))
+        return entries.order_by('-created_at', '-id')
 
-        # Initialize balance_history as a list if it's empty
-        if not self.balance_history:
-            self.balance_history = []
 
-        # Append the new transaction entry
-        self.balance_history.append(transaction_entry)
-        
-        # Save changes to the instance
-        self.save(update_fields=["balance", "balance_history"])
-        
+class BalanceEntry(models.Model):
+    """
+    One line of a user's balance ledger. Payout markers (is_payout=True)
+    close the period returned by get_balance_history_since_last_payout.
+    """
+    user = models.ForeignKey(UserAccount, on_delete=models.CASCADE, related_name='balance_entries')
+    school = models.ForeignKey('schools.School', on_delete=models.SET_NULL, related_name='balance_entries', null=True, blank=True)
+    amount = models.DecimalField(max_digits=10, decimal_places=2)
+    balance_after = models.DecimalField(max_digits=10, decimal_places=2)
+    message = models.TextField(blank=True, default="")
+    is_payout = models.BooleanField(default=False)
+    payment = models.ForeignKey(Payment, on_delete=models.SET_NULL, related_name='balance_entries', null=True, blank=True)
+    created_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        ordering = ['created_at', 'id']
+        indexes = [models.Index(fields=['user', 'school', 'created_at'])]
+
+    def __str__(self):
+        label = "Payout" if self.is_payout else f"{self.amount:+.2f}"
+        return f"{label} for {self.user} on {self.created_at:%Y-%m-%d %H:%M}"
+
+    def as_history_entry(self):
+        """Serializable form used by the payout and balance history endpoints."""
+        return {
+            "timestamp": self.created_at.isoformat(),
+            "amount": f"{self.amount:+.2f}",
+            "message": self.message,
+            "current_balance": f"{self.balance_after:+.2f}",
+        }
+
 
 
 class Student(models.Model):
@@ -382,12 +397,11 @@ class Unavailability(models.Model):
                 unavailabilities.append(unavail)
 
             if student:
-                for parent in student.parents.all():
-                    conflicts += list(student.lessons.filter(
-                        date=current_date,
-                        start_time__lt=end_time,
-                        end_time__gt=start_time
-                    ))
+                conflicts += list(student.lessons.filter(
+                    date=current_date,
+                    start_time__lt=end_time,
+                    end_time__gt=start_time
+                ))
                 unavail = cls.objects.create(
                     student=student,
                     date=current_date,
@@ -401,7 +415,8 @@ class Unavailability(models.Model):
 
             if conflicts:
                 logger.info("Found %d conflict(s) on %s", len(conflicts), current_date)
-                # Notification logic here (omitted for brevity)
+                conflict_type = "Instructor unavailable" if instructor else "Student unavailable"
+                cls.notify_conflicts(conflicts, conflict_type, start_time, end_time, school=school)
 
             if recurrence:
                 if recurrence['type'] == 'daily':
@@ -416,6 +431,38 @@ class Unavailability(models.Model):
         logger.info("Defined %d unavailability record(s) for %s", len(unavailabilities), date)
         return unavailabilities
 
+    @staticmethod
+    def notify_conflicts(conflicts, conflict_type, start_time, end_time, school=None):
+        """
+        Alerts the instructors and the students' parents of every lesson or
+        activity that conflicts with a new unavailability.
+        """
+        for item in conflicts:
+            item_school = item.school or school
+            if not item_school:
+                continue
+            context = dict(
+                conflict_type=conflict_type,
+                date=item.date,
+                start_time=start_time,
+                end_time=end_time,
+                school_name=item_school.name,
+            )
+            related = {"activities": [item]} if item._meta.model_name == "activity" else {"lessons": [item]}
+
+            Notification.fan_out(
+                [instructor.user for instructor in item.instructors.select_related('user')],
+                "conflict_notification", context, school=item_school, type="Instructor",
+                recipient_context=lambda user: {"instructor_name": f"{user.first_name} {user.last_name}"},
+                **related,
+            )
+            Notification.fan_out(
+                UserAccount.objects.filter(students__in=item.students.all()).distinct(),
+                "conflict_notification", context, school=item_school, type="Parent",
+                recipient_context=lambda user: {"parent_name": user.first_name},
+                **related,
+            )
+
 
 
         
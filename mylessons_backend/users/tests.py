@@ -5,7 +5,17 @@ from datetime import datetime, timedelta, date, time
 from django.utils.timezone import now
 from users.models import Student, UserAccount, Instructor
 from decimal import Decimal
+from payments.models import Payment
+from django.urls import reverse
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import APIClient
+from users.utils import CalendarServiceCache, decrypt, encrypt
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timezone as dt_timezone
+from unittest import mock
 import copy
+import json
 import re
 
 # -------------------- PaymentTypeUpdateTests --------------------
@@ -98,8 +108,7 @@ class PrivateClassMarkingTests(TestCase):
     def test_mark_as_given_updates_balance_and_history(self):
         # Initialize user balance and history.
         self.user.balance = Decimal("0.00")
-        self.user.balance_history = []
-        self.user.save(update_fields=["balance", "balance_history"])
+        self.user.save(update_fields=["balance"])
         
         private_class = Lesson.objects.create(
             date=date(2025, 1, 1),
@@ -120,17 +129,16 @@ class PrivateClassMarkingTests(TestCase):
         self.user.refresh_from_db()
         self.assertEqual(self.user.balance, Decimal("20.00"))
         # Verify that a transaction was recorded.
-        self.assertGreaterEqual(len(self.user.balance_history), 1)
-        last_tx = self.user.balance_history[-1]
-        self.assertEqual(last_tx["amount"], "+20.00")
+        self.assertGreaterEqual(self.user.balance_entries.count(), 1)
+        last_tx = self.user.balance_entries.last()
+        self.assertEqual(last_tx.amount, Decimal("20.00"))
         # Calling mark_as_given again should return False.
         self.assertFalse(private_class.mark_as_given())
     
     def test_mark_as_not_given_reverses_balance(self):
         # Initialize balance and history.
         self.user.balance = Decimal("0.00")
-        self.user.balance_history = []
-        self.user.save(update_fields=["balance", "balance_history"])
+        self.user.save(update_fields=["balance"])
         
         private_class = Lesson.objects.create(
             date=date(2025, 1, 1),
@@ -150,10 +158,10 @@ class PrivateClassMarkingTests(TestCase):
         self.assertTrue(result)
         self.user.refresh_from_db()
         self.assertEqual(self.user.balance, Decimal("0.00"))
-        transactions = self.user.balance_history
+        transactions = list(self.user.balance_entries.all())
         # Expect at least two transactions: one for mark_as_given and one for reversal.
         self.assertGreaterEqual(len(transactions), 2)
-        self.assertEqual(transactions[-1]["amount"], "-20.00")
+        self.assertEqual(transactions[-1].amount, Decimal("-20.00"))
 
 # -------------------- BalanceHistoryTests --------------------
 
@@ -161,8 +169,7 @@ class BalanceHistoryTests(TestCase):
     def setUp(self):
         self.user = UserAccount.objects.create(username="testuser", first_name="Test", last_name="User")
         self.user.balance = Decimal("0.00")
-        self.user.balance_history = []
-        self.user.save(update_fields=["balance", "balance_history"])
+        self.user.save(update_fields=["balance"])
     
     def test_multiple_transactions_recorded(self):
         # Perform multiple balance updates.
@@ -171,11 +178,64 @@ class BalanceHistoryTests(TestCase):
         self.user.update_balance(30.00, "Another deposit")
         self.user.refresh_from_db()
         self.assertEqual(self.user.balance, Decimal("60.00"))
-        self.assertEqual(len(self.user.balance_history), 3)
+        history = [entry.as_history_entry() for entry in self.user.balance_entries.all()]
+        self.assertEqual(len(history), 3)
         # Check that amounts are correctly formatted.
-        self.assertEqual(self.user.balance_history[0]["amount"], "+50.00")
-        self.assertEqual(self.user.balance_history[1]["amount"], "-20.00")
-        self.assertEqual(self.user.balance_history[2]["amount"], "+30.00")
+        self.assertEqual(history[0]["amount"], "+50.00")
+        self.assertEqual(history[1]["amount"], "-20.00")
+        self.assertEqual(history[2]["amount"], "+30.00")
+
+    def test_transactions_recorded_in_ledger(self):
+        self.user.update_balance(50.00, "Initial deposit")
+        self.user.update_balance(-20.00, "Withdrawal")
+        entries = list(self.user.balance_entries.values_list("amount", "balance_after", "message"))
+        self.assertEqual(entries, [
+            (Decimal("50.00"), Decimal("50.00"), "Initial deposit"),
+            (Decimal("-20.00"), Decimal("30.00"), "Withdrawal"),
+        ])
+
+    def test_stale_instance_does_not_overwrite_balance(self):
+        stale = UserAccount.objects.get(pk=self.user.pk)
+        self.user.update_balance(50.00, "First")
+        stale.update_balance(10.00, "Second")
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.balance, Decimal("60.00"))
+        self.assertEqual(self.user.balance_entries.last().balance_after, Decimal("60.00"))
+
+    def test_balance_history_endpoint_is_paginated(self):
+        for i in range(3):
+            self.user.update_balance(10.00, f"Deposit {i}")
+        client = APIClient()
+        client.force_authenticate(user=self.user)
+        response = client.get(reverse("balance_history"), {"page_size": 2})
+        self.assertEqual([entry["message"] for entry in response.data["results"]], ["Deposit 2", "Deposit 1"])
+        self.assertTrue(response.data["has_more"])
+        response = client.get(reverse("balance_history"), {"page_size": 2, "page": 2})
+        self.assertEqual([entry["message"] for entry in response.data["results"]], ["Deposit 0"])
+        self.assertFalse(response.data["has_more"])
+        for params in ({"page": "abc"}, {"page_size": "x"}, {"school_id": "nope"}):
+            self.assertEqual(client.get(reverse("balance_history"), params).status_code, 400)
+
+    def test_history_since_last_payout(self):
+        school = School.objects.create(name="Test School")
+        instructor = Instructor.objects.create(user=self.user)
+        school.instructors.add(instructor)
+
+        self.user.update_balance(50.00, "Before payout", school=school)
+        payment = Payment.objects.create(value=50, user=self.user, instructor=instructor, school=school, description={})
+        self.assertEqual(payment.get_payout_user(), self.user)
+        self.user.record_payout(payment)
+        self.user.update_balance(15.00, "After payout", school=school)
+
+        history = json.loads(self.user.get_balance_history_since_last_payout(school=school))
+        self.assertEqual([entry["message"] for entry in history], ["After payout"])
+        self.assertEqual(history[0]["current_balance"], "+65.00")
+
+    def test_history_without_payout_returns_everything(self):
+        self.user.update_balance(10.00, "First")
+        self.user.update_balance(5.00, "Second")
+        history = json.loads(self.user.get_balance_history_since_last_payout())
+        self.assertEqual([entry["message"] for entry in history], ["First", "Second"])
 
 class StudentTests(TestCase):
     def setUp(self):
@@ -590,3 +650,132 @@ class DefineAvailabilityTests(TestCase):
 
         # Ensure no unavailabilities remain
         self.assertEqual(Unavailability.objects.filter(instructor=self.instructor).count(), 0)
+
+
+# -------------------- CalendarServiceCacheTests --------------------
+
+class CalendarServiceCacheTests(TestCase):
+    def setUp(self):
+        self.cache = CalendarServiceCache(maxsize=2)
+        self.user = UserAccount.objects.create(username="instructor")
+        self.set_token(self.user, "access-1", datetime.now(dt_timezone.utc) + timedelta(hours=1))
+        build_patcher = mock.patch("users.utils.build", side_effect=lambda *args, **kwargs: object())
+        self.build = build_patcher.start()
+        self.addCleanup(build_patcher.stop)
+
+    def set_token(self, user, token, expiry):
+        user.calendar_token = encrypt(json.dumps({"token": token, "refresh_token": "refresh", "expiry": expiry.isoformat()}))
+        user.save(update_fields=["calendar_token"])
+
+    def test_service_is_built_once_per_token_version(self):
+        service = self.cache.get(self.user)
+        self.assertIs(self.cache.get(self.user), service)
+        self.assertEqual(self.build.call_count, 1)
+
+        self.set_token(self.user, "access-2", datetime.now(dt_timezone.utc) + timedelta(hours=1))
+        self.assertIsNot(self.cache.get(self.user), service)
+        self.assertEqual(self.build.call_count, 2)
+
+    def test_threads_do_not_share_a_service(self):
+        service = self.cache.get(self.user)
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            other_thread = executor.submit(self.cache.get, self.user).result()
+            self.assertIs(executor.submit(self.cache.get, self.user).result(), other_thread)
+
+        self.assertIsNot(other_thread, service)
+        self.assertIs(self.cache.get(self.user), service)
+
+    def test_least_recently_used_service_is_evicted(self):
+        others = [UserAccount.objects.create(username=f"user{i}") for i in range(2)]
+        for other in others:
+            self.set_token(other, "access", datetime.now(dt_timezone.utc) + timedelta(hours=1))
+        self.cache.get(self.user)
+        self.cache.get(others[0])
+        self.cache.get(self.user)
+        self.cache.get(others[1])
+
+        self.cache.get(self.user)
+        self.assertEqual(self.build.call_count, 3)
+        self.cache.get(others[0])
+        self.assertEqual(self.build.call_count, 4)
+
+    def test_token_is_refreshed_before_expiry_and_only_the_token_is_saved(self):
+        self.set_token(self.user, "access-1", datetime.now(dt_timezone.utc) + timedelta(minutes=1))
+
+        def refresh(creds, request):
+            creds.token = "access-2"
+            creds.expiry = datetime.utcnow() + timedelta(hours=1)
+
+        with mock.patch("users.utils.Credentials.refresh", autospec=True, side_effect=refresh) as refresh_mock, \
+                CaptureQueriesContext(connection) as queries:
+            service = self.cache.get(self.user)
+        refresh_mock.assert_called_once()
+        updates = [query["sql"] for query in queries if query["sql"].startswith("UPDATE")]
+        self.assertEqual(len(updates), 1)
+        self.assertIn('SET "calendar_token"', updates[0])
+        self.assertNotIn('"balance"', updates[0])
+
+        self.user.refresh_from_db()
+        self.assertEqual(json.loads(decrypt(self.user.calendar_token))["token"], "access-2")
+        # the saved token is the cached version, so the service is reused
+        self.assertIs(self.cache.get(self.user), service)
+        self.assertEqual(self.build.call_count, 1)
+
+
+class BookPackViewTests(TestCase):
+    def setUp(self):
+        self.school = School.objects.create(name="Test School")
+        self.parent = UserAccount.objects.create(username="parent", first_name="Jane")
+        self.student = Student.objects.create(first_name="Alice", last_name="Smith")
+        self.student.parents.add(self.parent)
+        self.client = APIClient()
+        self.client.force_authenticate(self.parent)
+
+    def pack_request(self, **overrides):
+        return {
+            "students": [{"id": self.student.id}],
+            "school": self.school.name,
+            "number_of_classes": 4,
+            "duration_in_minutes": 60,
+            "instructors": [],
+            "price": 100,
+            "payment": 0,
+            "type": "private",
+            "subject": {"id": None},
+            "location": {"id": None},
+            "user_paid": True,
+            **overrides,
+        }
+
+    def test_a_failing_pack_books_nothing(self):
+        response = self.client.post(
+            reverse("book_pack"), {"packs": [self.pack_request(), self.pack_request(school="Nowhere")]}, format="json",
+        )
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(len(response.json()["errors"]), 1)
+        self.assertEqual((Pack.objects.count(), Lesson.objects.count(), Payment.objects.count()), (0, 0, 0))
+
+    def test_retry_with_the_same_idempotency_key_books_once(self):
+        payload = {"packs": [self.pack_request(), self.pack_request(number_of_classes=2)]}
+
+        first = self.client.post(reverse("book_pack"), payload, format="json", HTTP_IDEMPOTENCY_KEY="booking-1")
+        retry = self.client.post(reverse("book_pack"), payload, format="json", HTTP_IDEMPOTENCY_KEY="booking-1")
+
+        self.assertEqual((first.status_code, retry.status_code), (201, 201))
+        self.assertEqual(retry.json(), first.json())
+        self.assertEqual([len(pack["lessons"]) for pack in first.json()["booked_packs"]], [4, 2])
+        self.assertEqual((Pack.objects.count(), Lesson.objects.count(), Payment.objects.count()), (2, 6, 1))
+
+        other = self.client.post(reverse("book_pack"), payload, format="json", HTTP_IDEMPOTENCY_KEY="booking-2")
+        self.assertEqual(other.status_code, 201)
+        self.assertEqual(Pack.objects.count(), 4)
+
+    def test_school_price_wins_over_the_app_price(self):
+        self.school.update_pack_price("private", "60m", "1p", "4c", 80)
+
+        response = self.client.post(reverse("book_pack"), {"packs": [self.pack_request(price=1)]}, format="json")
+
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(Pack.objects.get().price, Decimal("80.00"))
+        self.assertEqual(Payment.objects.get().value, Decimal("80.00"))
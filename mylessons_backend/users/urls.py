@@ -1,5 +1,5 @@
 from django.urls import path
-from .views import  generate_key, pair_by_key, PasswordResetConfirmView, PasswordResetRequestView, check_username_availability, daily_timeline, firebase_login, get_selected_instructors, get_selected_students, login_view, profile_view, register_user, student, student_debt, student_lessons, student_packs, student_parents, student_progress_records, update_availability, user_profile, current_role, number_of_active_students, current_balance, change_role, available_roles, change_school_id, current_school_id, available_schools, students, create_student, book_pack_view
+from .views import  generate_key, pair_by_key, PasswordResetConfirmView, PasswordResetRequestView, check_username_availability, daily_timeline, firebase_login, get_selected_instructors, get_selected_students, login_view, profile_view, register_user, student, student_debt, student_lessons, student_packs, student_parents, student_progress_records, update_availability, user_profile, current_role, notification_digest, number_of_active_students, current_balance, balance_history, change_role, available_roles, change_school_id, current_school_id, available_schools, students, create_student, book_pack_view
 
 urlpatterns = [
     path('student/<int:id>/', student, name='student'),
@@ -14,8 +14,10 @@ urlpatterns = [
     path('profile/', user_profile, name='user-profile'),
     path('current_role/', current_role, name='current-role'),
     path('change_role/', change_role, name='change_role'),
+    path('notification_digest/', notification_digest, name='notification_digest'),
     path('number_of_active_students/', number_of_active_students, name='number-of-students'),
     path("current_balance/", current_balance, name="current_balance"),
+    path("balance_history/", balance_history, name="balance_history"),
     path("available_roles/", available_roles, name="available_roles"),
     path("current_school_id/", current_school_id, name="current_school_id"),
     path("change_school_id/", change_school_id, name="change_school_id"),
@@ -7,7 +7,10 @@ from django.utils import timezone
 from .models import *
 from google.oauth2.credentials import Credentials
 from googleapiclient.discovery import build
+import hashlib
 import json
+import threading
+from collections import OrderedDict
 from google.auth.transport.requests import Request
 from datetime import timedelta, datetime
 import pytz
@@ -291,30 +294,105 @@ def create_google_event(service, class_instance, start_datetime, end_datetime, l
     service.events().insert(calendarId='primary', body=event).execute()
 """
 
-def get_calendar_service(user):
-    # 1) Decrypt the blob
-    blob = json.loads(decrypt(user.calendar_token))
-
-    # 2) Rebuild Credentials
-    creds = Credentials(
-        token=blob['token'],
-        refresh_token=blob['refresh_token'],
-        token_uri='https://oauth2.googleapis.com/token',
-        client_id=settings.GOOGLE_OAUTH_WEB_CLIENT_ID,
-        client_secret=settings.GOOGLE_OAUTH_WEB_CLIENT_SECRET,
-        scopes=['https://www.googleapis.com/auth/calendar'],
-    )
-
-    # 3) Refresh if needed
-    if creds.expired and creds.refresh_token:
-        creds.refresh(Request())
-        # persist updated token
+CALENDAR_SCOPES = ['https://www.googleapis.com/auth/calendar']
+CALENDAR_SERVICE_CACHE_SIZE = 256
+CALENDAR_TOKEN_REFRESH_MARGIN = timedelta(minutes=5)  # refresh this long before the access token expires
+
+
+class CalendarServiceCache:
+    """
+    LRU cache of built Calendar services, one per thread: a service holds
+    an httplib2.Http, which is not thread-safe, so threads of the same
+    process never share one. Entries are keyed by user and token version (a
+    digest of the encrypted calendar_token), so a user reconnecting their
+    calendar gets a new service. Access tokens close to expiry are
+    refreshed proactively and only calendar_token is saved.
+    """
+
+    def __init__(self, maxsize=CALENDAR_SERVICE_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._local = threading.local()
+
+    @property
+    def _entries(self):
+        # user pk -> (token version, credentials, service), for this thread
+        entries = getattr(self._local, 'entries', None)
+        if entries is None:
+            entries = self._local.entries = OrderedDict()
+        return entries
+
+    @staticmethod
+    def token_version(user):
+        return hashlib.sha256(user.calendar_token.encode('utf-8')).hexdigest()
+
+    def get(self, user):
+        entries = self._entries
+        version = self.token_version(user)
+        entry = entries.get(user.pk)
+        if entry is None or entry[0] != version:
+            creds = self._load_credentials(user)
+            entry = (version, creds, build('calendar', 'v3', credentials=creds, cache_discovery=False))
+        creds = entry[1]
+        if self._needs_refresh(creds):
+            creds.refresh(Request())
+            self._persist(user, creds)
+            entry = (self.token_version(user), creds, entry[2])
+
+        entries[user.pk] = entry
+        entries.move_to_end(user.pk)
+        while len(entries) > self.maxsize:
+            entries.popitem(last=False)
+        return entry[2]
+
+    def invalidate(self, user=None):
+        """Drops the calling thread's service of user, or all of them."""
+        if user is None:
+            self._entries.clear()
+        else:
+            self._entries.pop(user.pk, None)
+
+    @staticmethod
+    def _load_credentials(user):
+        blob = json.loads(decrypt(user.calendar_token))
+        creds = Credentials(
+            token=blob['token'],
+            refresh_token=blob.get('refresh_token'),
+            token_uri='https://oauth2.googleapis.com/token',
+            client_id=settings.GOOGLE_OAUTH_WEB_CLIENT_ID,
+            client_secret=settings.GOOGLE_OAUTH_WEB_CLIENT_SECRET,
+            scopes=CALENDAR_SCOPES,
+        )
+        if blob.get('expiry'):
+            expiry = datetime.fromisoformat(blob['expiry'])
+            # google-auth compares expiry with naive UTC datetimes
+            if expiry.tzinfo is not None:
+                expiry = expiry.astimezone(pytz.utc).replace(tzinfo=None)
+            creds.expiry = expiry
+        return creds
+
+    @staticmethod
+    def _needs_refresh(creds):
+        if not creds.refresh_token:
+            return False
+        if not creds.token or creds.expiry is None:
+            return not creds.token
+        return creds.expiry - CALENDAR_TOKEN_REFRESH_MARGIN <= datetime.utcnow()
+
+    @staticmethod
+    def _persist(user, creds):
+        blob = json.loads(decrypt(user.calendar_token))
         blob['token'] = creds.token
+        blob['expiry'] = creds.expiry.replace(tzinfo=pytz.utc).isoformat() if creds.expiry else None
         user.calendar_token = encrypt(json.dumps(blob))
-        user.save()
+        user.save(update_fields=['calendar_token'])
+
+
+calendar_services = CalendarServiceCache()
 
-    # 4) Build & return the service
-    return build('calendar', 'v3', credentials=creds)
+
+def get_calendar_service(user):
+    """The user's Calendar service, built once per token version and thread for sync and on-demand calls."""
+    return calendar_services.get(user)
 
 def get_users_name(users_list):
     
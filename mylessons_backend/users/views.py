@@ -8,6 +8,7 @@ from mylessons import settings
 from users.utils import encrypt
 from sports.models import Sport
 from payments.models import Payment
+from payments.utils import debt_summary, unpaid_pack_items
 from rest_framework.decorators import api_view, permission_classes
 from rest_framework.response import Response
 from django.shortcuts import get_object_or_404, redirect
@@ -22,7 +23,7 @@ from .models import GoogleCredentials, Student, Unavailability, UserAccount, Ins
     UserCredentials, AssociationKey
 from .serializers import PasswordResetConfirmSerializer, PasswordResetRequestSerializer, UserAccountSerializer, StudentSerializer, GenerateKeyOutputSerializer, PairByKeyInputSerializer
 from notifications.models import Notification
-from lessons.models import Lesson, Pack
+from lessons.models import Lesson, Pack, PackBooking
 from schools.models import School
 from django.db.models import Q
 from django.utils.timezone import now
@@ -30,7 +31,7 @@ from django.utils.dateparse import parse_date, parse_time
 import firebase_admin
 from firebase_admin import auth as firebase_auth, initialize_app, credentials
 import os
-from django.db import transaction
+from django.db import IntegrityError, transaction
 import secrets
 import string
 from google.oauth2 import id_token
@@ -387,6 +388,26 @@ def change_school_id(request):
         return Response({"error": "School was not changed!"},
                         status=status.HTTP_400_BAD_REQUEST)
 
+@api_view(['GET', 'POST'])
+@permission_classes([IsAuthenticated])
+def notification_digest(request):
+    """
+    GET returns how the user gets push notifications; POST changes it to
+    "immediate", "hourly" or "daily".
+    """
+    user = request.user
+
+    if request.method == 'POST':
+        frequency = request.data.get("notification_digest")
+        if frequency not in dict(UserAccount.DIGEST_CHOICES):
+            return Response({"error": "Invalid digest frequency."}, status=status.HTTP_400_BAD_REQUEST)
+        user.notification_digest = frequency
+        user.save(update_fields=["notification_digest"])
+        if frequency == UserAccount.DIGEST_IMMEDIATE:
+            Notification.release_digest_queue(user)
+
+    return Response({"notification_digest": user.notification_digest})
+
 @api_view(['POST'])
 @permission_classes([IsAuthenticated])
 def change_role(request):
@@ -480,6 +501,36 @@ def current_balance(request):
     
     return Response(data)
 
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def balance_history(request):
+    """
+    Paginate the current user's balance ledger, newest first.
+    Optional ?school_id= scopes the entries to one school.
+    """
+    user = request.user
+    try:
+        page = max(1, int(request.GET.get('page', 1)))
+        page_size = min(50, max(1, int(request.GET.get('page_size', 10))))
+        school_id = int(request.GET['school_id']) if request.GET.get('school_id') else None
+    except ValueError:
+        return Response({'error': 'page, page_size and school_id must be integers.'}, status=status.HTTP_400_BAD_REQUEST)
+
+    school = None
+    if school_id:
+        school = get_object_or_404(School, id=school_id)
+
+    start = (page - 1) * page_size
+    end = start + page_size
+    # fetch one extra row to know whether there is a next page without a COUNT
+    entries = list(user.get_balance_entries(school=school)[start:end + 1])
+
+    return Response({
+        'current_balance': user.balance,
+        'results': [entry.as_history_entry() for entry in entries[:page_size]],
+        'has_more': len(entries) > page_size,
+    })
+
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
 def available_roles(request):
@@ -656,17 +707,58 @@ def book_pack_view(request):
     by their school. After booking all packs, it creates one Payment object per unique school,
     setting payment.user=request.user, payment.school to that school, and associates all
     the corresponding packs (via payment.packs.set(...)).
+
+    All packs are booked in one transaction: if any of them fails, nothing is booked.
+    With an Idempotency-Key header (or "idempotency_key" in the payload), a retried
+    request returns the response of the first one instead of booking again.
     """
     data = request.data
     logger.debug("Received payload: %s", data)
-    today = now().date()
-    
+
     packs_data = data.get('packs', None)
     if packs_data is None or not isinstance(packs_data, list):
         error_msg = "Invalid payload. Expected a 'packs' list."
         logger.error(error_msg)
         return Response({"error": error_msg}, status=status.HTTP_400_BAD_REQUEST)
 
+    idempotency_key = request.headers.get('Idempotency-Key') or data.get('idempotency_key')
+    if idempotency_key:
+        previous = PackBooking.objects.filter(user=request.user, idempotency_key=idempotency_key).first()
+        if previous:
+            return Response(previous.response, status=status.HTTP_201_CREATED)
+
+    try:
+        with transaction.atomic():
+            booking = None
+            if idempotency_key:
+                # a concurrent request with the same key waits here and then fails on the unique key
+                booking = PackBooking.objects.create(user=request.user, idempotency_key=idempotency_key)
+            result, errors = _book_packs(request, packs_data)
+            if errors:
+                transaction.set_rollback(True)
+            elif booking:
+                booking.response = result
+                booking.save(update_fields=["response"])
+    except IntegrityError:
+        previous = PackBooking.objects.filter(user=request.user, idempotency_key=idempotency_key).first()
+        if previous is None:
+            raise
+        return Response(previous.response, status=status.HTTP_201_CREATED)
+
+    if errors:
+        logger.error("Booking errors: %s", errors)
+        return Response({"errors": errors}, status=status.HTTP_400_BAD_REQUEST)
+    logger.debug("Booked packs successfully: %s", result)
+    return Response(result, status=status.HTTP_201_CREATED)
+
+
+def _book_packs(request, packs_data):
+    """
+    Books every pack request of book_pack_view in the caller's transaction.
+    Each pack gets its own savepoint so every failing request is reported.
+    Returns (response payload, errors).
+    """
+    today = now().date()
     booked_packs = []
     errors = []
     
@@ -728,21 +820,30 @@ def book_pack_view(request):
             if location_id:
                 location = Location.objects.get(pk=location_id)
 
-            new_pack = Pack.book_new_pack(
-                students=students,
-                school=school_obj,
-                date=now().date(), 
-                number_of_classes=pack_req.get('number_of_classes'),
-                duration_in_minutes=pack_req.get('duration_in_minutes'),
-                instructors=pack_req.get('instructors'),
-                price=pack_req.get('price'),
-                payment=payment_value,
-                discount_id=pack_req.get('discount_id'),
-                type=final_type,
-                expiration_date=expiration_date if expiration_date else None,
-                subject=subject,
-                location=location,
+            # the school's own price wins over the one sent by the app
+            price = school_obj.get_price_table().pack_price(
+                final_type, pack_req.get('duration_in_minutes'), len(students), pack_req.get('number_of_classes'),
             )
+            if price is None:
+                price = pack_req.get('price')
+
+            with transaction.atomic():
+                new_pack = Pack.book_new_pack(
+                    students=students,
+                    school=school_obj,
+                    date=now().date(), 
+                    number_of_classes=pack_req.get('number_of_classes'),
+                    duration_in_minutes=pack_req.get('duration_in_minutes'),
+                    instructors=pack_req.get('instructors'),
+                    price=price,
+                    payment=payment_value,
+                    discount_id=pack_req.get('discount_id'),
+                    type=final_type,
+                    expiration_date=expiration_date if expiration_date else None,
+                    subject=subject,
+                    location=location,
+                )
+            lessons = new_pack.lessons_many.select_related('school').prefetch_related('packs', 'students')
             booked_packs.append({
                 "pack_id": new_pack.id,
                 "lessons": [
@@ -750,9 +851,9 @@ def book_pack_view(request):
                         "lesson_id": lesson.id,
                         "lesson_str": str(lesson),
                         "school": str(lesson.school) if lesson.school else "",
-                        "expiration_date": lesson.packs.all()[0].expiration_date if lesson.packs.exists() and lesson.packs.all()[0].expiration_date else "None",
+                        "expiration_date": lesson.packs.all()[0].expiration_date if lesson.packs.all() and lesson.packs.all()[0].expiration_date else "None",
                     }
-                    for lesson in new_pack.lessons_many.all()
+                    for lesson in lessons
                 ],
                 "lessons_remaining": str(new_pack.number_of_classes_left),
                 "unscheduled_lessons": str(new_pack.get_number_of_unscheduled_lessons()),
@@ -775,9 +876,8 @@ def book_pack_view(request):
             logger.exception(error_str)
 
     if errors:
-        logger.error("Booking errors: %s", errors)
-        return Response({"errors": errors}, status=status.HTTP_400_BAD_REQUEST)
-    
+        return None, errors
+
     # Now create a Payment object for each school that has packs with user_paid True.
     for school_obj, info in payment_data_by_school.items():
         packs_list = info["packs"]
@@ -793,11 +893,11 @@ def book_pack_view(request):
                 }
             )
             payment.packs.set(packs_list)
+            Payment.issue_receipts_on_commit([payment])
             logger.debug("Created Payment (ID %s) for School '%s' with packs: %s",
                          payment.id, school_obj.name, [p.id for p in packs_list])
-    
-    logger.debug("Booked packs successfully: %s", booked_packs)
-    return Response({"booked_packs": booked_packs}, status=status.HTTP_201_CREATED)
+
+    return {"booked_packs": booked_packs}, []
     
 # Helper to map weekday names to Python's date.weekday() indices
 DAY_NAME_TO_INDEX = {
@@ -1352,27 +1452,17 @@ def student_debt(request, id: int):
     plus a list of unpaid pack‐items for that student.
     """
     student = get_object_or_404(Student, pk=id)
+    packs = Pack.objects.filter(students=student)
 
-    # All packs where this student is enrolled and there is a remaining debt
-    unpaid_packs = Pack.objects.filter(students=student, debt__gt=0)
-
-    # Sum up the debt field on each pack
-    total_debt = sum((p.debt for p in unpaid_packs), Decimal('0.00'))
-
-    # Build itemized list
-    items = []
-    for pack in unpaid_packs:
-        items.append({
-            "pack_id": pack.id,
-            "date": pack.date.strftime("%Y-%m-%d") if pack.date else "",
-            "time": pack.date_time.strftime("%H:%M") if pack.date_time else "",
-            "description": str(pack),     # e.g. "Private pack – 10 lessons"
-            "amount": str(pack.debt),     # as string to preserve decimal precision
-        })
+    page = request.GET.get('page')
+    summary = debt_summary(packs)
+    items, has_more = unpaid_pack_items(packs, page=max(1, int(page)) if page else None)
 
     return Response({
-        "current_debt": str(total_debt),
+        "current_debt": summary["current_debt"],
+        "aging": summary["aging"],
         "items": items,
+        "has_more": has_more,
     })
 
 def student_parents(request, id: int):
@@ -1437,7 +1527,7 @@ def exchange_code(request):
 
     user = request.user
     user.calendar_token = encrypt(json.dumps(blob))
-    user.save()
+    user.save(update_fields=['calendar_token'])
 
     return Response({'status': 'ok'})
         
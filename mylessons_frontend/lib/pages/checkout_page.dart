@@ -126,6 +126,7 @@ class _CheckoutPageState extends State<CheckoutPage> {
     final url = Uri.parse('$baseUrl/api/users/book_pack/');
     final headers = await getAuthHeaders();
     headers['Content-Type'] = 'application/json';
+    headers['Idempotency-Key'] = CartService().checkoutKey;
 
     try {
       final response = await http.post(
@@ -37,51 +37,15 @@ class _PaymentSuccessPageState extends State<PaymentSuccessPage> {
   }
 
   /// Overall success handler:
-  /// - If there are no items in the cart, create a debt payment record.
+  /// - Debt payments are recorded by the backend from Stripe's webhook,
+  ///   so there is nothing to do here for them.
   /// - Otherwise, proceed to book packs.
   Future<void> _processSuccess() async {
-    if (widget.cameFromPaymentsPage == true) {
-      await _createDebtPaymentRecord();
-    } else {
+    if (widget.cameFromPaymentsPage != true) {
       await _bookPacks();
     }
   }
 
-  /// Create a debt payment record using the provided pack amounts.
-  Future<void> _createDebtPaymentRecord() async {
-    if (widget.packAmounts == null || widget.packAmounts!.isEmpty) {
-      debugPrint("No pack amounts to send; skipping debt payment record.");
-      return;
-    }
-
-    final Map<String, dynamic> payload = {
-      "pack_amounts": widget.packAmounts,
-    };
-
-    try {
-      final url =
-          Uri.parse("$baseUrl/api/payments/create_debt_payment_record/");
-      final headers = await getAuthHeaders();
-
-      final response = await http.post(
-        url,
-        headers: headers,
-        body: json.encode(payload),
-      );
-
-      if (response.statusCode == 200 || response.statusCode == 201) {
-        debugPrint(
-            "Debt Payment record created successfully: ${response.body}");
-      } else {
-        debugPrint(
-          "Failed to create debt payment record: ${response.statusCode}, ${response.body}",
-        );
-      }
-    } catch (e) {
-      debugPrint("Error creating debt payment record from Stripe metadata: $e");
-    }
-  }
-
   /// Books the packs using your existing booking endpoint.
   Future<void> _bookPacks() async {
     // Build payload only for items that represent a pack.
@@ -140,7 +104,10 @@ class _PaymentSuccessPageState extends State<PaymentSuccessPage> {
 
       final response = await http.post(
         Uri.parse("$baseUrl/api/users/book_pack/"),
-        headers: await getAuthHeaders(),
+        headers: {
+          ...await getAuthHeaders(),
+          'Idempotency-Key': _cartService.checkoutKey,
+        },
         body: json.encode(payload),
       );
 
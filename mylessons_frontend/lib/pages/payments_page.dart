@@ -64,6 +64,18 @@ class _PaymentsPageState extends State<PaymentsPage> {
     }
   }
 
+  // The history endpoints return every row as a list, or one page
+  // ({data, next_cursor, has_more}) when asked for ?cursor= / ?page_size=.
+  List<Map<String, dynamic>> _decodeHistory(List<int> bodyBytes) {
+    final decoded = json.decode(utf8.decode(bodyBytes));
+    if (decoded is List) {
+      return List<Map<String, dynamic>>.from(decoded);
+    } else if (decoded is Map && decoded.containsKey("data")) {
+      return List<Map<String, dynamic>>.from(decoded["data"]);
+    }
+    return [];
+  }
+
   // ------------------- Parent Data -------------------
   Future<void> _fetchParentData() async {
     final headers = await getAuthHeaders();
@@ -94,8 +106,7 @@ class _PaymentsPageState extends State<PaymentsPage> {
         }
       }
       if (historyRes.statusCode == 200) {
-        _parentHistory =
-            List<Map<String, dynamic>>.from(json.decode(utf8.decode(historyRes.bodyBytes)));
+        _parentHistory = _decodeHistory(historyRes.bodyBytes);
       }
     } catch (e) {
       debugPrint("Error fetching Parent data: $e");
@@ -110,8 +121,7 @@ class _PaymentsPageState extends State<PaymentsPage> {
           Uri.parse('$baseUrl/api/payments/instructor_payment_history/'),
           headers: headers);
       if (historyRes.statusCode == 200) {
-        _instructorHistory =
-            List<Map<String, dynamic>>.from(json.decode(utf8.decode(historyRes.bodyBytes)));
+        _instructorHistory = _decodeHistory(historyRes.bodyBytes);
       }
       final balanceResponse = await http.get(
           Uri.parse('$baseUrl/api/users/current_balance/'),
@@ -161,14 +171,7 @@ class _PaymentsPageState extends State<PaymentsPage> {
         _upcomingPayouts = [];
       }
 
-      final decodedHistory = json.decode(utf8.decode(historyRes.bodyBytes));
-      if (decodedHistory is List) {
-        _adminHistory = List<Map<String, dynamic>>.from(decodedHistory);
-      } else if (decodedHistory is Map && decodedHistory.containsKey("data")) {
-        _adminHistory = List<Map<String, dynamic>>.from(decodedHistory["data"]);
-      } else {
-        _adminHistory = [];
-      }
+      _adminHistory = _decodeHistory(historyRes.bodyBytes);
     } catch (e) {
       debugPrint("Error fetching Admin data: $e");
     }
@@ -1,4 +1,5 @@
 // cart_service.dart
+import 'dart:math';
 import 'package:flutter/foundation.dart';
 
 class CartService {
@@ -12,6 +13,22 @@ class CartService {
 
   List<Map<String, dynamic>> get items => _items;
 
+  String? _checkoutKey;
+
+  /// Idempotency-Key sent with every book_pack/ request for the current
+  /// cart, so a retried booking (or the one after Stripe returns to the
+  /// success page) is not booked twice. A new key is made when the cart
+  /// changes.
+  String get checkoutKey {
+    if (_checkoutKey == null) {
+      final random = Random.secure();
+      _checkoutKey = List.generate(16, (_) => random.nextInt(256))
+          .map((byte) => byte.toRadixString(16).padLeft(2, '0'))
+          .join();
+    }
+    return _checkoutKey!;
+  }
+
   void addToCart(
     Map<String, dynamic> service,
     List<Map<String, dynamic>> selectedStudents,
@@ -37,16 +54,19 @@ class CartService {
           : null,
       'price': price,
     });
+    _checkoutKey = null;
     cartCount.value = _items.length;
   }
 
   void removeAt(int index) {
     _items.removeAt(index);
+    _checkoutKey = null;
     cartCount.value = _items.length;
   }
 
   void clear() {
     _items.clear();
+    _checkoutKey = null;
     cartCount.value = 0;
   }
 